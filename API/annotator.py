@@ -1,8 +1,9 @@
 # coding=utf-8
 import Settings
 from model_store import ModelStore
+from annotator_bundle import build_annotator_bundle, load_annotator_bundle
 from window_based_tagger_config import get_config
-from processessays import process_essays, build_spelling_corrector
+from processessays import process_essays
 from nltk.tokenize import sent_tokenize
 from collections import defaultdict
 from BrattEssay import Essay, load_bratt_essays
@@ -10,7 +11,7 @@ from EssayCategory import cr_sort_key, friendly_tag, essay_category
 import numpy as np
 
 from featureextractortransformer import FeatureExtractorTransformer
-from sent_feats_for_stacking import CAUSAL_REL, RESULT_REL, CAUSE_RESULT, get_sent_feature_for_stacking_from_tagging_model
+from sent_feats_for_stacking import get_sent_feature_for_stacking_from_tagging_model
 
 from featureextractionfunctions import fact_extract_positional_word_features_stemmed, fact_extract_ngram_features_stemmed
 from wordtagginghelper import flatten_to_wordlevel_feat_tags, test_classifier_per_code
@@ -52,27 +53,58 @@ class Annotator(object):
     @classmethod
     def from_config(cls, config_file):
         cfg = Config(config_file)
+        if cfg.annotator_bundle:
+            return Annotator.from_bundle(cfg.annotator_bundle)
         return Annotator(cfg.models_folder, cfg.essays_folder, cfg.spell_check_dict)
 
+    @classmethod
+    def from_bundle(cls, bundle_file):
+        """
+        Loads the annotator from a bundle written by the training scripts (see annotator_bundle.py).
+        Unlike the constructor, this does not need access to the essay corpus or the spelling dictionary
+        """
+        annotator = cls.__new__(cls)
+        annotator.__initialize_(load_annotator_bundle(bundle_file))
+        return annotator
+
     def __init__(self, models_folder, essays_folder, spell_check_dict):
 
-        logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
         if not models_folder.endswith("/"):
             models_folder += "/"
         if not essays_folder.endswith("/"):
             essays_folder += "/"
 
-        self.logger = logging.getLogger()
         cfg = get_config(essays_folder)
-        self.config = cfg
-        self.essays_folder = essays_folder
 
-        # Create spell checker
         # Need annotations here purely to load the tags
         tagged_essays = load_bratt_essays(essays_folder, include_vague=cfg["include_vague"], include_normal=cfg["include_normal"], load_annotations=True)
-        self.__set_tags_(tagged_essays)
-        self.wd_sent_freq = defaultdict(int)
-        self.spelling_corrector = build_spelling_corrector(tagged_essays, self.config["lower_case"], self.wd_sent_freq, folder=spell_check_dict)
+
+        # load models
+        logging.getLogger().info("Loading pickled models")
+        store = ModelStore(models_folder=models_folder)
+
+        bundle = build_annotator_bundle(tagged_essays, cfg, spell_check_dict,
+                                        feat_transform=store.get_transformer(),
+                                        tag_2_wd_classifier=store.get_tag_2_wd_classifier(),
+                                        tag_2_sent_classifier=store.get_tag_2_sent_classifier())
+        self.__initialize_(bundle)
+
+    def __initialize_(self, bundle):
+
+        logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+        self.logger = logging.getLogger()
+        self.config = bundle["config"]
+        self.essays_folder = self.config["folder"]
+
+        self.wd_test_tags = bundle["wd_test_tags"]
+        self.sent_input_feat_tags = bundle["sent_input_feat_tags"]
+        self.sent_input_interaction_tags = bundle["sent_input_interaction_tags"]
+        self.sent_output_train_test_tags = bundle["sent_output_train_test_tags"]
+
+        # Spell checker
+        self.wd_sent_freq = bundle["wd_sent_freq"]
+        self.spelling_corrector = bundle["spelling_corrector"]
 
         offset = (self.config["window_size"] - 1) / 2
 
@@ -84,130 +116,131 @@ class Annotator(object):
         # most params below exist ONLY for the purposes of the hashing to and from disk
         self.feature_extractor = FeatureExtractorTransformer(extractors)
 
-        # load models
-        self.logger.info("Loading pickled models")
-        store = ModelStore(models_folder=models_folder)
-
-        self.feature_transformer =  store.get_transformer()
+        self.feature_transformer = bundle["feat_transform"]
         self.logger.info("Loaded Transformer")
-        self.tag_2_wd_classifier = store.get_tag_2_wd_classifier()
+        self.tag_2_wd_classifier = bundle["tag_2_wd_classifier"]
         self.logger.info("Loaded word tagging model")
-        self.tag_2_sent_classifier = store.get_tag_2_sent_classifier()
+        self.tag_2_sent_classifier = bundle["tag_2_sent_classifier"]
         self.logger.info("Loaded sentence classifier")
 
     def annotate(self, essay_text):
 
         try:
+            return self.__annotate_essays_([essay_text])[0]
+        except Exception as x:
+            self.logger.exception("An exception occured while annotating essay")
+            return {"error": format_exc()}
+        pass
+
+    def annotate_many(self, essay_texts):
+        """
+        Annotates a batch of essays. The word features for all essays are stacked into a single matrix
+        so that each word and sentence classifier is only called once per batch, rather than once per essay
+
+        @param essay_texts: list[str]
+            the essay texts to annotate
+        @return: list[dict]
+            one annotation dictionary per essay, in the same order as essay_texts
+        """
+        if len(essay_texts) == 0:
+            return []
+        try:
+            return self.__annotate_essays_(essay_texts)
+        except Exception as x:
+            # one bad essay should not fail the whole batch, so fall back to annotating each essay separately
+            self.logger.exception("An exception occured while annotating a batch of essays, annotating individually")
+            return [self.annotate(essay_text) for essay_text in essay_texts]
+
+    def __annotate_essays_(self, essay_texts):
+
+        essays = []
+        for essay_text in essay_texts:
             sentences = sent_tokenize(essay_text.strip())
             contents = "\n".join(sentences)
 
             essay = Essay(full_path=None, include_vague=self.config["include_vague"],
                           include_normal=self.config["include_normal"], load_annotations=False, essay_text=contents)
+            essays.append(essay)
+
+        processed_essays = process_essays(essays=essays,
+                                          spelling_corrector=self.spelling_corrector,
+                                          wd_sent_freq=self.wd_sent_freq,
+                                          remove_infrequent=self.config["remove_infrequent"],
+                                          spelling_correct=self.config["spelling_correct"],
+                                          replace_nums=self.config["replace_nums"],
+                                          stem=self.config["stem"],
+                                          remove_stop_words=self.config["remove_stop_words"],
+                                          remove_punctuation=self.config["remove_punctuation"],
+                                          lower_case=self.config["lower_case"])
+
+        self.logger.info("%i essay(s) loaded successfully" % len(processed_essays))
+        essays_TD = self.feature_extractor.transform(processed_essays)
+
+        wd_feats, _ = flatten_to_wordlevel_feat_tags(essays_TD)
+        xs = self.feature_transformer.transform(wd_feats)
+
+        wd_predictions_by_code = test_classifier_per_code(xs, self.tag_2_wd_classifier, self.wd_test_tags)
+
+        dummy_wd_td_ys_bytag = defaultdict(lambda: np.asarray([0.0] * xs.shape[0]))
+        sent_xs, sent_ys_bycode = get_sent_feature_for_stacking_from_tagging_model(self.sent_input_feat_tags,
+                                                                                   self.sent_input_interaction_tags,
+                                                                                   essays_TD, xs,
+                                                                                   dummy_wd_td_ys_bytag,
+                                                                                   self.tag_2_wd_classifier,
+                                                                                   sparse=True,
+                                                                                   look_back=0)
+
+        """ Test Stack Classifier """
+
+        sent_predictions_by_code = test_classifier_per_code(sent_xs, self.tag_2_sent_classifier, self.sent_output_train_test_tags)
+
+        """ Generate Return Values """
+        essay_type = None
+        if "coral" in self.essays_folder.lower():
+            essay_type = "CB"
+        elif "skin" in self.essays_folder.lower():
+            essay_type = "SC"
+        else:
+            raise Exception("Unknown essay type")
 
-            processed_essays = process_essays(essays=[essay],
-                                              spelling_corrector=self.spelling_corrector,
-                                              wd_sent_freq=self.wd_sent_freq,
-                                              remove_infrequent=self.config["remove_infrequent"],
-                                              spelling_correct=self.config["spelling_correct"],
-                                              replace_nums=self.config["replace_nums"],
-                                              stem=self.config["stem"],
-                                              remove_stop_words=self.config["remove_stop_words"],
-                                              remove_punctuation=self.config["remove_punctuation"],
-                                              lower_case=self.config["lower_case"])
-
-            self.logger.info("Essay loaded successfully")
-            essays_TD = self.feature_extractor.transform(processed_essays)
-
-            wd_feats, _ = flatten_to_wordlevel_feat_tags(essays_TD)
-            xs = self.feature_transformer.transform(wd_feats)
-
-            wd_predictions_by_code = test_classifier_per_code(xs, self.tag_2_wd_classifier, self.wd_test_tags)
-
-            dummy_wd_td_ys_bytag = defaultdict(lambda: np.asarray([0.0] * xs.shape[0]))
-            sent_xs, sent_ys_bycode = get_sent_feature_for_stacking_from_tagging_model(self.sent_input_feat_tags,
-                                                                                             self.sent_input_interaction_tags,
-                                                                                             essays_TD, xs,
-                                                                                             dummy_wd_td_ys_bytag,
-                                                                                             self.tag_2_wd_classifier,
-                                                                                             sparse=True,
-                                                                                             look_back=0)
-
-            """ Test Stack Classifier """
-
-            sent_predictions_by_code = test_classifier_per_code(sent_xs, self.tag_2_sent_classifier, self.sent_output_train_test_tags)
-
-            """ Generate Return Values """
-            essay_tags = self.__get_essay_tags_(sent_predictions_by_code)
-
-            essay_type = None
-            if "coral" in self.essays_folder.lower():
-                essay_type = "CB"
-            elif "skin" in self.essays_folder.lower():
-                essay_type = "SC"
-            else:
-                raise Exception("Unknown essay type")
+        # split the stacked predictions back out per essay
+        annotations = []
+        wd_ix, sent_ix = 0, 0
+        for essay, essay_TD in zip(essays, essays_TD):
+            num_wds = sum(map(len, essay_TD.sentences))
+            num_sents = len(essay_TD.sentences)
 
-            raw_essay_tags = ",".join(sorted(essay_tags, key=cr_sort_key))
+            essay_wd_predictions_by_code = dict((tag, preds[wd_ix:wd_ix + num_wds])
+                                                for tag, preds in wd_predictions_by_code.items())
+            essay_sent_predictions_by_code = dict((tag, preds[sent_ix:sent_ix + num_sents])
+                                                  for tag, preds in sent_predictions_by_code.items())
+            wd_ix += num_wds
+            sent_ix += num_sents
 
-            t_words = self.__get_tagged_words_(essay, essays_TD[0], wd_predictions_by_code)
-            t_sentences = self.__get_tagged_sentences_(essay, sent_predictions_by_code)
+            annotations.append(self.__get_annotation_(essay, essay_TD, essay_type,
+                                                      essay_wd_predictions_by_code, essay_sent_predictions_by_code))
+        return annotations
 
-            tagged_sentences = [t_sent.add_word_tags(map(lambda twd: twd.__dict__, t_wds)).__dict__
-                                for t_sent, t_wds in zip(t_sentences, t_words)]
+    def __get_annotation_(self, essay, essay_TD, essay_type, wd_predictions_by_code, sent_predictions_by_code):
 
-            essay_codes, essay_causal = self.__format_essay_tags_(essay_tags)
-            return {"tagged_sentences"  :   tagged_sentences,
+        essay_tags = self.__get_essay_tags_(sent_predictions_by_code)
+        raw_essay_tags = ",".join(sorted(essay_tags, key=cr_sort_key))
 
-                    "essay_codes"       :   essay_codes,
-                    "essay_causal"      :   essay_causal,
-                    "essay_category"    :   essay_category(raw_essay_tags, essay_type),
+        t_words = self.__get_tagged_words_(essay, essay_TD, wd_predictions_by_code)
+        t_sentences = self.__get_tagged_sentences_(essay, sent_predictions_by_code)
 
-                    "raw_essay_tags"    :   raw_essay_tags
-            }
-        except Exception as x:
-            self.logger.exception("An exception occured while annotating essay")
-            return {"error": format_exc()}
-        pass
+        tagged_sentences = [t_sent.add_word_tags(map(lambda twd: twd.__dict__, t_wds)).__dict__
+                            for t_sent, t_wds in zip(t_sentences, t_words)]
+
+        essay_codes, essay_causal = self.__format_essay_tags_(essay_tags)
+        return {"tagged_sentences"  :   tagged_sentences,
+
+                "essay_codes"       :   essay_codes,
+                "essay_causal"      :   essay_causal,
+                "essay_category"    :   essay_category(raw_essay_tags, essay_type),
 
-    def __set_tags_(self, tagged_essays):
-
-        MIN_TAG_FREQ = 5
-
-        tag_freq = defaultdict(int)
-        for essay in tagged_essays:
-            for sentence in essay.tagged_sentences:
-                un_tags = set()
-                for word, tags in sentence:
-                    for tag in tags:
-                        if "5b" in tag:
-                            continue
-                        if      (tag[-1].isdigit() or tag in {"Causer", "explicit", "Result"} \
-                                    or tag.startswith("Causer") or tag.startswith("Result") \
-                                    or tag.startswith("explicit") or "->" in tag) \
-                                and not ("Anaphor" in tag or "rhetorical" in tag or "other" in tag):
-                            # if not ("Anaphor" in tag or "rhetorical" in tag or "other" in tag):
-                            un_tags.add(tag)
-                for tag in un_tags:
-                    tag_freq[tag] += 1
-
-        all_tags = list(tag_freq.keys())
-        freq_tags = list(set((tag for tag, freq in tag_freq.items() if freq >= MIN_TAG_FREQ)))
-        non_causal = [t for t in freq_tags if "->" not in t]
-        only_causal = [t for t in freq_tags if "->" in t]
-
-        CAUSE_TAGS = ["Causer", "Result", "explicit"]
-        CAUSAL_REL_TAGS = [CAUSAL_REL, CAUSE_RESULT, RESULT_REL]  # + ["explicit"]
-
-        """ works best with all the pair-wise causal relation codes """
-        # Include all tags for the output
-        self.wd_test_tags = list(set(all_tags + CAUSE_TAGS))
-
-        # tags from tagging model used to train the stacked model
-        self.sent_input_feat_tags = list(set(freq_tags + CAUSE_TAGS))
-        # find interactions between these predicted tags from the word tagger to feed to the sentence tagger
-        self.sent_input_interaction_tags = list(set(non_causal + CAUSE_TAGS))
-        # tags to train (as output) for the sentence based classifier
-        self.sent_output_train_test_tags = list(set(all_tags + CAUSE_TAGS + CAUSAL_REL_TAGS))
+                "raw_essay_tags"    :   raw_essay_tags
+        }
 
     def __is_tag_to_return_(self, tag):
         return tag[0].isdigit() or ("->" in tag and "Causer" in tag)
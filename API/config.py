@@ -8,9 +8,14 @@ class Config(object):
         self.__verify_config_file__(config_file)
         self.__cfg__            = self.__load_config_file__(config_file)
 
-        self.models_folder    = self.__getfilename__("DEFAULT", "models_folder")
-        self.essays_folder    = self.__getfilename__("DEFAULT", "essays_folder")
-        self.spell_check_dict = self.__getfilename__("DEFAULT", "spell_check_dict")
+        # a pre-compiled annotator bundle (see annotator_bundle.py) replaces the other settings
+        self.annotator_bundle = self.__getoptionalfilename__("DEFAULT", "annotator_bundle")
+        if self.annotator_bundle:
+            self.models_folder, self.essays_folder, self.spell_check_dict = None, None, None
+        else:
+            self.models_folder    = self.__getfilename__("DEFAULT", "models_folder")
+            self.essays_folder    = self.__getfilename__("DEFAULT", "essays_folder")
+            self.spell_check_dict = self.__getfilename__("DEFAULT", "spell_check_dict")
 
     def __load_config_file__(self, config_file):
         config = ConfigParser.ConfigParser()
@@ -22,6 +27,11 @@ class Config(object):
         assert os.path.exists(fname), "File\Folder: %s does not exist" % fname
         return fname
 
+    def __getoptionalfilename__(self, section, key):
+        if not self.__cfg__.has_option(section, key) or not self.__cfg__.get(section, key).strip():
+            return None
+        return self.__getfilename__(section, key)
+
     def __getstring__(self, section, key):
         value = self.__cfg__.get(section, key)
         assert (value != None and value.strip() != "")
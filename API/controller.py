@@ -30,6 +30,23 @@ def annotate_essay_text():
     except Exception as e:
         return jsonify({"error": format_exc()})
 
+@app.route('/AnnotateEssays/batch', methods=['POST'])
+def annotate_essay_texts():
+    try:
+        payload = request.get_json(force=True, silent=True) or {}
+        texts = payload.get("texts")
+        if not isinstance(texts, list) or len(texts) == 0:
+            return jsonify({"error": "Expected a JSON body with a non-empty 'texts' list!"})
+
+        # annotate the valid essays in one batch, and report the invalid ones in place
+        valid_ixs = [i for i, text in enumerate(texts) if valid_param(text)]
+        annotations = [{"error": "No essay text entered!"}] * len(texts)
+        for i, annotation in zip(valid_ixs, annotatr.annotate_many([texts[i] for i in valid_ixs])):
+            annotations[i] = annotation
+        return jsonify({"annotations": annotations})
+    except Exception as e:
+        return jsonify({"error": format_exc()})
+
 
 if __name__ == "__main__":
     try:
@@ -3,6 +3,8 @@ Created on Mar 30, 2013
 
 @author: Simon
 '''
+import numpy as np
+from collections import defaultdict
 
 
 def compute_tp_fp_fn(expected, actual, class_value=1):
@@ -30,6 +32,48 @@ def compute_tp_fp_fn(expected, actual, class_value=1):
     
     return (tp, fp, fn)
 
+def compute_tp_fp_tn_fn_by_tag(expected_by_tag, actual_by_tag, class_value=1):
+    """ Counts the true positives, false positives, true negatives and false negatives for many tags at once,
+        with the same semantics as compute_tp_fp_fn. The labels for all tags of the same length are stacked
+        into boolean matrices (rows are data points, columns are tags) and counted in a single pass.
+
+        expected_by_tag :   dict[str, list or np.array]
+        actual_by_tag   :   dict[str, list or np.array]
+                                predictions for each tag. Every tag must be in expected_by_tag
+        class_value     :   value of the positive class
+
+        returns         :   dict[str, (float, float, float, float, int)]
+                                tp, fp, tn, fn and the number of positive (> 0) labels for each tag in
+                                actual_by_tag, skipping tags with no labels
+    """
+    tags_by_len = defaultdict(list)
+    for tag in actual_by_tag.keys():
+        n = len(expected_by_tag[tag])
+        if n > 0:
+            tags_by_len[n].append(tag)
+
+    counts_by_tag = dict()
+    for n, tags in tags_by_len.items():
+        is_positive = np.empty((n, len(tags)), dtype=np.bool_)
+        is_correct  = np.empty((n, len(tags)), dtype=np.bool_)
+        is_code     = np.empty((n, len(tags)), dtype=np.bool_)
+        for col, tag in enumerate(tags):
+            expected, actual = np.asarray(expected_by_tag[tag]), np.asarray(actual_by_tag[tag])
+            if len(actual) != len(expected):
+                raise Exception("Both list must be the same size, actual - %i expected - %i, tag - %s" % (len(actual), len(expected), str(tag)))
+            is_positive[:, col] = expected == class_value
+            is_correct[:, col]  = actual == expected
+            is_code[:, col]     = expected > 0.0
+
+        tp = (is_correct & is_positive).sum(axis=0)
+        fn = is_positive.sum(axis=0) - tp
+        fp = (~(is_correct | is_positive)).sum(axis=0)
+        nc = is_code.sum(axis=0)
+        for col, tag in enumerate(tags):
+            tp_tag, fp_tag, fn_tag = float(tp[col]), float(fp[col]), float(fn[col])
+            counts_by_tag[tag] = (tp_tag, fp_tag, n - (tp_tag + fp_tag + fn_tag), fn_tag, int(nc[col]))
+    return counts_by_tag
+
 def __tally_results_with_indices__(expected, actual, class_value):
     """ Counts the number of true positives, false positives and false negatives,
         AND returns the indices into categories classifications
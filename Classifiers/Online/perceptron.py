@@ -6,6 +6,9 @@ from collections import defaultdict
 import pickle
 import random
 
+import numpy as np
+import scipy.sparse as sp
+
 class AveragedPerceptron(object):
 
     '''An averaged perceptron, as implemented by Matthew Honnibal.
@@ -76,6 +79,17 @@ class AveragedPerceptron(object):
             self.weights[feat] = new_feat_weights
         return None
 
+    def weight_sums(self):
+        '''The sum of each weight over all the instances seen, as a dict-of-dicts (for parameter mixing).'''
+        sums = {}
+        for feat, weights in self.weights.items():
+            feat_sums = {}
+            for clas, weight in weights.items():
+                param = (feat, clas)
+                feat_sums[clas] = self._totals.get(param, 0) + (self.i - self._tstamps.get(param, 0)) * weight
+            sums[feat] = feat_sums
+        return sums
+
     def save(self, path):
         '''Save the pickled model weights.'''
         return pickle.dump(dict(self.weights), open(path, 'w'))
@@ -85,6 +99,246 @@ class AveragedPerceptron(object):
         self.weights = pickle.load(open(path))
         return None
 
+class ArrayAveragedPerceptron(object):
+
+    '''An averaged perceptron with the same interface as AveragedPerceptron, but where the weights,
+    totals and timestamps are stored in dense (n_features, n_classes) arrays rather than nested dicts.
+    Each feature is mapped to a row via feature_index, and each class to a column via class_index.
+
+    decision_function also accepts a CSR matrix (see vectorize), in which case a whole batch is scored
+    with a single sparse matrix product.
+    '''
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, classes = set()):
+        # feature -> row
+        self.feature_index = {}
+        # class -> column, and column -> class
+        self.class_index = {}
+        self.index_class = []
+
+        self.weights  = np.zeros((self.INITIAL_CAPACITY, 0), dtype=np.float32)
+        # The accumulated values, for the averaging
+        self._totals  = np.zeros((self.INITIAL_CAPACITY, 0), dtype=np.float64)
+        # The last time the feature was changed, for the averaging
+        self._tstamps = np.zeros((self.INITIAL_CAPACITY, 0), dtype=np.int64)
+        self._classes = set()
+        self.classes = classes
+        # Number of instances seen
+        self.i = 0
+
+    @property
+    def classes(self):
+        return self._classes
+
+    @classes.setter
+    def classes(self, classes):
+        # kept as is (not copied), as in AveragedPerceptron, so that ties are broken in the same order
+        self._classes = classes if isinstance(classes, set) else set(classes)
+        for c in self._classes:
+            self.__add_class_(c)
+
+    @property
+    def num_features(self):
+        return len(self.feature_index)
+
+    def __resize_(self, rows, cols):
+        def resize(arr):
+            new_arr = np.zeros((rows, cols), dtype=arr.dtype)
+            n_rows, n_cols = min(rows, arr.shape[0]), min(cols, arr.shape[1])
+            new_arr[:n_rows, :n_cols] = arr[:n_rows, :n_cols]
+            return new_arr
+
+        self.weights  = resize(self.weights)
+        self._totals  = resize(self._totals)
+        self._tstamps = resize(self._tstamps)
+
+    def __add_feature_(self, feat):
+        row = len(self.feature_index)
+        if row >= self.weights.shape[0]:
+            self.__resize_(max(self.INITIAL_CAPACITY, 2 * self.weights.shape[0]), self.weights.shape[1])
+        self.feature_index[feat] = row
+        return row
+
+    def __add_class_(self, clas):
+        # as AveragedPerceptron, a truth or guess that isn't one of the classes gets weights, but is never predicted
+        col = self.class_index.get(clas)
+        if col is None:
+            col = self.class_index[clas] = len(self.index_class)
+            self.index_class.append(clas)
+            self.__resize_(self.weights.shape[0], len(self.index_class))
+        return col
+
+    def vectorize(self, lst_features):
+        '''Converts a list of feature dictionaries into a CSR matrix aligned with the weights.
+        Features not seen during training are ignored.'''
+        indptr, indices, data = [0], [], []
+        for features in lst_features:
+            for feat, value in features.items():
+                row = self.feature_index.get(feat)
+                if row is None or value == 0:
+                    continue
+                indices.append(row)
+                data.append(value)
+            indptr.append(len(indices))
+        return sp.csr_matrix((np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int32)),
+                             shape=(len(lst_features), self.num_features))
+
+    def predict(self, features):
+        '''Dot-product the features and current weights and return the best label.'''
+        scores = self.decision_function(features)
+        # Do a secondary alphabetic sort, for stability
+        return max(self.classes, key=lambda label: (scores[label], label))
+
+    def predict_batch(self, X):
+        '''Returns the best label for each row of a CSR matrix (see vectorize).'''
+        scores = self.decision_function(X)
+        cols = [self.class_index[c] for c in self.classes]
+        scores, labels = scores[:, cols], [self.index_class[c] for c in cols]
+
+        maxes = scores.max(axis=1)
+        best = scores.argmax(axis=1)
+        ties = (scores == maxes[:, np.newaxis]).sum(axis=1) > 1
+
+        predictions = [labels[ix] for ix in best]
+        # Do a secondary alphabetic sort, for stability
+        for row in np.where(ties)[0]:
+            predictions[row] = max((labels[ix] for ix in np.where(scores[row] == maxes[row])[0]))
+        return predictions
+
+    def decision_function(self, features):
+        '''Dot-product the features and current weights and return the score for each class.
+        If features is a CSR matrix, returns an array of shape (n_rows, n_classes), where the columns
+        are ordered as in index_class'''
+        if sp.issparse(features):
+            n_feats = min(features.shape[1], self.num_features)
+            return np.asarray(features[:, :n_feats].dot(self.weights[:n_feats]))
+
+        rows, values = [], []
+        for feat, value in features.items():
+            row = self.feature_index.get(feat)
+            if row is None or value == 0:
+                continue
+            rows.append(row)
+            values.append(value)
+
+        scores = defaultdict(float)
+        if rows:
+            class_scores = np.dot(np.asarray(values, dtype=np.float32), self.weights[rows])
+            for label, score in zip(self.index_class, class_scores.tolist()):
+                scores[label] = score
+        return scores
+
+    def update(self, truth, guess, features):
+        '''Update the feature weights.'''
+        self.i += 1
+        if truth == guess:
+            return None
+
+        truth_col, guess_col = self.__add_class_(truth), self.__add_class_(guess)
+        rows = []
+        for f in features:
+            row = self.feature_index.get(f)
+            if row is None:
+                row = self.__add_feature_(f)
+            rows.append(row)
+        rows = np.asarray(rows, dtype=np.int64)
+
+        for col, v in ((truth_col, 1.0), (guess_col, -1.0)):
+            self._totals[rows, col] += (self.i - self._tstamps[rows, col]) * self.weights[rows, col]
+            self._tstamps[rows, col] = self.i
+            self.weights[rows, col] += v
+        return None
+
+    def average_weights(self):
+        '''Average weights from all iterations.'''
+        if self.i == 0:
+            return None
+        n = self.num_features
+        totals = self._totals[:n] + (self.i - self._tstamps[:n]) * self.weights[:n]
+        self.weights[:n] = np.round(totals / float(self.i), 5)
+        return None
+
+    def __getstate__(self):
+        # Don't pickle the unused capacity
+        state = dict(self.__dict__)
+        n = self.num_features
+        state["weights"], state["_totals"], state["_tstamps"] = self.weights[:n], self._totals[:n], self._tstamps[:n]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @staticmethod
+    def from_weights(classes, weights):
+        '''Creates a model from (averaged) weights stored as a dict-of-dicts, as in AveragedPerceptron.'''
+        model = ArrayAveragedPerceptron(classes)
+        for feat, feat_weights in weights.items():
+            row = model.__add_feature_(feat)
+            for clas, weight in feat_weights.items():
+                # add the class first, as it may re-size the weights
+                col = model.__add_class_(clas)
+                model.weights[row, col] = weight
+        return model
+
+    def save(self, path):
+        '''Save the pickled model.'''
+        return pickle.dump(self.__getstate__(), open(path, 'wb'), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        '''Load the pickled model.'''
+        self.__setstate__(pickle.load(open(path, 'rb')))
+        return None
+
+
+class ParameterMixer(object):
+
+    '''Iterative parameter mixing (McDonald, Hall and Mann, 2010) for AveragedPerceptrons. Each epoch, the
+    data is sharded, a perceptron is trained on each shard (in parallel) for one epoch starting from the current
+    mixed weights, and the shard weights are then mixed (averaged) to give the weights for the next epoch.
+
+    The averaging accumulators of the shards are summed over all epochs, so that averaged_weights is the
+    average of the weights over every instance seen by every shard.
+    '''
+
+    def __init__(self):
+        self.weights = {}
+        # sum of each weight over all instances, and the number of instances
+        self._sums = defaultdict(float)
+        self.i = 0
+
+    def shard_model(self, classes):
+        '''A new model starting from the current mixed weights, to train on one shard for one epoch.'''
+        model = AveragedPerceptron(classes)
+        model.weights = dict((feat, dict(weights)) for feat, weights in self.weights.items())
+        return model
+
+    def mix(self, shard_models):
+        '''Uniformly mixes the weights of the models trained on each shard. The shards are processed in order,
+        so the result is deterministic.'''
+        mixed = defaultdict(lambda: defaultdict(float))
+        num_shards = float(len(shard_models))
+        for model in shard_models:
+            for feat, weights in model.weights.items():
+                feat_mixed = mixed[feat]
+                for clas, weight in weights.items():
+                    feat_mixed[clas] += weight / num_shards
+            for feat, sums in model.weight_sums().items():
+                for clas, total in sums.items():
+                    self._sums[(feat, clas)] += total
+            self.i += model.i
+        self.weights = dict((feat, dict(weights)) for feat, weights in mixed.items())
+        return self.weights
+
+    def averaged_weights(self):
+        '''Average weights over all epochs and shards, as AveragedPerceptron.average_weights.'''
+        averaged = {}
+        for (feat, clas), total in self._sums.items():
+            value = round(total / float(max(self.i, 1)), 5)
+            if value:
+                averaged.setdefault(feat, {})[clas] = value
+        return averaged
 
 def train(nr_iter, examples):
     '''Return an averaged perceptron model trained on ``examples`` for
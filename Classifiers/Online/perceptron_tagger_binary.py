@@ -7,7 +7,8 @@ import numpy as np
 import logging
 
 from collections import defaultdict
-from perceptron import AveragedPerceptron
+from joblib import Parallel, delayed, cpu_count
+from perceptron import AveragedPerceptron, ParameterMixer
 from results_procesor import ResultsProcessor
 from Rpfa import weighted_mean_rpfa
 
@@ -87,59 +88,100 @@ class PerceptronTaggerBinary(object):
     def __get_yal_(self, wd, tgt_tag):
         return self.POSITIVE_CLASS if tgt_tag in wd.tags else self.NEGATIVE_CLASS
 
-    def train(self, essay_feats, save_loc=None, nr_iter=5, verbose=True):
+    def train(self, essay_feats, save_loc=None, nr_iter=5, verbose=True, n_jobs=1, seed=0):
         '''Train a model from sentences, and save it at ``save_loc``. ``nr_iter``
         controls the number of Perceptron training iterations.
         :param sentences: A list of (words, tags) tuples.
         :param save_loc: If not ``None``, saves a pickled model in this location.
         :param nr_iter: Number of training iterations.
+        :param n_jobs: If not 1, train in parallel with iterative parameter mixing, over n_jobs shards
+            (-1 for one per cpu). See ParameterMixer.
+        :param seed: Seed for shuffling the essays between iterations, when training in parallel.
         '''
 
         # Copy as we do an inplace shuffle below
         cp_essay_feats = list(essay_feats)
+        if n_jobs != 1:
+            return self.__train_parameter_mixing_(cp_essay_feats, nr_iter, verbose, n_jobs, seed)
 
         for iter_ in range(nr_iter):
-            class2predictions = defaultdict(list)
-            class2tags = defaultdict(list)
-
-            for essay_ix, essay in enumerate(cp_essay_feats):
-                for sent_ix, taggged_sentence in enumerate(essay.sentences):
-                    """ Start Sentence """
-                    class2prev = defaultdict(list)
-                    for cls in self.classes:
-                        class2prev[cls] = list(self.START)
-
-                    for wd in taggged_sentence:
-                        # Don't mutate the feat dictionary
-                        shared_features = dict(wd.features.items())
-                        # get all tagger predictions for previous 2 tags
-                        for cls in self.classes:
-                            self._add_secondary_tag_features(shared_features, wd.word, cls, class2prev[cls])
-                        # train each binary tagger
-                        for cls in self.classes:
-                            tagger_feats = dict(shared_features.items())
-                            # add more in depth features for this tag
-                            self._add_tag_features(tagger_feats, wd.word, class2prev[cls][-1], class2prev[cls][-2])
-                            actual = self.__get_yal_(wd, cls)
-                            model = self.class2model[cls]
-                            guess = model.predict(tagger_feats)
-                            model.update(actual, guess, tagger_feats)
-
-                            class2prev[cls].append(guess)
-
-                            class2predictions[cls].append(guess)
-                            class2tags[cls].append(actual)
-
+            class2predictions, class2tags = self._train_epoch(cp_essay_feats)
             random.shuffle(cp_essay_feats)
-            class2metrics = ResultsProcessor.compute_metrics(class2tags, class2predictions)
-            wtd_mean = weighted_mean_rpfa(class2metrics.values())
-            if verbose:
-                logging.info("Iter {0}: Wtd Mean: {1}".format(iter_, str(wtd_mean)))
+            self.__log_metrics_(iter_, class2tags, class2predictions, verbose)
 
         for cls in self.classes:
             self.class2model[cls].average_weights()
         return None
 
+    def __train_parameter_mixing_(self, essays, nr_iter, verbose, n_jobs, seed):
+        num_shards = n_jobs if n_jobs > 0 else cpu_count()
+        rnd = random.Random(seed)
+        # one mixer per binary model
+        class2mixer = dict((cls, ParameterMixer()) for cls in self.classes)
+        binary_classes = set([self.NEGATIVE_CLASS, self.POSITIVE_CLASS])
+
+        for iter_ in range(nr_iter):
+            shards = [essays[ix::num_shards] for ix in range(num_shards)]
+            results = Parallel(n_jobs=n_jobs)(
+                delayed(_train_shard)(self, dict((cls, mixer.shard_model(binary_classes)) for cls, mixer in class2mixer.items()), shard)
+                for shard in shards if shard)
+
+            class2predictions, class2tags = defaultdict(list), defaultdict(list)
+            for cls, mixer in class2mixer.items():
+                mixer.mix([class2model[cls] for class2model, _, _ in results])
+            for _, shard_predictions, shard_tags in results:
+                for cls in self.classes:
+                    class2predictions[cls].extend(shard_predictions[cls])
+                    class2tags[cls].extend(shard_tags[cls])
+            rnd.shuffle(essays)
+            self.__log_metrics_(iter_, class2tags, class2predictions, verbose)
+
+        for cls, mixer in class2mixer.items():
+            model = AveragedPerceptron(binary_classes)
+            model.weights = mixer.averaged_weights()
+            self.class2model[cls] = model
+        return None
+
+    def __log_metrics_(self, iter_, class2tags, class2predictions, verbose):
+        class2metrics = ResultsProcessor.compute_metrics(class2tags, class2predictions)
+        wtd_mean = weighted_mean_rpfa(class2metrics.values())
+        if verbose:
+            logging.info("Iter {0}: Wtd Mean: {1}".format(iter_, str(wtd_mean)))
+
+    def _train_epoch(self, essays):
+        '''Trains the binary models for one pass over essays. Returns the predictions and tags by class.'''
+        class2predictions = defaultdict(list)
+        class2tags = defaultdict(list)
+
+        for essay_ix, essay in enumerate(essays):
+            for sent_ix, taggged_sentence in enumerate(essay.sentences):
+                """ Start Sentence """
+                class2prev = defaultdict(list)
+                for cls in self.classes:
+                    class2prev[cls] = list(self.START)
+
+                for wd in taggged_sentence:
+                    # Don't mutate the feat dictionary
+                    shared_features = dict(wd.features.items())
+                    # get all tagger predictions for previous 2 tags
+                    for cls in self.classes:
+                        self._add_secondary_tag_features(shared_features, wd.word, cls, class2prev[cls])
+                    # train each binary tagger
+                    for cls in self.classes:
+                        tagger_feats = dict(shared_features.items())
+                        # add more in depth features for this tag
+                        self._add_tag_features(tagger_feats, wd.word, class2prev[cls][-1], class2prev[cls][-2])
+                        actual = self.__get_yal_(wd, cls)
+                        model = self.class2model[cls]
+                        guess = model.predict(tagger_feats)
+                        model.update(actual, guess, tagger_feats)
+
+                        class2prev[cls].append(guess)
+
+                        class2predictions[cls].append(guess)
+                        class2tags[cls].append(actual)
+        return class2predictions, class2tags
+
     def _normalize(self, word):
         '''Normalization used in pre-processing.
         - All words are lower cased
@@ -183,5 +225,11 @@ class PerceptronTaggerBinary(object):
         add('i+2 word', context[i+2])
         return features
 
+def _train_shard(tagger, class2model, essays):
+    """ Trains the binary models on one shard of the essays for one epoch (see PerceptronTaggerBinary.train) """
+    tagger.class2model = class2model
+    class2predictions, class2tags = tagger._train_epoch(essays)
+    return class2model, class2predictions, class2tags
+
 def _pc(n, d):
     return (float(n) / d) * 100
\ No newline at end of file
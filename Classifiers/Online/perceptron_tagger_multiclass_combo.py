@@ -6,7 +6,9 @@ import pickle
 import logging
 
 from collections import defaultdict
-from perceptron import AveragedPerceptron
+from itertools import chain
+from joblib import Parallel, delayed, cpu_count
+from perceptron import AveragedPerceptron, ArrayAveragedPerceptron, ParameterMixer
 from results_procesor import ResultsProcessor
 from Rpfa import weighted_mean_rpfa, micro_rpfa
 import numpy as np
@@ -28,8 +30,13 @@ class PerceptronTaggerMultiClassCombo(object):
     POSITIVE_CLASS = 1.0
     NEGATIVE_CLASS = 0.0
 
-    def __init__(self, individual_tags, tag_history, combo_freq_threshold, load=False, use_tag_features=True):
+    def __init__(self, individual_tags, tag_history, combo_freq_threshold, load=False, use_tag_features=True, array_weights=False):
+        """ array_weights   :   bool
+                                    use the array backed ArrayAveragedPerceptron, which needs far less memory
+                                    on large feature sets than the dict based AveragedPerceptron
+        """
         self.use_tag_features = use_tag_features
+        self.array_weights = array_weights
         self.combo_freq_threshold = combo_freq_threshold
         self.tag_history = tag_history
         self.classes = set()
@@ -51,48 +58,143 @@ class PerceptronTaggerMultiClassCombo(object):
             offset = ix - self.tag_history
             feats["HIST_TAG " + str(offset) + " " + str(prev)] = 1
 
+    """ Tag Features (interned) """
+    def _clear_caches(self):
+        # (previous tags) -> history feature names, and (word, prev, prev2) -> tag feature names
+        self.__history_names_ = dict()
+        self.__tag_names_ = dict()
+
+    def __dynamic_feature_names_(self, word, prev):
+        """ The names of the tag history and tag features of the current token, as two lists. The names
+            are built once for each distinct history (and word), rather than formatted for every token
+        """
+        hist = tuple(prev[-self.tag_history:])
+        hist_names = self.__history_names_.get(hist)
+        if hist_names is None:
+            feats = dict()
+            self._add_secondary_tag_features(feats, prev)
+            hist_names = self.__history_names_[hist] = list(feats.keys())
+
+        if not self.use_tag_features:
+            return hist_names, []
+        key = (word, prev[-1], prev[-2])
+        tag_names = self.__tag_names_.get(key)
+        if tag_names is None:
+            feats = dict()
+            self._add_tag_features(feats, word, prev[-1], prev[-2])
+            tag_names = self.__tag_names_[key] = list(feats.keys())
+        return hist_names, tag_names
+
+    """ Scoring """
+    def __dict_scores_(self, static_features, hist_names, tag_names):
+        """ decision_function for the dict based model, over the token's features plus the tag features
+            (which all have a value of 1), without merging them into a new dictionary """
+        weights = self.model.weights
+        scores = defaultdict(float)
+        for feat, value in static_features.items():
+            if value == 0:
+                continue
+            feat_weights = weights.get(feat)
+            if feat_weights is None:
+                continue
+            for label, weight in feat_weights.items():
+                scores[label] += value * weight
+        for names in (hist_names, tag_names):
+            for feat in names:
+                feat_weights = weights.get(feat)
+                if feat_weights is None:
+                    continue
+                for label, weight in feat_weights.items():
+                    scores[label] += weight
+        return scores
+
+    def __array_candidates_(self):
+        """ Columns of the array model's classes, in the order the classes are iterated in """
+        if self.__candidate_classes_ is not self.model.classes:
+            self.__candidate_classes_ = self.model.classes
+            self.__candidate_labels_ = list(self.model.classes)
+            self.__candidate_cols_ = np.asarray([self.model.class_index[c] for c in self.__candidate_labels_], dtype=np.int64)
+        return self.__candidate_labels_, self.__candidate_cols_
+
+    def __array_best_(self, scores):
+        labels, cols = self.__array_candidates_()
+        cand_scores = scores[cols]
+        best = cand_scores.argmax()
+        tied = np.where(cand_scores == cand_scores[best])[0]
+        if len(tied) == 1:
+            return labels[best]
+        # same tie break as max over (score, label)
+        return _best_label([labels[ix] for ix in tied], defaultdict(float))
+
+    def __array_rows_(self, hist_names, tag_names):
+        feature_index = self.model.feature_index
+        rows = []
+        for names in (hist_names, tag_names):
+            for feat in names:
+                row = feature_index.get(feat)
+                if row is not None:
+                    rows.append(row)
+        return rows
+
     def predict(self, essay_feats, output_scores = False):
         '''Tags a string `corpus`.
             Outputs a dictionary mapping to a list of binary predictions
         '''
+        self._clear_caches()
+        self.__candidate_classes_ = None
+        is_array_model = isinstance(self.model, ArrayAveragedPerceptron)
+        # the weights don't change, so the rows of the tag features are looked up once per (interned) name list
+        row_cache = dict()
+        if is_array_model and output_scores:
+            # columns of the labels containing each tag
+            tag2cols = dict((tag, np.asarray([col for col, label in enumerate(self.model.index_class) if tag in label], dtype=np.int64))
+                            for tag in self.individual_tags)
 
         # Assume untokenized corpus has \n between sentences and ' ' between words
         class2predictions = defaultdict(list)
         for essay_ix, essay in enumerate(essay_feats):
             for sent_ix, taggged_sentence in enumerate(essay.sentences):
                 """ Start Sentence """
-                class2prev = defaultdict(list)
-                for cls in self.classes:
-                    class2prev[cls] = list(self.START)
+                if is_array_model:
+                    # the scores from the token's own features don't depend on the predicted tags, so are computed
+                    # for the whole sentence up front
+                    static_scores = self.model.decision_function(self.model.vectorize([wd.features for wd in taggged_sentence]))
 
                 prev = list(self.START)
                 for i, (wd) in enumerate(taggged_sentence):
-                    # Don't mutate the feat dictionary
-                    shared_features = dict(wd.features.items())
-                    # get all tagger predictions for previous 2 tags
-
-                    self._add_secondary_tag_features(shared_features, prev)
-
-                    tagger_feats = dict(shared_features.items())
-                    if self.use_tag_features:
-                        self._add_tag_features(tagger_feats, wd.word, prev[-1], prev[-2])
-
-                    scores_by_class = self.model.decision_function(tagger_feats)
-                    guess = max(self.model.classes, key=lambda label: (scores_by_class[label], label))
+                    hist_names, tag_names = self.__dynamic_feature_names_(wd.word, prev)
+                    if is_array_model:
+                        key = (id(hist_names), id(tag_names))
+                        rows = row_cache.get(key)
+                        if rows is None:
+                            rows = row_cache[key] = self.__array_rows_(hist_names, tag_names)
+                        scores = static_scores[i]
+                        if rows:
+                            scores = scores + self.model.weights[rows].sum(axis=0)
+                        guess = self.__array_best_(scores)
+                    else:
+                        scores_by_class = self.__dict_scores_(wd.features, hist_names, tag_names)
+                        guess = _best_label(self.model.classes, scores_by_class)
                     prev.append(guess)
 
                     if output_scores:
-                        max_score_per_class = defaultdict(float)
-                        for fset_tags, score in scores_by_class.items():
-                            for tag in fset_tags:
-                                max_score_per_class[tag] = max(max_score_per_class[tag], score)
-
-                        for cls in self.individual_tags:
-                            class2predictions[cls].append(max_score_per_class[cls])
+                        if is_array_model:
+                            for cls in self.individual_tags:
+                                cols = tag2cols[cls]
+                                class2predictions[cls].append(max(0.0, float(scores[cols].max())) if len(cols) else 0.0)
+                        else:
+                            max_score_per_class = defaultdict(float)
+                            for fset_tags, score in scores_by_class.items():
+                                for tag in fset_tags:
+                                    max_score_per_class[tag] = max(max_score_per_class[tag], score)
+
+                            for cls in self.individual_tags:
+                                class2predictions[cls].append(max_score_per_class[cls])
                     else:
                         for cls in self.individual_tags:
                             class2predictions[cls].append(1 if cls in guess else 0)
 
+        self._clear_caches()
         np_class2predictions = dict()
         for key, lst in class2predictions.items():
             np_class2predictions[key] = np.asarray(lst)
@@ -107,12 +209,15 @@ class PerceptronTaggerMultiClassCombo(object):
     def __get_tags_(self, tags):
         return frozenset((t for t in tags if t in self.individual_tags))
 
-    def train(self, essay_feats, save_loc=None, nr_iter=5, verbose=True):
+    def train(self, essay_feats, save_loc=None, nr_iter=5, verbose=True, n_jobs=1, seed=0):
         '''Train a model from sentences, and save it at ``save_loc``. ``nr_iter``
         controls the number of Perceptron training iterations.
         :param sentences: A list of (words, tags) tuples.
         :param save_loc: If not ``None``, saves a pickled model in this location.
         :param nr_iter: Number of training iterations.
+        :param n_jobs: If not 1, train in parallel with iterative parameter mixing, over n_jobs shards
+            (-1 for one per cpu). See ParameterMixer.
+        :param seed: Seed for shuffling the essays between iterations, when training in parallel.
         '''
 
         cp_essay_feats = list(essay_feats)
@@ -127,46 +232,117 @@ class PerceptronTaggerMultiClassCombo(object):
 
 
         self.classes = set([ fs for fs, cnt in tag_freq.items() if cnt >= self.combo_freq_threshold])
-        self.model = AveragedPerceptron(self.classes)
+        if n_jobs != 1:
+            return self.__train_parameter_mixing_(cp_essay_feats, nr_iter, verbose, n_jobs, seed)
+
+        if self.array_weights:
+            self.model = ArrayAveragedPerceptron(self.classes)
+        else:
+            self.model = AveragedPerceptron(self.classes)
+
+        self._clear_caches()
+        self.__candidate_classes_ = None
+        row_of_id = None
+        if isinstance(self.model, ArrayAveragedPerceptron):
+            interned, feature_ids = _intern_static_features(cp_essay_feats)
+            # model row of each interned feature, -1 until the model first updates it
+            row_of_id = np.zeros(len(feature_ids), dtype=np.int64) - 1
+        else:
+            interned = [None] * len(cp_essay_feats)
+        # shuffled together (random.shuffle's permutation only depends on the length)
+        cp_essay_feats = list(zip(cp_essay_feats, interned))
 
         for iter_ in range(nr_iter):
-            class2predictions = defaultdict(list)
-            class2tags = defaultdict(list)
+            class2predictions, class2tags = self._train_epoch(cp_essay_feats, row_of_id)
+            random.shuffle(cp_essay_feats)
+            self.__log_metrics_(iter_, class2tags, class2predictions, verbose)
 
-            for essay_ix, essay in enumerate(cp_essay_feats):
-                for sent_ix, taggged_sentence in enumerate(essay.sentences):
-                    """ Start Sentence """
-                    prev = list(self.START)
+        self._clear_caches()
+        self.model.average_weights()
+        return None
 
-                    for i, (wd) in enumerate(taggged_sentence):
-                        # Don't mutate the feat dictionary
-                        shared_features = dict(wd.features.items())
-                        # get all tagger predictions for previous 2 tags
-                        self._add_secondary_tag_features(shared_features, prev)
+    def __train_parameter_mixing_(self, essays, nr_iter, verbose, n_jobs, seed):
+        num_shards = n_jobs if n_jobs > 0 else cpu_count()
+        rnd = random.Random(seed)
+        mixer = ParameterMixer()
+        self.model = None
+        self._clear_caches()
 
-                        tagger_feats = dict(shared_features.items())
-                        # add more in depth features for this tag
-                        actual = self.__get_tags_(wd.tags)
+        for iter_ in range(nr_iter):
+            shards = [essays[ix::num_shards] for ix in range(num_shards)]
+            results = Parallel(n_jobs=n_jobs)(
+                delayed(_train_shard)(self, mixer.shard_model(self.classes), shard) for shard in shards if shard)
+
+            mixer.mix([model for model, _, _ in results])
+            class2predictions, class2tags = defaultdict(list), defaultdict(list)
+            for _, shard_predictions, shard_tags in results:
+                for cls in self.individual_tags:
+                    class2predictions[cls].extend(shard_predictions[cls])
+                    class2tags[cls].extend(shard_tags[cls])
+            rnd.shuffle(essays)
+            self.__log_metrics_(iter_, class2tags, class2predictions, verbose)
+
+        self._clear_caches()
+        averaged = mixer.averaged_weights()
+        if self.array_weights:
+            self.model = ArrayAveragedPerceptron.from_weights(self.classes, averaged)
+        else:
+            self.model = AveragedPerceptron(self.classes)
+            self.model.weights = averaged
+        return None
 
-                        if self.use_tag_features:
-                            self._add_tag_features(tagger_feats, wd.word, prev[-1], prev[-2])
+    def __log_metrics_(self, iter_, class2tags, class2predictions, verbose):
+        class2metrics = ResultsProcessor.compute_metrics(class2tags, class2predictions)
+        micro_metrics = micro_rpfa(class2metrics.values())
+        if verbose:
+            logging.info("Iter {0}: Micro Avg Metrics: {1}".format(iter_, str(micro_metrics)))
 
-                        guess = self.model.predict(tagger_feats)
-                        self.model.update(actual, guess, tagger_feats)
+    def _train_epoch(self, essays, row_of_id=None):
+        '''Trains self.model for one pass over essays, a list of (essay, interned features) pairs (the
+        interned features are only needed for the array based model, see _intern_static_features).
+        Returns the predictions and tags by class.'''
+        class2predictions = defaultdict(list)
+        class2tags = defaultdict(list)
+        is_array_model = isinstance(self.model, ArrayAveragedPerceptron)
 
-                        prev.append(guess)
-                        for cls in self.individual_tags:
-                            class2predictions[cls].append(  1 if cls in guess  else 0 )
-                            class2tags[cls].append(         1 if cls in actual else 0)
+        for essay_ix, (essay, essay_interned) in enumerate(essays):
+            for sent_ix, taggged_sentence in enumerate(essay.sentences):
+                """ Start Sentence """
+                prev = list(self.START)
 
-            random.shuffle(cp_essay_feats)
-            class2metrics = ResultsProcessor.compute_metrics(class2tags, class2predictions)
-            micro_metrics = micro_rpfa(class2metrics.values())
-            if verbose:
-                logging.info("Iter {0}: Micro Avg Metrics: {1}".format(iter_, str(micro_metrics)))
+                for i, (wd) in enumerate(taggged_sentence):
+                    # the tag features are added to the scores (and updates) separately, rather than
+                    # merged into a copy of the feature dictionary
+                    hist_names, tag_names = self.__dynamic_feature_names_(wd.word, prev)
+                    actual = self.__get_tags_(wd.tags)
+
+                    if is_array_model:
+                        ids, values = essay_interned[sent_ix][i]
+                        rows = row_of_id[ids]
+                        known = rows >= 0
+                        weights = self.model.weights
+                        if known.all():
+                            scores = values.dot(weights[rows])
+                        else:
+                            scores = values[known].dot(weights[rows[known]])
+                        dynamic_rows = self.__array_rows_(hist_names, tag_names)
+                        if dynamic_rows:
+                            scores = scores + weights[dynamic_rows].sum(axis=0)
+                        guess = self.__array_best_(scores)
+                    else:
+                        guess = _best_label(self.model.classes, self.__dict_scores_(wd.features, hist_names, tag_names))
 
-        self.model.average_weights()
-        return None
+                    self.model.update(actual, guess, chain(wd.features, hist_names, tag_names))
+                    if is_array_model and actual != guess and not known.all():
+                        # the update adds any new features to the model
+                        feature_index = self.model.feature_index
+                        row_of_id[ids] = [feature_index[f] for f in wd.features]
+
+                    prev.append(guess)
+                    for cls in self.individual_tags:
+                        class2predictions[cls].append(  1 if cls in guess  else 0 )
+                        class2tags[cls].append(         1 if cls in actual else 0)
+        return class2predictions, class2tags
 
     def _normalize(self, word):
         '''Normalization used in pre-processing.
@@ -211,5 +387,42 @@ class PerceptronTaggerMultiClassCombo(object):
         add('i+2 word', context[i+2])
         return features
 
+def _train_shard(tagger, model, essays):
+    """ Trains model on one shard of the essays for one epoch (see PerceptronTaggerMultiClassCombo.train) """
+    tagger.model = model
+    tagger._clear_caches()
+    class2predictions, class2tags = tagger._train_epoch([(essay, None) for essay in essays])
+    return model, class2predictions, class2tags
+
+def _best_label(classes, scores):
+    """ Same as max(classes, key=lambda label: (scores[label], label)), without the key tuples """
+    best, best_score = None, None
+    for label in classes:
+        score = scores.get(label, 0.0)
+        if best_score is None or score > best_score or (score == best_score and label > best):
+            best, best_score = label, score
+    return best
+
+def _intern_static_features(essays):
+    """ Maps the features of every token to integer ids, once for the corpus
+
+    Returns
+    -------
+    (interned, feature_ids) : for each essay, sentence and word, an (ids, values) pair of arrays, ordered as
+    the word's feature dictionary, and the dictionary of feature -> id
+    """
+    feature_ids = dict()
+    interned = []
+    for essay in essays:
+        essay_interned = []
+        for taggged_sentence in essay.sentences:
+            sent_interned = []
+            for wd in taggged_sentence:
+                ids = [feature_ids.setdefault(f, len(feature_ids)) for f in wd.features]
+                sent_interned.append((np.asarray(ids, dtype=np.int64), np.asarray(list(wd.features.values()), dtype=np.float32)))
+            essay_interned.append(sent_interned)
+        interned.append(essay_interned)
+    return interned, feature_ids
+
 def _pc(n, d):
     return (float(n) / d) * 100
\ No newline at end of file
@@ -0,0 +1,109 @@
+import random
+import unittest
+
+import numpy as np
+
+from perceptron import AveragedPerceptron, ArrayAveragedPerceptron
+from perceptron_tagger_multiclass_combo import PerceptronTaggerMultiClassCombo
+
+TAGS = ["50", "Causer", "Result", "explicit", "7"]
+
+class Word(object):
+    def __init__(self, word, features, tags):
+        self.word = word
+        self.features = features
+        self.tags = tags
+
+class Essay(object):
+    def __init__(self, sentences):
+        self.sentences = sentences
+
+def build_essays(num_essays, seed=0):
+    """ Random essays where each word's tags depend on its features, plus a few infrequent tag combinations
+        (below the tagger's combo_freq_threshold), which the taggers see in training but should never predict
+    """
+    rnd = random.Random(seed)
+    vocab = ["w%i" % i for i in range(40)]
+    essays = []
+    for _ in range(num_essays):
+        sentences = []
+        for _ in range(rnd.randint(1, 4)):
+            sentence = []
+            for _ in range(rnd.randint(2, 8)):
+                word = rnd.choice(vocab)
+                features = {"word=" + word: 1, "prior": 1, "len": len(word) / 3.0}
+                ix = vocab.index(word)
+                if rnd.random() < 0.03:
+                    tags = set(rnd.sample(TAGS, 3))
+                else:
+                    tags = set([TAGS[ix % len(TAGS)]]) if ix % 3 else set()
+                sentence.append(Word(word, features, tags))
+            sentences.append(sentence)
+        essays.append(Essay(sentences))
+    return essays
+
+def train_tagger(essays, array_weights, n_jobs=1):
+    random.seed(0)
+    tagger = PerceptronTaggerMultiClassCombo(TAGS, tag_history=2, combo_freq_threshold=5, array_weights=array_weights)
+    tagger.train(essays, nr_iter=3, verbose=False, n_jobs=n_jobs)
+    return tagger
+
+class TestCase(unittest.TestCase):
+
+    def testArrayModelOnlyPredictsClasses(self):
+        model = ArrayAveragedPerceptron(set(["a", "b"]))
+        for _ in range(3):
+            model.update("c", "a", {"x": 1})
+        self.assertEqual(model.classes, set(["a", "b"]))
+        self.assertIn("c", model.class_index)
+        self.assertEqual(model.predict({"x": 1}), "b")
+        self.assertEqual(model.predict_batch(model.vectorize([{"x": 1}])), ["b"])
+
+    def testArrayModelMatchesDictModel(self):
+        rnd = random.Random(1)
+        classes = set(["a", "b", "c"])
+        dict_model, array_model = AveragedPerceptron(set(classes)), ArrayAveragedPerceptron(set(classes))
+        examples = []
+        for _ in range(300):
+            features = dict(("f%i" % rnd.randint(0, 20), 1) for _ in range(4))
+            # "d" is never predicted, but is trained on
+            examples.append((features, rnd.choice(["a", "b", "c", "d"])))
+        for features, truth in examples:
+            dict_guess, array_guess = dict_model.predict(features), array_model.predict(features)
+            self.assertEqual(dict_guess, array_guess)
+            dict_model.update(truth, dict_guess, features)
+            array_model.update(truth, array_guess, features)
+        dict_model.average_weights()
+        array_model.average_weights()
+
+        self.assertEqual(array_model.classes, classes)
+        dict_predictions = [dict_model.predict(features) for features, _ in examples]
+        self.assertEqual(dict_predictions, [array_model.predict(features) for features, _ in examples])
+        self.assertEqual(dict_predictions, array_model.predict_batch(array_model.vectorize([f for f, _ in examples])))
+
+    def testArrayTaggerMatchesDictTagger(self):
+        essays = build_essays(30)
+        dict_tagger, array_tagger = train_tagger(essays, False), train_tagger(essays, True)
+
+        self.assertEqual(array_tagger.model.classes, dict_tagger.model.classes)
+        dict_predictions, array_predictions = dict_tagger.predict(essays), array_tagger.predict(essays)
+        for tag in TAGS:
+            self.assertEqual(list(dict_predictions[tag]), list(array_predictions[tag]))
+
+        dict_scores, array_scores = dict_tagger.decision_function(essays), array_tagger.decision_function(essays)
+        for tag in TAGS:
+            self.assertTrue(np.allclose(dict_scores[tag], array_scores[tag], atol=1e-4))
+
+    def testArrayTaggerTrainsInParallel(self):
+        essays = build_essays(30)
+        dict_tagger, array_tagger = train_tagger(essays, False, n_jobs=2), train_tagger(essays, True, n_jobs=2)
+
+        self.assertEqual(array_tagger.model.classes, dict_tagger.model.classes)
+        # the mixed weights include labels that aren't classes (the infrequent combos)
+        self.assertGreater(len(array_tagger.model.index_class), len(array_tagger.model.classes))
+        dict_predictions, array_predictions = dict_tagger.predict(essays), array_tagger.predict(essays)
+        for tag in TAGS:
+            self.assertEqual(list(dict_predictions[tag]), list(array_predictions[tag]))
+
+if __name__ == "__main__":
+    unittest.main()
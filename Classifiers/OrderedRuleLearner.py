@@ -29,6 +29,112 @@ class Rule(object):
     def __repr__(self):
         return "[{0}] -> {1}\t. Accuracy: {2}, Coverage: {3}\n".format(self.class_matched, self.words, self.accuracy, self.coverage)
 
+class OrderedMatchIndex(object):
+    """
+    Evaluates Rule.matches over a list of examples at once. The examples' words are laid out in one flat
+    array, each example followed by an end slot, with the (sorted) flat positions of each word.
+
+    Rule.matches consumes the rule's words from the front, one for each sentence word that is any of the
+    words not yet consumed, so the k'th word is consumed at the first occurrence (after the previous one) of
+    any of words[k:]. For a seed rule, the next such occurrence from every flat position is tabulated for each
+    step (see seed_tables), so a rule with one word inserted into the seed is matched with one lookup per step
+    in these tables (and the new word's positions), for every example at once.
+    """
+    def __init__(self, examples):
+        """
+        Parameters
+        ----------
+        examples : list[(list[str], str)]
+            (words, sentence) tuples, as in OrderedRuleLearner.fit
+        """
+        lengths = np.asarray([len(wds) for wds, _ in examples], dtype=np.int64)
+        # flat position of each example's first word, and of its end slot
+        self.ends = np.cumsum(lengths + 1) - 1
+        self.starts = self.ends - lengths
+        self.size = int(self.ends[-1]) + 1 if len(examples) > 0 else 0
+
+        positions = defaultdict(list)
+        for (wds, _), start in izip(examples, self.starts.tolist()):
+            for i, wd in enumerate(wds):
+                positions[wd].append(start + i)
+        self.positions = dict((wd, np.asarray(pos, dtype=np.int64)) for wd, pos in positions.items())
+
+    def __next_of_word_(self, word, current):
+        """ Per example, the first flat position >= current of word, else the example's end slot """
+        positions = self.positions.get(word)
+        if positions is None:
+            return self.ends
+        found = positions[np.minimum(np.searchsorted(positions, current), len(positions) - 1)]
+        return np.where((found >= current) & (found < self.ends), found, self.ends)
+
+    def __step_(self, consumed):
+        # continue after the consumed word. The end slot (nothing consumed) is absorbing
+        return np.where(consumed < self.ends, consumed + 1, self.ends)
+
+    def matches(self, words):
+        """
+        Returns
+        -------
+        np.array : bool[n_examples], whether Rule(..., words, ...) matches each example
+        """
+        if len(words) == 0:
+            return self.ends > self.starts
+
+        current = self.starts
+        for k in range(len(words)):
+            consumed = self.ends
+            for wd in set(words[k:]):
+                consumed = np.minimum(consumed, self.__next_of_word_(wd, current))
+            current = self.__step_(consumed)
+        return consumed < self.ends
+
+    def seed_tables(self, seed):
+        """
+        Returns
+        -------
+        list[np.array] : for each step k of the seed, int[size], the first flat position at or after each
+            flat position (in the same example) of any of seed[k:], else the example's end slot
+        """
+        tables = [None] * len(seed)
+        marked = np.empty(self.size, dtype=np.int64)
+        marked.fill(self.size)
+        marked[self.ends] = self.ends
+        for k in range(len(seed) - 1, -1, -1):
+            positions = self.positions.get(seed[k])
+            if positions is not None:
+                marked[positions] = positions
+            # the end slots stop the (reversed) running minimum at the example boundaries
+            tables[k] = np.minimum.accumulate(marked[::-1])[::-1]
+        return tables
+
+    def extension_matches(self, seed, tables, insertion_point, word):
+        """
+        Parameters
+        ----------
+        seed : list[str]
+        tables : list[np.array]
+            seed_tables(seed)
+        insertion_point : int
+            0 to len(seed)
+        word : str
+
+        Returns
+        -------
+        np.array : bool[n_examples], whether seed[:insertion_point] + [word] + seed[insertion_point:] matches
+            each example
+        """
+        current = self.starts
+        for k in range(len(seed) + 1):
+            if k <= insertion_point:
+                # the words not yet consumed are seed[k:] and word
+                consumed = self.__next_of_word_(word, current)
+                if k < len(seed):
+                    consumed = np.minimum(consumed, tables[k][current])
+            else:
+                consumed = tables[k - 1][current]
+            current = self.__step_(consumed)
+        return consumed < self.ends
+
 class OrderedRuleLearner(object):
 
     def __init__(self):
@@ -39,15 +145,15 @@ class OrderedRuleLearner(object):
         self.rules = []
 
     """ private """
-    def __create_rule__(self, words, all_examples, all_labels):
+    def __create_rule__(self, words, all_examples, all_labels, all_index):
         coverage = 0.0
         correct = 0.0
 
-        tmp_rule = Rule(-1, -1, words, -9999)
+        matched = all_index.matches(words)
         pos_cnt = 0
         neg_cnt = 0
-        for (wds, sentence), label in izip(all_examples, all_labels):
-            if tmp_rule.matches(wds):
+        for is_match, label in izip(matched, all_labels):
+            if is_match:
                 if label == self.positive_val:
                     coverage += 1.0
                     correct += 1.0
@@ -63,17 +169,16 @@ class OrderedRuleLearner(object):
         matched_class = self.positive_val if pos_cnt > neg_cnt else self.NEGATIVE_VAL
         return Rule(accuracy, coverage / cnt, words, matched_class)
 
-    def __eval__(self, pattern_words, examples, labels):
+    def __eval__(self, matched, labels):
+        """ matched : np.array of bool, whether the pattern matches each example """
 
         matches = []
         tally = defaultdict(int)
-        r = Rule(-1,-1, pattern_words, -99999)
-
-        for (sent_wds, sentence), label in izip(examples, labels):
 
-            if r.matches(sent_wds):
-                matches.append(label)
-                tally[label] += 1
+        for ix in np.flatnonzero(matched).tolist():
+            label = labels[ix]
+            matches.append(label)
+            tally[label] += 1
 
         # Do some smoothing. This handles both the zero matches case and the
         # 0 entropy case (either no matches - bad, or all are the same - very good)
@@ -84,16 +189,20 @@ class OrderedRuleLearner(object):
         return lbl_cnt / entropy(matches)
         #return 1.0 / entropy(matches)
 
-    def __get_best_rules__(self, new_rules, examples, labels):
+    def __get_best_rules__(self, seed, extensions, index, labels):
+        """ extensions : list of (insertion_point, word), see __generate_new_rules__ """
         best = []
         best_val = -1
-        for r in new_rules:
-            val = self.__eval__(r, examples, labels)
+        tables = index.seed_tables(seed)
+        labels = list(labels)
+        for ext in extensions:
+            insertion_point, wd = ext
+            val = self.__eval__(index.extension_matches(seed, tables, insertion_point, wd), labels)
             if val > best_val:
-                best = [r]
+                best = [ext]
                 best_val = val
             elif val == best_val:
-                best.append(r)
+                best.append(ext)
         return (best, best_val)
 
     def __get_candidate_terms__(self, examples, min_freq=0.05):
@@ -117,6 +226,7 @@ class OrderedRuleLearner(object):
         return (b4_map, after_map)
 
     def __generate_new_rules__(self, seed, b4_map, after_map):
+        """ The rules one word longer than the seed, as (insertion_point, word) extensions of it """
 
         new_rules = []
         for insertion_point in range(len(seed) + 1):
@@ -130,11 +240,10 @@ class OrderedRuleLearner(object):
                 candidates = b4_map[wd].intersection(after_map[wd])
 
             for c in candidates:
-                new_rule = seed[:insertion_point] + [c] + seed[insertion_point:]
-                new_rules.append(new_rule)
+                new_rules.append((insertion_point, c))
         return new_rules
 
-    def __get_next_rule__(self, uncovered_examples, uncovered_labels, all_examples, all_labels):
+    def __get_next_rule__(self, uncovered_examples, uncovered_labels, uncovered_index, all_examples, all_labels, all_index):
         positive_examples = self.__get_positive_examples__(uncovered_examples, uncovered_labels)
         if len(positive_examples) == 0:
             return None
@@ -145,26 +254,27 @@ class OrderedRuleLearner(object):
 
         while True:
             if len(best_pattern) == 0:
-                new_rules = [[term] for term in self.__get_candidate_terms__(positive_examples)]
+                new_rules = [(0, term) for term in self.__get_candidate_terms__(positive_examples)]
             else:
                 new_rules = self.__generate_new_rules__(best_pattern, b4_map, after_map)
                 if len(new_rules) == 0:
                     break
 
-            best_rules, val = self.__get_best_rules__(new_rules, uncovered_examples, uncovered_labels)
+            best_rules, val = self.__get_best_rules__(best_pattern, new_rules, uncovered_index, uncovered_labels)
 
             if len(best_rules) == 1:
-                new_best_rule = best_rules[0]
+                insertion_point, wd = best_rules[0]
             else:
                 # multiple best rules. Pick the best on the entire dataset
-                best_overall_rules, _ = self.__get_best_rules__(best_rules, all_examples, all_labels)
-                new_best_rule = best_overall_rules[0]
+                best_overall_rules, _ = self.__get_best_rules__(best_pattern, best_rules, all_index, all_labels)
+                insertion_point, wd = best_overall_rules[0]
+            new_best_rule = best_pattern[:insertion_point] + [wd] + best_pattern[insertion_point:]
 
             # Stop when no improvement
             if val <= best_val:
                 break
             best_pattern, best_val = new_best_rule, val
-        return self.__create_rule__(best_pattern, all_examples, all_labels)
+        return self.__create_rule__(best_pattern, all_examples, all_labels, all_index)
 
 
     def __get_positive_examples__(self, examples, labels):
@@ -179,10 +289,13 @@ class OrderedRuleLearner(object):
     def __get_positive_ys__(self, ys):
         return np.array([y for y in ys if self.__positive_test__(y)]).flatten()
 
-    def __get_unmatched_sentences__(self, uncovered_examples, uncovered_labels):
+    def __get_unmatched_sentences__(self, uncovered_examples, uncovered_labels, uncovered_index):
+        matched = np.zeros(len(uncovered_examples), dtype=bool)
+        for r in self.rules:
+            matched |= uncovered_index.matches(r.words)
         return list(izip(* [(  (words, sentence), label   )
-                for (words, sentence), label in izip(uncovered_examples, uncovered_labels)
-                if not self.__matches_any_rule__(words)]))
+                for (words, sentence), label, is_match in izip(uncovered_examples, uncovered_labels, matched)
+                if not is_match]))
 
     def __matches_any_rule__(self, sent_wds):
         return any(r for r in self.rules if r.matches(sent_wds))
@@ -203,15 +316,17 @@ class OrderedRuleLearner(object):
         all_examples = [(words, " ".join(words)) for words in xs[:]]
         uncovered_examples = all_examples[:]
         uncovered_labels = ys[:]
+        all_index = OrderedMatchIndex(all_examples)
 
         """ A list of tuples (accuracy, coverage, pattern) """
         self.rules = []
         while True:
-            next_rule = self.__get_next_rule__(uncovered_examples, uncovered_labels, all_examples, ys)
+            uncovered_index = OrderedMatchIndex(uncovered_examples)
+            next_rule = self.__get_next_rule__(uncovered_examples, uncovered_labels, uncovered_index, all_examples, ys, all_index)
             if next_rule == None:
                 break
             self.rules.append(next_rule)
-            tpl = self.__get_unmatched_sentences__(uncovered_examples, uncovered_labels)
+            tpl = self.__get_unmatched_sentences__(uncovered_examples, uncovered_labels, uncovered_index)
             if len(tpl) == 0:
                 break
             uncovered_examples, uncovered_labels = tpl
@@ -4,6 +4,7 @@ from itertools import imap, izip
 from Metrics import recall, precision, f1_score, rpf1
 from DocumentFrequency import compute_document_frequency
 from Rule import Rule, DisjointRule, PositiveNotNegativeRule
+from RuleMatchIndex import RuleMatchIndex
 
 class RegExLearner(object):
     def __init__(self, rule_score_fn, global_score_fn, min_pct_coverage):
@@ -22,10 +23,12 @@ class RegExLearner(object):
     def __above_doc_freq__(self, doc_freq, minimum):
         return set(k for k, v in doc_freq.items() if v >= minimum)
 
-    def __add_negative_rules__(self, pos_comp_rule, current_best_global_score, xs, ys):
+    def __add_negative_rules__(self, pos_matched, current_best_global_score, xs, ys):
 
         print("Adding new negative rules")
         neg_rules = []
+        # ids of the docs matched by any of the neg_rules
+        neg_matched = set()
         best_global_score = current_best_global_score
 
         # include both sets of tokens to build negative rules
@@ -43,6 +46,7 @@ class RegExLearner(object):
 
             improved_local_score = True
             # Grow rule while each iteration improves on the previous (adding to the length)
+            # (rule, ids of the docs it matches)
             candidates = []
             """ Grow new rule """
             while improved_local_score:
@@ -50,36 +54,38 @@ class RegExLearner(object):
                 previous_best_pattern = current_best_pattern[:]
 
                 insertion_indices = range(len(previous_best_pattern) + 1)
+                frontier = self.match_index.frontier(previous_best_pattern)
                 for token in tokens:
                     for insertion_index in insertion_indices:
                         new_pattern = previous_best_pattern[:insertion_index] + [token] + previous_best_pattern[insertion_index:]
 
-                        new_rule = Rule(new_pattern)
-                        neg_predictions = self.__predict_labels_from_rule__(new_rule, xs)
+                        matched = self.match_index.extension_matches(frontier, token, insertion_index)
+                        neg_predictions = self.__predict_labels_from_matches__(matched, len(xs))
                         new_rule_score = self.rule_score_fn(neg_ys, neg_predictions)
 
                         if new_rule_score > best_rule_score:
                             current_best_pattern = new_pattern
                             best_rule_score = new_rule_score
                             improved_local_score = True
-                            candidates.append(new_rule)
+                            candidates.append((Rule(new_pattern), matched))
 
-            best_new_rule = None
+            best_new_rule, best_new_matched = None, None
             tmp_best_global = best_global_score
             # Did we improve global score?
-            for candidate in candidates:
-                tmp_negative_rules = neg_rules + [candidate]
-                new_combo_rule = PositiveNotNegativeRule(pos_comp_rule, DisjointRule(tmp_negative_rules))
-                predictions = self.__predict_labels_from_rule__(new_combo_rule, xs)
+            for candidate, candidate_matched in candidates:
+                # PositiveNotNegativeRule(positive rules, DisjointRule(neg_rules + [candidate]))
+                combo_matched = pos_matched - neg_matched - candidate_matched
+                predictions = self.__predict_labels_from_matches__(combo_matched, len(xs))
                 new_global_score = self.global_score_fn(ys, predictions)
 
                 if new_global_score > tmp_best_global:
                     tmp_best_global = new_global_score
                     # has to improve the global score to be considered
-                    best_new_rule = candidate
+                    best_new_rule, best_new_matched = candidate, candidate_matched
 
             if best_new_rule is not None:
                 neg_rules.append(best_new_rule)
+                neg_matched = neg_matched | best_new_matched
                 best_global_score = tmp_best_global
                 print "New best global score (from adding negative rules: ", str(round(best_global_score, 4)), "for", best_new_rule
             else:
@@ -95,28 +101,26 @@ class RegExLearner(object):
 
     def __build_rules__(self, xs, ys):
         self.positive_rules = []
+        self.match_index = RuleMatchIndex(xs)
 
-        instances = zip(xs, ys)
-
-        work_list = instances[:]
+        # ids of the instances not matched by the rules so far
+        work_list = range(len(xs))
         tokens = self.positive_tokens.copy()
 
-        composite_pos_rule = None
+        # ids of the docs matched by any of the positive rules
+        composite_pos_matched = set()
         max_global_score = float('-inf')
 
         print("Iteratively adding rules")
         while len(work_list) > self.min_positive_rules_covered:
-            next_rule, work_list, tokens = self.__get_next_rule__(tokens, work_list)
+            next_rule, work_list, tokens = self.__get_next_rule__(tokens, work_list, ys)
             if next_rule is None:
                 print "Quitting iterative rule growth: failed to generate a new rule that matched sufficient examples"
                 break
 
-            #Compute score from global score
-            tmp_rules = self.positive_rules[:]
-            tmp_rules.append(next_rule)
-
-            new_composite_rule = DisjointRule(tmp_rules)
-            predictions = self.__predict_labels_from_rule__(new_composite_rule, xs)
+            #Compute score from global score (DisjointRule(self.positive_rules + [next_rule]))
+            new_composite_matched = composite_pos_matched | self.match_index.matches(next_rule.tokens)
+            predictions = self.__predict_labels_from_matches__(new_composite_matched, len(xs))
             score = self.global_score_fn(ys, predictions)
 
             if score <= max_global_score:
@@ -126,50 +130,46 @@ class RegExLearner(object):
             max_global_score = score
             # Only add a rule if it improves the global score
             self.positive_rules.append(next_rule)
-            composite_pos_rule = new_composite_rule
+            composite_pos_matched = new_composite_matched
 
         #self.__improve_global_score__(xs, ys, max_global_score)
-        self.negative_rules = self.__add_negative_rules__(composite_pos_rule, max_global_score, xs, ys)
+        self.negative_rules = self.__add_negative_rules__(composite_pos_matched, max_global_score, xs, ys)
 
         #matched_docs, matched_labels, unmatched_docs, unmatched_labels \
         #   = self.__partition_by_regex_classification__(composite_pos_rule, xs, ys)
 
         pass
 
-    def __get_next_rule__(self, tokens, instances):
+    def __get_next_rule__(self, tokens, instance_ids, all_ys):
 
         best_pattern = []
         best_match_count = -1
 
         best_score = float('-inf')
-        un_matched_instances = []
+        best_matched = set()
 
-        _, ys = zip(*instances)
+        ys = [all_ys[ix] for ix in instance_ids]
 
         improved = True
         while improved:
             improved = False
             current_best_pattern = best_pattern[:]
             insertion_indices = range(len(current_best_pattern) + 1)
+            # the instances matched by each extension of best_pattern are found from its match frontier
+            frontier = self.match_index.frontier(best_pattern, instance_ids)
 
             for token in tokens:
                 for insertion_index in insertion_indices:
                     new_pattern = best_pattern[:insertion_index] + [token] + best_pattern[insertion_index:]
 
-                    new_rule = Rule(new_pattern)
-                    un_matched = []
-                    predictions = []
-                    match_count = 0
-                    for x, y in instances:
-                        if new_rule.matches(x):
-                            match_count += 1
-                            predictions.append(self.positive_label)
-                        else:
-                            predictions.append(0)
-                            un_matched.append((x, y))
+                    matched = self.match_index.extension_matches(frontier, token, insertion_index)
+                    match_count = len(matched)
+                    if match_count < self.min_positive_rules_covered:
+                        continue
 
+                    predictions = [self.positive_label if ix in matched else 0 for ix in instance_ids]
                     score = self.rule_score_fn(ys, predictions)
-                    if score >= best_score and match_count >= self.min_positive_rules_covered:
+                    if score >= best_score:
 
                         # If tied, always prefer ones that match more instances
                         if score == best_score and match_count <= best_match_count:
@@ -180,7 +180,7 @@ class RegExLearner(object):
 
                         best_score = score
                         improved = True
-                        un_matched_instances = un_matched
+                        best_matched = matched
                     pass # End for
                 pass # End for
             best_pattern = current_best_pattern
@@ -195,11 +195,13 @@ class RegExLearner(object):
                                                                                     best_match_count)
 
         """ Compute remaining tokens """
+        un_matched_ids = [ix for ix in instance_ids if ix not in best_matched]
+        un_matched_instances = [(self.match_index.docs[ix], all_ys[ix]) for ix in un_matched_ids]
         un_matched_positives, un_matched_negatives = self.__partition_by_class__(un_matched_instances)
         positive_doc_freq = compute_document_frequency(un_matched_positives)
         remaining_tokens = self.__above_doc_freq__(positive_doc_freq, self.min_positive_rules_covered)
 
-        return best_rule, un_matched_instances, remaining_tokens
+        return best_rule, un_matched_ids, remaining_tokens
 
     def __improve_global_score__(self, xs, ys, current_score):
 
@@ -257,6 +259,9 @@ class RegExLearner(object):
                 unmatched_labels.append(y)
         return matched_docs, matched_labels, unmatched_docs, unmatched_labels
 
+    def __predict_labels_from_matches__(self, matched, num_docs):
+        return [self.positive_label if ix in matched else 0 for ix in range(num_docs)]
+
     def __predict_labels_from_rule__(self, rule, xs):
         predictions = map(lambda x: self.positive_label if rule.matches(x) else 0, xs)
         return predictions
@@ -439,4 +444,4 @@ test_learner_on_data()
 
             => (global|earth|planet's) temperatures (rise|risen|increase)
             The resulting 'merged' rule is more general and will meet more cases
-"""
\ No newline at end of file
+"""
\ No newline at end of file
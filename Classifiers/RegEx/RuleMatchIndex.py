@@ -0,0 +1,220 @@
+"""
+Evaluates Rule patterns over a fixed set of documents from an inverted index, rather than by regex matching.
+
+A Rule's regex (Rule.START + Rule.MID.join(tokens) + Rule.END, matched from the start of " ".join(doc))
+matches a document when its tokens occur in order, each as a whole word except the last, which only has to
+start a word. The words before the first token and between tokens are skipped by Rule.WC, so they have to be
+all [a-z0-9]: any other word is a barrier that no part of the pattern can skip over. For literal tokens the
+earliest occurrence of each token is always the best choice, so a pattern is matched greedily, one posting
+list at a time. Tokens that are not literal (they contain regex syntax) and documents whose words the regex
+would not see as single words are evaluated with the Rule regex, so the results are always those of Rule.matches.
+"""
+__author__ = 'simon.hughes'
+
+import re
+from bisect import bisect_left, bisect_right
+
+from Rule import Rule
+
+# a word the Rule.WC wildcard can skip over
+__SKIPPABLE__ = re.compile(r"[a-z0-9]+\Z")
+__REGEX_CHARS__ = set(".^$*+?{}[]\\|()")
+
+def is_literal(token):
+    """ Does the token match (as a regex) only the string itself? """
+    return len(token) > 0 and not any(c in __REGEX_CHARS__ or c.isspace() for c in token)
+
+def __is_single_word__(word):
+    return len(word) > 0 and not any(c.isspace() for c in word)
+
+class PatternFrontier(object):
+    """ The per document match state of a pattern, from which the pattern with one more token inserted
+        (at any index) is evaluated. See RuleMatchIndex.frontier
+    """
+    def __init__(self, pattern, doc_ids, prefix_ends, suffix_starts):
+        self.pattern = pattern
+        self.doc_ids = doc_ids
+        # prefix_ends[j] : doc id -> position of the (earliest) match of pattern[:j], all whole words
+        self.prefix_ends = prefix_ends
+        # suffix_starts[j] : doc id -> sorted positions where a match of pattern[j:] can start
+        self.suffix_starts = suffix_starts
+
+class RuleMatchIndex(object):
+    def __init__(self, docs):
+        """
+        Parameters
+        ----------
+        docs : list[list[str]]
+            the tokenized documents, as passed to Rule.matches. Documents are identified by their index
+        """
+        self.docs = docs
+        # word -> {doc id : sorted positions}
+        self.postings = {}
+        # doc id -> sorted positions of the words Rule.WC can't skip
+        self.barriers = {}
+        # documents the regex has to evaluate (words with white space, or empty words)
+        self.regex_docs = set()
+
+        for doc_id, doc in enumerate(docs):
+            if not all(__is_single_word__(wd) for wd in doc):
+                self.regex_docs.add(doc_id)
+                continue
+            self.barriers[doc_id] = [i for i, wd in enumerate(doc) if not __SKIPPABLE__.match(wd)]
+            for i, wd in enumerate(doc):
+                self.postings.setdefault(wd, {}).setdefault(doc_id, []).append(i)
+
+        self.vocab = sorted(self.postings.keys())
+        self.__prefix_postings_ = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __next_barrier_(self, doc_id, position):
+        """ The position of the first barrier after position (or the document length if none) """
+        barriers = self.barriers[doc_id]
+        ix = bisect_right(barriers, position)
+        return barriers[ix] if ix < len(barriers) else len(self.docs[doc_id])
+
+    def __token_postings_(self, token, prefix):
+        if not prefix:
+            return self.postings.get(token, {})
+        # the last token of a pattern only has to start a word
+        postings = self.__prefix_postings_.get(token)
+        if postings is None:
+            postings = {}
+            for ix in range(bisect_left(self.vocab, token), len(self.vocab)):
+                wd = self.vocab[ix]
+                if not wd.startswith(token):
+                    break
+                for doc_id, positions in self.postings[wd].items():
+                    postings.setdefault(doc_id, []).extend(positions)
+            for positions in postings.values():
+                positions.sort()
+            self.__prefix_postings_[token] = postings
+        return postings
+
+    def __advance_(self, ends, token, prefix):
+        """ Extends the matches ending at ends (doc id -> position) by token, taking its first occurrence
+            after each match that isn't past a barrier
+        """
+        postings = self.__token_postings_(token, prefix)
+        new_ends = {}
+        if len(postings) < len(ends):
+            pairs = ((doc_id, ends.get(doc_id), positions) for doc_id, positions in postings.items())
+        else:
+            pairs = ((doc_id, end, postings.get(doc_id)) for doc_id, end in ends.items())
+        for doc_id, end, positions in pairs:
+            if end is None or positions is None:
+                continue
+            ix = bisect_right(positions, end)
+            if ix < len(positions) and positions[ix] <= self.__next_barrier_(doc_id, end):
+                new_ends[doc_id] = positions[ix]
+        return new_ends
+
+    def __starts_within_(self, doc_id, starts, position):
+        """ Does any of starts follow position, with no barrier in between? """
+        ix = bisect_right(starts, position)
+        return ix < len(starts) and starts[ix] <= self.__next_barrier_(doc_id, position)
+
+    def __regex_matches_(self, pattern, doc_ids):
+        rule = Rule(pattern)
+        return set(doc_id for doc_id in doc_ids if rule.matches(self.docs[doc_id]))
+
+    def __all_ids_(self, doc_ids):
+        return range(len(self.docs)) if doc_ids is None else doc_ids
+
+    def matches(self, pattern, doc_ids=None):
+        """
+        Parameters
+        ----------
+        pattern : list[str]
+            the tokens of a Rule
+        doc_ids : list[int] (optional)
+            the documents to match, defaults to all of them
+
+        Returns
+        -------
+        set[int] : the ids of the documents Rule(pattern) matches
+        """
+        doc_ids = self.__all_ids_(doc_ids)
+        if not all(is_literal(token) for token in pattern):
+            return self.__regex_matches_(pattern, doc_ids)
+
+        ends = dict((doc_id, -1) for doc_id in doc_ids if doc_id not in self.regex_docs)
+        for i, token in enumerate(pattern):
+            ends = self.__advance_(ends, token, prefix=(i == len(pattern) - 1))
+        matched = set(ends.keys())
+        matched.update(self.__regex_matches_(pattern, [doc_id for doc_id in doc_ids if doc_id in self.regex_docs]))
+        return matched
+
+    def frontier(self, pattern, doc_ids=None):
+        """
+        Parameters
+        ----------
+        pattern : list[str]
+            the tokens of the pattern being grown
+        doc_ids : list[int] (optional)
+            the documents to match, defaults to all of them
+
+        Returns
+        -------
+        PatternFrontier : for evaluating one token extensions of the pattern (see extension_matches)
+        """
+        doc_ids = list(self.__all_ids_(doc_ids))
+        if not all(is_literal(token) for token in pattern):
+            # every extension is evaluated by the regex
+            return PatternFrontier(pattern, doc_ids, None, None)
+
+        prefix_ends = [dict((doc_id, -1) for doc_id in doc_ids if doc_id not in self.regex_docs)]
+        for token in pattern:
+            prefix_ends.append(self.__advance_(prefix_ends[-1], token, prefix=False))
+
+        suffix_starts = [None] * (len(pattern) + 1)
+        if len(pattern) > 0:
+            in_scope = prefix_ends[0]
+            last = self.__token_postings_(pattern[-1], prefix=True)
+            suffix_starts[-2] = dict((doc_id, positions) for doc_id, positions in last.items() if doc_id in in_scope)
+            for j in range(len(pattern) - 2, -1, -1):
+                later_starts = suffix_starts[j + 1]
+                starts = {}
+                for doc_id, positions in self.__token_postings_(pattern[j], prefix=False).items():
+                    later = later_starts.get(doc_id)
+                    if later is None:
+                        continue
+                    valid = [p for p in positions if self.__starts_within_(doc_id, later, p)]
+                    if valid:
+                        starts[doc_id] = valid
+                suffix_starts[j] = starts
+        return PatternFrontier(pattern, doc_ids, prefix_ends, suffix_starts)
+
+    def extension_matches(self, frontier, token, insertion_index):
+        """
+        Parameters
+        ----------
+        frontier : PatternFrontier
+            from frontier(pattern, doc_ids)
+        token : str
+        insertion_index : int
+            0 to len(pattern)
+
+        Returns
+        -------
+        set[int] : the ids of the documents (of those in the frontier) matched by
+            Rule(pattern[:insertion_index] + [token] + pattern[insertion_index:])
+        """
+        pattern = frontier.pattern
+        new_pattern = pattern[:insertion_index] + [token] + pattern[insertion_index:]
+        if frontier.prefix_ends is None or not is_literal(token):
+            return self.__regex_matches_(new_pattern, frontier.doc_ids)
+
+        is_last = insertion_index == len(pattern)
+        ends = self.__advance_(frontier.prefix_ends[insertion_index], token, prefix=is_last)
+        if is_last:
+            matched = set(ends.keys())
+        else:
+            starts = frontier.suffix_starts[insertion_index]
+            matched = set(doc_id for doc_id, end in ends.items()
+                          if doc_id in starts and self.__starts_within_(doc_id, starts[doc_id], end))
+        if self.regex_docs:
+            matched.update(self.__regex_matches_(new_pattern, [doc_id for doc_id in frontier.doc_ids if doc_id in self.regex_docs]))
+        return matched
@@ -0,0 +1,198 @@
+__author__ = 'simon.hughes'
+
+import numpy as np
+
+# log probability of events not seen in training (as for nltk's MLE estimate)
+NEG_INF = -np.inf
+# max number of (sentence, state, state) cells scored at once in Viterbi, bounds the memory used by a batch
+MAX_BATCH_CELLS = 2 ** 22
+
+def __log_normalize__(counts, smoothing):
+    """ Row-wise (Lidstone) smoothed log probabilities of a count matrix. Rows with no counts (and
+        no smoothing) are all NEG_INF
+    """
+    counts = counts + smoothing
+    totals = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_probs = np.log(counts) - np.log(totals)
+    log_probs[~np.isfinite(log_probs)] = NEG_INF
+    return log_probs
+
+class HMMTagger(object):
+    """
+    First order hidden markov model tagger, with the start, transition and emission probabilities held as
+    log probability matrices over integer encoded states (tags) and symbols (words). Sentences are decoded in
+    batches by a vectorized Viterbi. A drop in replacement for the tagger returned by nltk's
+    HiddenMarkovModelTrainer.train_supervised (see HMMTrainer), taking and returning sentences in the formats
+    of nltk_datahelper.
+    """
+    def __init__(self, states, symbols, log_start, log_trans, log_emit):
+        """
+        Parameters
+        ----------
+        states : list[str]
+            the tags
+        symbols : list[str]
+            the words seen in training
+        log_start : np.array
+            float[n_states], log probability of starting a sentence in each state
+        log_trans : np.array
+            float[n_states, n_states], log probability of moving from each state (row) to each state (column)
+        log_emit : np.array
+            float[n_symbols + 1, n_states], log probability of each state emitting each symbol. The last row
+            is for words not seen in training
+        """
+        self.states = states
+        self.symbols = symbols
+        self.symbol_ix = dict((sym, ix) for ix, sym in enumerate(symbols))
+        self.log_start = log_start
+        self.log_trans = log_trans
+        self.log_emit = log_emit
+
+    def __encode_(self, sentence):
+        unknown = len(self.symbols)
+        return [self.symbol_ix.get(wd, unknown) for wd in sentence]
+
+    def tag(self, sentence):
+        """
+        Parameters
+        ----------
+        sentence : list[str]
+
+        Returns
+        -------
+        list[(str, str)] : the tagged sentence, as (word, tag) tuples
+        """
+        return self.tag_sents([sentence])[0]
+
+    def tag_sents(self, sentences, batch_size=None):
+        """
+        Parameters
+        ----------
+        sentences : list[list[str]]
+            e.g. from nltk_datahelper.to_sentences
+        batch_size : int (optional)
+            number of sentences decoded at once. Defaults to as many as fit in MAX_BATCH_CELLS
+
+        Returns
+        -------
+        list[list[(str, str)]] : the tagged sentences, as lists of (word, tag) tuples
+        """
+        sentences = list(sentences)
+        n_states = len(self.states)
+        if batch_size is None:
+            batch_size = max(1, MAX_BATCH_CELLS // (n_states * n_states))
+
+        encoded = [self.__encode_(sentence) for sentence in sentences]
+        # batch sentences of similar length together, to minimize padding
+        order = sorted(range(len(sentences)), key=lambda ix: len(encoded[ix]))
+        paths = [None] * len(sentences)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            for ix, path in zip(batch, self.__viterbi_([encoded[ix] for ix in batch])):
+                paths[ix] = path
+
+        tagged = []
+        for sentence, path in zip(sentences, paths):
+            tagged.append([(wd, self.states[state]) for wd, state in zip(sentence, path)])
+        return tagged
+
+    def __viterbi_(self, encoded):
+        """ Viterbi decoding of a batch of encoded sentences, padded to the longest
+
+        Returns
+        -------
+        list[list[int]] : the most likely state sequence of each sentence
+        """
+        lengths = np.asarray([len(symbols) for symbols in encoded], dtype=np.int64)
+        n_sents, max_len = len(encoded), int(lengths.max()) if len(encoded) else 0
+        if max_len == 0:
+            return [[] for _ in encoded]
+
+        # padding positions are never read, as a finished sentence's scores are frozen
+        symbols = np.zeros((n_sents, max_len), dtype=np.int64)
+        for row, sent_symbols in enumerate(encoded):
+            symbols[row, :len(sent_symbols)] = sent_symbols
+
+        n_states = len(self.states)
+        back_pointers = np.zeros((n_sents, max_len, n_states), dtype=np.int32)
+        scores = self.log_start[np.newaxis, :] + self.log_emit[symbols[:, 0]]
+        for t in range(1, max_len):
+            # [sentence, from state, to state]
+            candidates = scores[:, :, np.newaxis] + self.log_trans[np.newaxis, :, :]
+            back_pointers[:, t] = candidates.argmax(axis=1)
+            new_scores = candidates.max(axis=1) + self.log_emit[symbols[:, t]]
+            active = (t < lengths)[:, np.newaxis]
+            scores = np.where(active, new_scores, scores)
+
+        rows = np.arange(n_sents)
+        paths = np.zeros((n_sents, max_len), dtype=np.int64)
+        current = scores.argmax(axis=1)
+        for t in range(max_len - 1, -1, -1):
+            active = t < lengths
+            paths[active, t] = current[active]
+            if t > 0:
+                current = np.where(active, back_pointers[rows, t, current], current)
+        return [paths[row, :length].tolist() for row, length in enumerate(lengths.tolist())]
+
+class HMMTrainer(object):
+    """ Supervised training of an HMMTagger, in place of nltk.tag.hmm.HiddenMarkovModelTrainer """
+    def __init__(self, smoothing=0.0):
+        """
+        Parameters
+        ----------
+        smoothing : float
+            Lidstone smoothing (added to every count). The default, 0.0, is the maximum likelihood
+            estimate, as nltk's train_supervised
+        """
+        self.smoothing = smoothing
+
+    def train_supervised(self, labelled_sequences):
+        """
+        Parameters
+        ----------
+        labelled_sequences : list[list[(str, str)]]
+            tagged sentences, as lists of (word, tag) tuples (e.g. from nltk_datahelper)
+
+        Returns
+        -------
+        HMMTagger
+        """
+        states, state_ix = [], {}
+        symbols, symbol_ix = [], {}
+        first_states, prev_states, next_states, emit_states, emit_symbols = [], [], [], [], []
+
+        for sentence in labelled_sequences:
+            prev = None
+            for wd, tag in sentence:
+                six = state_ix.get(tag)
+                if six is None:
+                    six = state_ix[tag] = len(states)
+                    states.append(tag)
+                wix = symbol_ix.get(wd)
+                if wix is None:
+                    wix = symbol_ix[wd] = len(symbols)
+                    symbols.append(wd)
+                if prev is None:
+                    first_states.append(six)
+                else:
+                    prev_states.append(prev)
+                    next_states.append(six)
+                emit_states.append(six)
+                emit_symbols.append(wix)
+                prev = six
+
+        n_states, n_symbols = len(states), len(symbols)
+        start_counts = np.bincount(np.asarray(first_states, dtype=np.int64), minlength=n_states).astype(np.float64)
+        trans_counts = np.bincount(np.asarray(prev_states, dtype=np.int64) * n_states + np.asarray(next_states, dtype=np.int64),
+                                   minlength=n_states * n_states).astype(np.float64).reshape((n_states, n_states))
+        # an extra (never seen) symbol column for unknown words
+        emit_counts = np.bincount(np.asarray(emit_states, dtype=np.int64) * (n_symbols + 1) + np.asarray(emit_symbols, dtype=np.int64),
+                                  minlength=n_states * (n_symbols + 1)).astype(np.float64).reshape((n_states, n_symbols + 1))
+
+        log_emit = __log_normalize__(emit_counts, self.smoothing)
+        return HMMTagger(states, symbols,
+                         log_start=__log_normalize__(start_counts, self.smoothing),
+                         log_trans=__log_normalize__(trans_counts, self.smoothing),
+                         # symbol major, so that the emissions of a sentence's words are a row gather
+                         log_emit=np.ascontiguousarray(log_emit.T))
@@ -1,6 +1,11 @@
 import os
+import logging
+from traceback import format_exc
+
+from joblib import Parallel, delayed
 
 from FindFiles import find_files
+from artifact_cache import ArtifactCache
 import Settings
 
 from collections import defaultdict
@@ -206,7 +211,8 @@ class NoteAnnotation(AnnotationBase):
 
 class Essay(object):
 
-    def __init__(self, full_path, include_vague = True, include_normal = True, load_annotations = True, essay_text = None):
+    def __init__(self, full_path, include_vague = True, include_normal = True, load_annotations = True, essay_text = None, txt = None):
+        """ txt : str (optional) - contents of the essay's .txt file, if it has already been read """
 
         self.include_normal = include_normal
         self.include_vague = include_vague
@@ -215,8 +221,10 @@ class Essay(object):
             self.full_path = full_path
             self.file_name = full_path.split("/")[-1]
             txt_file = full_path[:-4] + ".txt"
-            with open(txt_file, "r+") as f:
-                self.txt = f.read()
+            if txt is None:
+                with open(txt_file, "r+") as f:
+                    txt = f.read()
+            self.txt = txt
         else:
             if load_annotations:
                 raise Exception("Can't load annotations when pasing in essay as text string")
@@ -537,9 +545,80 @@ class Essay(object):
         #if len(self.tagged_sentences) > 60:
         #    raise Exception("Too many sentences (%s) in essay %s" % (str(len(self.sentence_tags)), self.file_name))
 
-def load_bratt_essays(directory = None, include_vague = True, include_normal = True, load_annotations = True):
-    import warnings
-
+# bump this when the parsing code above changes, to invalidate the cached essays
+BRATT_ESSAY_CACHE_VERSION = 1
+MAX_ESSAY_SENTENCES = 60
+
+def __file_signature_(fname):
+    st = os.stat(fname)
+    return fname, st.st_mtime, st.st_size
+
+def load_bratt_essay(f, include_vague = True, include_normal = True, load_annotations = True, cache_folder = None):
+    """
+    Loads a single essay. Runs in the worker processes of load_bratt_essays
+
+    Parameters
+    ----------
+    f : str
+        path of the .ann file (or the .txt file if not loading annotations)
+    cache_folder : str (optional)
+        folder to cache the parsed essays in. Essays are re-parsed when the path, modified time or size
+        of their .ann or .txt file changes
+
+    Returns
+    -------
+    (Essay, str) : the essay, or None if the essay was skipped, and the reason it was skipped
+    """
+    txt_file = f[:-4] + ".txt"
+
+    cache, key = None, None
+    if cache_folder is not None:
+        cache = ArtifactCache(os.path.join(cache_folder, "bratt_essay_"), version=BRATT_ESSAY_CACHE_VERSION)
+        key = cache.key(__file_signature_(f), __file_signature_(txt_file), include_vague, include_normal, load_annotations)
+        found, result = cache.get(key)
+        if found:
+            return result
+
+    with open(txt_file) as fin:
+        txt = fin.read()
+
+    contents = txt.strip().lower()
+    if "no essay" in contents[:20] or "no text" in contents[0:20]:
+        result = (None, "Skipping %s file as .txt file is %s'" % (f, contents))
+    else:
+        essay = Essay(f, include_vague=include_vague, include_normal=include_normal, load_annotations=load_annotations, txt=txt)
+        if len(essay.tagged_sentences) > MAX_ESSAY_SENTENCES:
+            result = (None, "Too many sentences (%s) in essay %s" % (str(len(essay.sentence_tags)), essay.file_name))
+        else:
+            result = (essay, None)
+
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+def __try_load_bratt_essay_(f, include_vague, include_normal, load_annotations, cache_folder):
+    # errors are returned rather than raised, so one bad file doesn't stop the other essays loading
+    try:
+        return load_bratt_essay(f, include_vague, include_normal, load_annotations, cache_folder), None
+    except Exception:
+        return (None, None), format_exc()
+
+def load_bratt_essays(directory = None, include_vague = True, include_normal = True, load_annotations = True,
+                      n_jobs = 1, cache_folder = None):
+    """
+    Loads the essays in the folder, in file name order
+
+    Parameters
+    ----------
+    n_jobs : int
+        number of processes to parse the essays with (-1 to use all cores)
+    cache_folder : str (optional)
+        folder to cache the parsed essays in, see load_bratt_essay
+
+    Returns
+    -------
+    list[Essay]
+    """
     bratt_root_folder = directory
     if not bratt_root_folder:
         settings = Settings.Settings()
@@ -550,31 +629,23 @@ def load_bratt_essays(directory = None, include_vague = True, include_normal = T
         files = find_files(bratt_root_folder, "\.ann$", remove_empty=True)
     else:
         files = find_files(bratt_root_folder, "\.txt$", remove_empty=True)
-    print(len(files), "files found")
+    logging.info("%i files found" % len(files))
+
+    # Parallel returns the results in the order of files, which find_files sorts
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(__try_load_bratt_essay_)(f, include_vague, include_normal, load_annotations, cache_folder)
+        for f in files)
 
     essays = []
-    for f in files:
-        try:
-            txt_file = f[:-4] + ".txt"
-            with open(txt_file) as fin:
-                contents = fin.read().strip().lower()
-                if "no essay" in contents[:20] or "no text" in contents[0:20]:
-                    print("Skipping %s file as .txt file is %s'" % (f, contents))
-                    continue
+    for f, ((essay, skip_reason), error) in zip(files, results):
+        if error is not None:
+            logging.error("Error processing file: %s\n%s" % (f, error))
+        elif essay is None:
+            logging.warning(skip_reason)
+        else:
+            essays.append(essay)
 
-            essay = Essay(f, include_vague=include_vague, include_normal=include_normal, load_annotations=load_annotations)
-            if len(essay.tagged_sentences) > 60:
-                warnings.warn("Too many sentences (%s) in essay %s" % (str(len(essay.sentence_tags)), essay.file_name))
-                print("Too many sentences (%s) in essay %s" % (str(len(essay.sentence_tags)), essay.file_name))
-            else:
-                essays.append(essay)
-        except Exception as ex:
-            from traceback import format_exc
-            print(format_exc())
-            print("Error processing file: ", f)
-            pass
-
-    print("%s essays processed" % str(len(essays)))
+    logging.info("%s essays processed" % str(len(essays)))
     return essays
 
 
@@ -1,5 +1,16 @@
-import re, collections
+import re, collections, zlib
+from array import array
 from collections import defaultdict
+import numpy as np
+
+# maximum edit distance covered by the symmetric delete index (same as known_edits2)
+MAX_EDIT_DISTANCE = 2
+
+def __variant_keys__(keys):
+    """ Converts an array of (signed) crc32 hashes of deletion variants to the index keys. Variants that collide
+        only add candidates, which are checked against the edits of the word anyway
+    """
+    return (np.frombuffer(keys, dtype=np.dtype(keys.typecode)) & 0xffffffff).astype(np.uint32)
 
 class SpellingCorrector(object):
 
@@ -38,6 +49,11 @@ class SpellingCorrector(object):
         #add apostrophe
         self.alphabet = "abcdefghijklmnopqrstuvwxyz'"
         self.memoize = {}
+
+        # symmetric delete index, see build_index
+        self.index_words = None
+        self.index_keys = None
+        self.index_word_ids = None
     
     def extract_words(self, text):
         return re.findall('[a-z]+', text.lower()) 
@@ -87,8 +103,78 @@ class SpellingCorrector(object):
         return correction
 
     def __correct__(self, word):
-        candidates = self.known([word]) or self.known(self.edits1(word)) or self.known_edits2(word) or [word]
-        return max(candidates, key=self.nwords.get)
+        if word in self.nwords:
+            return word
+        if self.index_keys is None:
+            candidates = self.known(self.edits1(word)) or self.known_edits2(word)
+            return self.__most_frequent_(candidates) if candidates else word
+        e1 = self.edits1(word)
+        candidates = self.__lookup_(word)
+        # same candidates, in the same order of preference, as known(edits1) then known_edits2
+        known_edits1 = [c for c in candidates if c in e1]
+        if known_edits1:
+            return self.__most_frequent_(known_edits1)
+        known_edits2 = [c for c in candidates if not e1.isdisjoint(self.inverse_edits1(c, word))]
+        if known_edits2:
+            return self.__most_frequent_(known_edits2)
+        return word
+
+    def __most_frequent_(self, candidates):
+        # break ties on the word itself, so the correction doesn't depend on set ordering
+        return max(candidates, key=lambda c: (self.nwords[c], c))
+
+    def inverse_edits1(self, word, source):
+        """ All strings that edits1 maps to word. source is the word being corrected, whose characters
+            (along with the alphabet) are the only ones an edit of it can contain
+        """
+        chars      = set(self.alphabet) | set(source)
+        splits     = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+        # undo a delete, insert, transpose and replace respectively
+        inserts    = [a + c + b     for a, b in splits for c in chars]
+        deletes    = [a + b[1:]     for a, b in splits if b and b[0] in self.alphabet]
+        transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b)>1]
+        replaces   = [a + c + b[1:] for a, b in splits for c in chars if b and b[0] in self.alphabet]
+        return set(inserts + deletes + transposes + replaces)
+
+    # SYMMETRIC DELETE INDEX
+    #   Maps every string formed by deleting up to MAX_EDIT_DISTANCE characters from a dictionary word to that
+    #   word. A word within MAX_EDIT_DISTANCE edits of a dictionary word shares at least one such deletion with
+    #   it, so the candidates for a word are found with a few lookups instead of generating all of its edits.
+    #   The candidates are then filtered to those edits1 or known_edits2 would produce.
+    def deletes(self, word, max_distance=MAX_EDIT_DISTANCE):
+        variants, frontier = set([word]), set([word])
+        for _ in range(max_distance):
+            frontier = set(w[:i] + w[i+1:] for w in frontier for i in range(len(w)))
+            variants |= frontier
+        return variants
+
+    def build_index(self):
+        """ Builds the symmetric delete index, which is pickled along with the corrector. Until it is built,
+            corrections fall back to known_edits2
+
+            The index is stored as the sorted hashes of the deletion variants, with the (index_words) id of the
+            dictionary word each came from, rather than as a dictionary of strings, to keep it small
+        """
+        words = sorted(self.nwords.keys())
+        keys, num_variants = array("l"), array("l")
+        for word in words:
+            variants = self.deletes(word)
+            keys.extend(map(zlib.crc32, variants))
+            num_variants.append(len(variants))
+        keys = __variant_keys__(keys)
+        order = np.argsort(keys, kind="mergesort")
+
+        self.index_words = words
+        self.index_keys = keys[order]
+        self.index_word_ids = np.repeat(np.arange(len(words), dtype=np.int32), num_variants)[order]
+
+    def __lookup_(self, word):
+        variants = [v.encode("utf-8") if isinstance(v, unicode) else v for v in self.deletes(word)]
+        keys = __variant_keys__(array("l", map(zlib.crc32, variants)))
+        starts = np.searchsorted(self.index_keys, keys, side="left")
+        ends = np.searchsorted(self.index_keys, keys, side="right")
+        word_ids = np.unique(np.concatenate([self.index_word_ids[start:end] for start, end in zip(starts, ends)]))
+        return set(self.index_words[word_id] for word_id in word_ids)
 
 if __name__ == "__main__":
     sc = SpellingCorrector()
@@ -0,0 +1,139 @@
+__author__ = 'simon.hughes'
+
+import logging
+
+from nltk.tag.crf import CRFTagger
+import pycrfsuite
+
+from artifact_cache import ArtifactCache, function_name
+
+class SentenceFeatureStore(object):
+    """
+    The token features of every sentence in a corpus, as computed by a CRF feature function (see
+    nltk_featureextractionfunctions.fact_composite_feature_extractor), extracted once and looked up by
+    sentence id. This means the features (including the parse based ones) are shared by every fold and
+    hyper parameter setting, rather than re-extracted for each model trained and for each call to tag_sents.
+
+    Sentences are identified by their tokens, so the same sentence under different label projections
+    (binary, most common tag, label powerset) maps to the same id.
+    """
+    def __init__(self, feature_fn, sentences=()):
+        """
+        Parameters
+        ----------
+        feature_fn : function(tokens, idx) -> list[str]
+            the CRF feature function
+        sentences : list[list[str]]
+            the sentence tokens to extract the features for
+        """
+        self.feature_fn = feature_fn
+        self.feature_fn_name = function_name(feature_fn)
+        # sentence id -> list of features per token
+        self.features = []
+        # tuple(tokens) -> sentence id
+        self.sentence_ids = {}
+        # the last tokens looked up by feature_func, as it is called for every index of the same sentence
+        self.__last_tokens_, self.__last_id_ = None, None
+        self.add_sentences(sentences)
+
+    def add_sentences(self, sentences):
+        """ Extracts the features of any new sentences, returning the id of each sentence """
+        ids = []
+        for tokens in sentences:
+            key = tuple(tokens)
+            sent_id = self.sentence_ids.get(key)
+            if sent_id is None:
+                if self.feature_fn is None:
+                    raise KeyError("Sentence not in the feature store, and the store has no feature function: %s" % " ".join(key))
+                sent_id = len(self.features)
+                self.features.append([self.feature_fn(key, idx) for idx in range(len(key))])
+                self.sentence_ids[key] = sent_id
+            ids.append(sent_id)
+        return ids
+
+    def sentence_id(self, tokens):
+        return self.add_sentences([tokens])[0]
+
+    def sentence_features(self, sent_id):
+        return self.features[sent_id]
+
+    def feature_func(self, tokens, idx):
+        """ Drop in replacement for the feature function, e.g. for CRFTagger(feature_func=...) """
+        if tokens is not self.__last_tokens_:
+            self.__last_id_ = self.sentence_id(tokens)
+            self.__last_tokens_ = tokens
+        return self.features[self.__last_id_][idx]
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getstate__(self):
+        # feature functions are closures, which can't be pickled. Unpickled stores only serve the stored sentences
+        state = self.__dict__.copy()
+        state["feature_fn"] = None
+        state["_SentenceFeatureStore__last_tokens_"], state["_SentenceFeatureStore__last_id_"] = None, None
+        return state
+
+class FeatureStoreCRFTagger(CRFTagger):
+    """ CRFTagger that takes the features of each sentence from a SentenceFeatureStore by sentence id,
+        rather than calling the feature function for every token
+    """
+    def __init__(self, feature_store, verbose=False, training_opt={}):
+        CRFTagger.__init__(self, feature_func=feature_store.feature_func, verbose=verbose, training_opt=training_opt)
+        self.feature_store = feature_store
+
+    def train(self, train_data, model_file):
+        trainer = pycrfsuite.Trainer(verbose=self._verbose)
+        trainer.set_params(self._training_options)
+        for sent in train_data:
+            tokens, labels = zip(*sent)
+            trainer.append(self.feature_store.sentence_features(self.feature_store.sentence_id(tokens)), labels)
+        trainer.train(model_file)
+        self.set_model_file(model_file)
+
+    def tag_sents(self, sents):
+        if self._model_file == '':
+            raise Exception(' No model file is found !! Please use train or set_model_file function')
+        result = []
+        for tokens, sent_id in zip(sents, self.feature_store.add_sentences(sents)):
+            labels = self._tagger.tag(self.feature_store.sentence_features(sent_id))
+            if len(labels) != len(tokens):
+                raise Exception(' Predicted Length Not Matched, Expect Errors !')
+            result.append(list(zip(tokens, labels)))
+        return result
+
+def essay_sentence_tokens(essays):
+    """ The tokens of every sentence in the (processed) essays """
+    return [tuple(wd for wd, tags in sentence) for essay in essays for sentence in essay.sentences]
+
+def build_feature_store(feature_fn, essays, filename_prefix=None):
+    """
+    Extracts the features of every sentence in essays, once for the corpus and feature configuration.
+
+    Parameters
+    ----------
+    feature_fn : function(tokens, idx) -> list[str]
+        the CRF feature function. Its name should identify its configuration (see attach_function_identifier),
+        as it keys the cached store
+    essays : list[Essay]
+    filename_prefix : str (optional)
+        caches the store on disk (see artifact_cache.ArtifactCache) under this prefix
+
+    Returns
+    -------
+    SentenceFeatureStore
+    """
+    sentences = essay_sentence_tokens(essays)
+    if filename_prefix is None:
+        return SentenceFeatureStore(feature_fn, sentences)
+
+    cache = ArtifactCache(filename_prefix)
+    key = cache.key(function_name(feature_fn), sentences)
+    found, store = cache.get(key)
+    if found:
+        logging.info("Loaded features for %i sentences (%s)" % (len(store), function_name(feature_fn)))
+        store.feature_fn = feature_fn
+        return store
+    store = SentenceFeatureStore(feature_fn, sentences)
+    cache.put(key, store)
+    return store
@@ -0,0 +1,292 @@
+__author__ = 'simon.hughes'
+
+import os
+
+import numpy as np
+
+# file names of the arrays making up a stored corpus
+__ARRAYS__ = ["token_ids", "tag_bits", "sentence_offsets", "essay_offsets", "vocab", "tags", "essay_names"]
+
+class StoreSentences(object):
+    """ A read only sequence over the sentences of one essay in an EssayStore. Each sentence is built
+        on access, as a list of (word, tags) tuples. The words and tag sets are shared objects from the
+        store's vocabulary and tag set tables, and are not copied per token.
+    """
+    def __init__(self, store, first_sent_ix, last_sent_ix):
+        self.store = store
+        self.first_sent_ix = first_sent_ix
+        self.last_sent_ix = last_sent_ix
+
+    def __len__(self):
+        return self.last_sent_ix - self.first_sent_ix
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            return [self[i] for i in range(*ix.indices(len(self)))]
+        if ix < 0:
+            ix += len(self)
+        if ix < 0 or ix >= len(self):
+            raise IndexError("sentence index out of range")
+        return self.store.sentence(self.first_sent_ix + ix)
+
+    def __iter__(self):
+        for ix in range(self.first_sent_ix, self.last_sent_ix):
+            yield self.store.sentence(ix)
+
+class StoreEssay(object):
+    """ Essay view over an EssayStore, usable wherever a processessays.Essay is expected """
+    def __init__(self, store, essay_ix):
+        self.name = store.essay_names[essay_ix]
+        self.essay_ix = essay_ix
+        self.sentences = StoreSentences(store, int(store.essay_offsets[essay_ix]), int(store.essay_offsets[essay_ix + 1]))
+
+class EssayStore(object):
+    """
+    Columnar storage for processed essays (see processessays.process_essays). The corpus is held as
+    flat numpy arrays, which can be saved as .npy files and memory mapped, so that worker processes
+    share one (read only) copy of the corpus via the OS page cache:
+
+        token_ids           : int32[n_tokens]               index of each word into vocab
+        tag_bits            : uint8[n_tokens, n_tag_bytes]  bitset of each word's tags (bit i = tags[i]), see np.packbits
+        sentence_offsets    : int64[n_sentences + 1]        first token of each sentence
+        essay_offsets       : int64[n_essays + 1]           first sentence of each essay
+        vocab, tags, essay_names : str arrays
+
+    Iterating the store yields StoreEssay objects, so existing code taking a list of essays works on it.
+    """
+    def __init__(self, token_ids, tag_bits, sentence_offsets, essay_offsets, vocab, tags, essay_names, folder=None):
+        self.token_ids = token_ids
+        self.tag_bits = tag_bits
+        self.sentence_offsets = sentence_offsets
+        self.essay_offsets = essay_offsets
+        self.vocab = vocab
+        self.tags = tags
+        self.essay_names = essay_names
+        # set when memory mapped, so that pickling the store (e.g. to send to a worker) just re-opens the files
+        self.folder = folder
+        self.__init_tables_()
+
+    def __init_tables_(self):
+        self.tag_ix = dict((tag, ix) for ix, tag in enumerate(self.tags))
+        # built on first use, see __tagset_table_
+        self.__tagset_ids_, self.__tagsets_ = None, None
+
+    @staticmethod
+    def from_essays(essays):
+        """
+        Parameters
+        ----------
+        essays : list[Essay]
+            essays whose sentences are lists of (word, set(tags)) tuples
+
+        Returns
+        -------
+        EssayStore
+        """
+        vocab, word_ix = [], {}
+        tags, tag_ix = [], {}
+        token_ids, tag_rows, tag_cols = [], [], []
+        sentence_offsets, essay_offsets, essay_names = [0], [0], []
+
+        for essay in essays:
+            essay_names.append(essay.name)
+            for sentence in essay.sentences:
+                for wd, wd_tags in sentence:
+                    if wd not in word_ix:
+                        word_ix[wd] = len(vocab)
+                        vocab.append(wd)
+                    for tag in wd_tags:
+                        if tag not in tag_ix:
+                            tag_ix[tag] = len(tags)
+                            tags.append(tag)
+                        tag_rows.append(len(token_ids))
+                        tag_cols.append(tag_ix[tag])
+                    token_ids.append(word_ix[wd])
+                sentence_offsets.append(len(token_ids))
+            essay_offsets.append(len(sentence_offsets) - 1)
+
+        # set the bits directly, rather than packing a (much larger) boolean matrix
+        tag_cols = np.asarray(tag_cols, dtype=np.int64)
+        tag_bits = np.zeros((len(token_ids), max(1, (len(tags) + 7) // 8)), dtype=np.uint8)
+        np.bitwise_or.at(tag_bits, (np.asarray(tag_rows, dtype=np.int64), tag_cols // 8),
+                         (128 >> (tag_cols % 8)).astype(np.uint8))
+
+        return EssayStore(
+            token_ids=np.asarray(token_ids, dtype=np.int32),
+            tag_bits=tag_bits,
+            sentence_offsets=np.asarray(sentence_offsets, dtype=np.int64),
+            essay_offsets=np.asarray(essay_offsets, dtype=np.int64),
+            vocab=vocab, tags=tags, essay_names=essay_names)
+
+    def save(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in __ARRAYS__:
+            value = getattr(self, name)
+            if type(value) == list:
+                value = __encode_strs__(value)
+            np.save(os.path.join(folder, name + ".npy"), value)
+
+    @staticmethod
+    def load(folder, mmap_mode="r"):
+        """
+        Parameters
+        ----------
+        folder : str
+            folder the store was saved to
+        mmap_mode : str (optional)
+            passed to np.load. The default memory maps the arrays read only. None loads them into memory
+
+        Returns
+        -------
+        EssayStore
+        """
+        arrays = {}
+        for name in __ARRAYS__:
+            fname = os.path.join(folder, name + ".npy")
+            if name in ("vocab", "tags", "essay_names"):
+                arrays[name] = __decode_strs__(np.load(fname))
+            else:
+                arrays[name] = np.load(fname, mmap_mode=mmap_mode)
+        return EssayStore(folder=folder if mmap_mode else None, **arrays)
+
+    def __getstate__(self):
+        if self.folder is not None:
+            return {"folder": self.folder}
+        state = self.__dict__.copy()
+        del state["_EssayStore__tagset_ids_"], state["_EssayStore__tagsets_"]
+        return state
+
+    def __setstate__(self, state):
+        if "token_ids" not in state:
+            state = EssayStore.load(state["folder"]).__dict__
+        self.__dict__.update(state)
+        self.__init_tables_()
+
+    """ Sizes """
+    @property
+    def num_tokens(self):
+        return len(self.token_ids)
+
+    @property
+    def num_sentences(self):
+        return len(self.sentence_offsets) - 1
+
+    def __len__(self):
+        return len(self.essay_names)
+
+    """ Essay \ Sentence access """
+    def __iter__(self):
+        for essay_ix in range(len(self)):
+            yield StoreEssay(self, essay_ix)
+
+    def __getitem__(self, essay_ix):
+        if isinstance(essay_ix, slice):
+            # e.g. for cross validation splits
+            return [StoreEssay(self, ix) for ix in range(*essay_ix.indices(len(self)))]
+        if essay_ix < 0:
+            essay_ix += len(self)
+        if essay_ix < 0 or essay_ix >= len(self):
+            raise IndexError("essay index out of range")
+        return StoreEssay(self, essay_ix)
+
+    def essay_sentence_range(self, essay_ix):
+        return int(self.essay_offsets[essay_ix]), int(self.essay_offsets[essay_ix + 1])
+
+    def essay_token_range(self, essay_ix):
+        first_sent, last_sent = self.essay_sentence_range(essay_ix)
+        return int(self.sentence_offsets[first_sent]), int(self.sentence_offsets[last_sent])
+
+    def sentence_token_range(self, sent_ix):
+        return int(self.sentence_offsets[sent_ix]), int(self.sentence_offsets[sent_ix + 1])
+
+    def sentence(self, sent_ix):
+        """ The tagged sentence, as a list of (word, tags) tuples """
+        return zip(self.sentence_words(sent_ix), self.sentence_tags(sent_ix))
+
+    def sentence_words(self, sent_ix):
+        start, end = self.sentence_token_range(sent_ix)
+        vocab = self.vocab
+        return [vocab[wix] for wix in self.token_ids[start:end].tolist()]
+
+    def sentence_tags(self, sent_ix):
+        start, end = self.sentence_token_range(sent_ix)
+        tagset_ids, tagsets = self.__tagset_table_()
+        return [tagsets[ix] for ix in tagset_ids[start:end].tolist()]
+
+    def __tagset_table_(self):
+        """ Decodes each distinct tag bitset once. Tokens with the same tags share the same frozenset
+
+        Returns
+        -------
+        (np.array, list[frozenset]) : the index of each token's tag set, and the tag sets
+        """
+        if self.__tagsets_ is None:
+            rows = np.ascontiguousarray(self.tag_bits)
+            as_void = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+            _, first_ix, tagset_ids = np.unique(as_void, return_index=True, return_inverse=True)
+            tagsets = []
+            for row in first_ix:
+                bits = np.unpackbits(rows[row])[:len(self.tags)]
+                tagsets.append(frozenset(self.tags[ix] for ix in np.flatnonzero(bits)))
+            self.__tagset_ids_, self.__tagsets_ = tagset_ids.astype(np.int32), tagsets
+        return self.__tagset_ids_, self.__tagsets_
+
+    def word_tags(self, start=0, end=None):
+        """ The tags of every token in the range, in order (as returned by wordtagginghelper.flatten_to_wordlevel_feat_tags) """
+        tagset_ids, tagsets = self.__tagset_table_()
+        return [tagsets[ix] for ix in tagset_ids[start:end].tolist()]
+
+    """ Vectorized access """
+    def tag_matrix(self, tags, start=0, end=None):
+        """
+        Parameters
+        ----------
+        tags : list[str]
+            tags to return the labels for. Tags not in the store are all zeros
+        start, end : int
+            token range
+
+        Returns
+        -------
+        np.array : bool[end - start, len(tags)], whether each token has each tag
+        """
+        end = self.num_tokens if end is None else end
+        matrix = np.zeros((end - start, len(tags)), dtype=np.bool_)
+        for col, tag in enumerate(tags):
+            ix = self.tag_ix.get(tag)
+            if ix is not None:
+                byte_ix, bit = divmod(ix, 8)
+                # np.packbits is big endian within each byte
+                matrix[:, col] = (self.tag_bits[start:end, byte_ix] & (128 >> bit)) > 0
+        return matrix
+
+    def ys_by_code(self, expected_tags):
+        """ Word level binary labels per tag, as wordtagginghelper.get_wordlevel_ys_by_code """
+        matrix = self.tag_matrix(expected_tags)
+        return dict((tag, matrix[:, col].astype(np.int)) for col, tag in enumerate(expected_tags))
+
+    def sentence_tag_matrix(self, tags):
+        """ bool[n_sentences, len(tags)], whether any token in each sentence has each tag """
+        matrix = self.tag_matrix(tags)
+        starts = self.sentence_offsets[:-1]
+        non_empty = starts < self.sentence_offsets[1:]
+        sent_matrix = np.zeros((self.num_sentences, len(tags)), dtype=np.bool_)
+        if non_empty.any() and len(tags) > 0:
+            sent_matrix[non_empty] = np.logical_or.reduceat(matrix, starts[non_empty], axis=0)
+        return sent_matrix
+
+def __encode_strs__(strs):
+    return np.array([s.encode("utf-8") if isinstance(s, unicode) else s for s in strs], dtype=np.str_)
+
+def __decode_strs__(arr):
+    return [str(s) for s in arr.tolist()]
+
+def save_essay_store(essays, folder):
+    """ Converts the processed essays to columnar format, and saves them to folder """
+    store = EssayStore.from_essays(essays)
+    store.save(folder)
+    return store
+
+def load_essay_store(folder, mmap_mode="r"):
+    return EssayStore.load(folder, mmap_mode=mmap_mode)
@@ -0,0 +1,175 @@
+__author__ = 'simon.hughes'
+
+import logging
+
+import scipy.sparse as sp
+
+from artifact_cache import ArtifactCache, stable_hash, function_name
+from featureextractortransformer import FeatureExtractorTransformer, Word
+from processessays import Essay
+from essaystore import EssayStore
+
+def corpus_fingerprint(essays):
+    """ A stable hash of the words and tags of the (processed) essays
+
+    Parameters
+    ----------
+    essays : list[Essay] or essaystore.EssayStore
+
+    Returns
+    -------
+    str : the hex digest
+    """
+    if isinstance(essays, EssayStore):
+        return stable_hash(essays.token_ids, essays.tag_bits, essays.sentence_offsets, essays.essay_offsets,
+                           essays.vocab, essays.tags, essays.essay_names)
+    return stable_hash([(essay.name, essay.sentences) for essay in essays])
+
+class FeatureBlockStore(object):
+    """
+    Caches the features of each feature extractor separately, as a sparse block of columns over every word
+    of the corpus (see featureextractortransformer.FeatureBlock), keyed on the extractor's identifier (see
+    featureextractionfunctions.attach_function_identifier) and the corpus fingerprint. The features for any
+    combination of extractors are the cached blocks stacked horizontally, so adding an extractor to an existing
+    set (e.g. in a feature selection sweep) only extracts the new extractor's features.
+    """
+    def __init__(self, filename_prefix=None, hash_bits=None, batch_parse=True, keep_in_memory=True):
+        """
+        Parameters
+        ----------
+        filename_prefix : str (optional)
+            caches the blocks on disk (see artifact_cache.ArtifactCache) under this prefix
+        hash_bits : int (optional)
+            if set, each extractor's features are hashed into its own 2 ** hash_bits columns
+        batch_parse : bool
+            see FeatureExtractorTransformer
+        keep_in_memory : bool
+            also keep the blocks used in memory, so they are not re-loaded from disk for each combination
+        """
+        self.filename_prefix = filename_prefix
+        self.hash_bits = hash_bits
+        self.batch_parse = batch_parse
+        self.keep_in_memory = keep_in_memory
+        self.cache = ArtifactCache(filename_prefix) if filename_prefix else None
+        self.blocks = {}
+        # the essays last fingerprinted, and their fingerprint
+        self.__fingerprinted_ = (None, None)
+
+    def fingerprint(self, essays):
+        # hashing the corpus is not free, and a sweep passes the same essays for every combination
+        if self.__fingerprinted_[0] is not essays:
+            self.__fingerprinted_ = (essays, corpus_fingerprint(essays))
+        return self.__fingerprinted_[1]
+
+    def block_key(self, extractor, fingerprint):
+        # the function (its identifier and byte code), rather than just its name, so edited extractors don't match stale blocks
+        return stable_hash("feature_block", extractor, fingerprint, self.hash_bits)
+
+    def get_blocks(self, essays, extractors):
+        """
+        Parameters
+        ----------
+        essays : list[Essay] or essaystore.EssayStore
+        extractors : list[fn]
+            fn: FeatureExtractorInput -> dict
+
+        Returns
+        -------
+        list[FeatureBlock] : the block of each extractor, extracting only those not already cached
+        """
+        fingerprint = self.fingerprint(essays)
+        keys = [self.block_key(fn, fingerprint) for fn in extractors]
+
+        found, missing = {}, []
+        for fn, key in zip(extractors, keys):
+            if key in found or key in self.blocks:
+                continue
+            if self.cache is not None:
+                in_cache, block = self.cache.get(key)
+                if in_cache:
+                    found[key] = block
+                    continue
+            if key not in [k for _, k in missing]:
+                missing.append((fn, key))
+
+        if missing:
+            logging.info("Extracting %i feature block(s): %s" % (len(missing), ", ".join(function_name(fn) for fn, _ in missing)))
+            transformer = FeatureExtractorTransformer([fn for fn, _ in missing], hash_bits=self.hash_bits,
+                                                      batch_parse=self.batch_parse)
+            for (fn, key), block in zip(missing, transformer.transform_blocks(essays)):
+                found[key] = block
+                if self.cache is not None:
+                    self.cache.put(key, block)
+
+        blocks = [found[key] if key in found else self.blocks[key] for key in keys]
+        if self.keep_in_memory:
+            self.blocks.update(found)
+        return blocks
+
+    def feature_matrix(self, essays, extractors):
+        """
+        Returns
+        -------
+        (CSR matrix, list[str]) : the features of the extractors, one row per word, and the name of each
+            column (None for hashed features)
+        """
+        blocks = self.get_blocks(essays, extractors)
+        xs = sp.hstack([block.matrix for block in blocks], format="csr")
+        if self.hash_bits:
+            return xs, None
+        return xs, [feat for block in blocks for feat in block.feature_names]
+
+    def transform(self, essays, extractors, as_matrix=False):
+        """
+        Drop in replacement for FeatureExtractorTransformer(extractors, hash_bits).transform(essays)
+        (see load_data.extract_features), built from the cached blocks
+
+        Parameters
+        ----------
+        essays : list[Essay] or essaystore.EssayStore
+        extractors : list[fn]
+        as_matrix : bool
+            set each essay's rows of the stacked blocks as its hashed_features, rather than building the feature
+            dictionary of every word (flatten_to_wordlevel_feat_tags and FeatureVectorizer accept either). Always
+            the case when the features are hashed
+
+        Returns
+        -------
+        list[Essay] : whose sentences are lists of Word objects
+        """
+        blocks = self.get_blocks(essays, extractors)
+        as_matrix = as_matrix or bool(self.hash_bits)
+        if as_matrix:
+            xs = sp.hstack([block.matrix for block in blocks], format="csr")
+        else:
+            matrices = [block.matrix.tocsr() for block in blocks]
+
+        transformed, row = [], 0
+        for essay_ix, essay in enumerate(essays):
+            t_essay = []
+            t_essay_obj = Essay(essay.name, t_essay)
+            transformed.append(t_essay_obj)
+            first_row = row
+            for taggged_sentence in essay.sentences:
+                t_sentence = []
+                t_essay.append(t_sentence)
+                for wd, tags in taggged_sentence:
+                    word = Word(wd, tags)
+                    if not as_matrix:
+                        # in extractor order, so later extractors overwrite duplicate features as in FeatureExtractorTransformer
+                        for block, matrix in zip(blocks, matrices):
+                            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+                            names = block.feature_names
+                            word.features.update(
+                                (names[col], val) for col, val in zip(matrix.indices[start:end].tolist(), matrix.data[start:end].tolist()))
+                    t_sentence.append(word)
+                    row += 1
+            if as_matrix:
+                t_essay_obj.hashed_features = xs[first_row:row]
+                if isinstance(essays, EssayStore):
+                    t_essay_obj.store, t_essay_obj.essay_ix = essays, essay_ix
+        return transformed
+
+    def clear(self):
+        """ Clears the in memory blocks (the on disk cache is kept) """
+        self.blocks.clear()
@@ -1,12 +1,12 @@
 from NgramGenerator import compute_ngrams
-from Decorators import memoize
+from Decorators import memoize_bounded, MAX_CACHED_SENTENCES
 from SpaCyParserWrapper import Parser
 import PosTagger
 
 from nltk import PorterStemmer
 stemmer = PorterStemmer()
 
-@memoize
+@memoize_bounded()
 def stem(word):
     return stemmer.stem(word)
 
@@ -41,10 +41,95 @@ def attach_function_identifier(fn, d):
     fn.func_name = s.strip() + "]"
     return fn
 
-@memoize
-def __parse__(tokens):
+""" SENTENCE LEVEL ANNOTATIONS
+
+    The parse and POS tags of a sentence are shared by all of its words. preprocess_sentences computes them
+    for every distinct sentence up front, in bulk, and stores them in the tables below, keyed on the sentence
+    tokens (FeatureExtractorInput.sentence). Sentences not in the tables are annotated individually.
+"""
+__parse_table__ = {}
+__pos_tag_table__ = {}
+
+def requires_parse(fn):
+    """ Marks a feature extractor as using the spaCy parse, so FeatureExtractorTransformer parses up front """
+    fn.requires_parse = True
+    return fn
+
+def requires_pos_tags(fn):
+    """ Marks a feature extractor as using the POS tags, so FeatureExtractorTransformer tags up front """
+    fn.requires_pos_tags = True
+    return fn
+
+""" SENTENCE LEVEL EXTRACTORS
+
+    A feature extractor can also provide a sentence level version of itself, as fn.sentence_fn:
+        sentence_fn(sentence) -> list of dict
+    which takes the sentence tokens (FeatureExtractorInput.sentence) and returns the features of every word
+    in the sentence, the same as calling fn for each word. FeatureExtractorTransformer calls it (once per
+    sentence) in preference to fn, so windowed extractors pad, stem and compute the ngrams of each sentence
+    once, rather than once per word.
+"""
+def attach_sentence_extractor(fn, sentence_fn):
+    fn.sentence_fn = sentence_fn
+    return fn
+
+def __pad_sentence_(words, offset):
+    return [__START__] * offset + list(words) + [__END__] * offset
+
+def __window_ngrams_(words, offset, ngram_size):
+    """ The ngrams of the padded sentence, joined. The window of word j is padded[j:j + 2 * offset + 1],
+        so the ith ngram of word j's window is ngrams[j + i]
+    """
+    padded = __pad_sentence_(words, offset)
+    return [",".join(padded[p:p + ngram_size]) for p in range(len(padded) - ngram_size + 1)]
+
+def preprocess_sentences(sentences, parse=True, pos_tag=True, batch_size=1000, n_threads=4):
+    """
+    Parses and/or POS tags all distinct sentences in bulk, storing the results in the sentence tables
+
+    Parameters
+    ----------
+    sentences : iterable of tuple[str]
+        sentence tokens, as in FeatureExtractorInput.sentence
+    parse : bool
+        fill the spaCy parse table (dependency relations and brown clusters)
+    pos_tag : bool
+        fill the POS tag table
+    batch_size, n_threads : int
+        passed to Parser.parse_many
+    """
+    distinct = list(set(map(tuple, sentences)))
+    if parse:
+        to_parse = [s for s in distinct if s not in __parse_table__]
+        for tokens, sentence_parse in zip(to_parse, parser.parse_many(to_parse, batch_size=batch_size, n_threads=n_threads)):
+            __parse_table__[tokens] = sentence_parse
+    if pos_tag:
+        to_tag = [s for s in distinct if s not in __pos_tag_table__]
+        for tokens, tag_pairs in zip(to_tag, __pos_tagger__.tag_many(to_tag)):
+            __pos_tag_table__[tokens] = tag_pairs
+
+def clear_sentence_tables():
+    __parse_table__.clear()
+    __pos_tag_table__.clear()
+
+# bounded, as long running processes (e.g. the annotator) see an unbounded number of sentences
+@memoize_bounded(max_size=MAX_CACHED_SENTENCES)
+def __parse_sentence_(tokens):
     return parser.parse(tokens)
 
+def __parse__(tokens):
+    sentence_parse = __parse_table__.get(tokens)
+    if sentence_parse is not None:
+        return sentence_parse.relations
+    return __parse_sentence_(tokens)
+
+def __brown_clusters_(tokens):
+    sentence_parse = __parse_table__.get(tokens)
+    if sentence_parse is not None:
+        return sentence_parse.brown_clusters
+    return parser.brown_cluster(tokens)
+
+@requires_parse
 def extract_dependency_children(input, val=1):
     relations = __parse__(input.sentence)
     relation = relations[input.wordix]
@@ -54,6 +139,7 @@ def extract_dependency_children(input, val=1):
         feats["CHILD_DEP:" + bin_rel.relation + "->" + bin_rel.child] = val
     return feats
 
+@requires_parse
 def extract_dependency_child_words(input, val=1):
     relations = __parse__(input.sentence)
     relation = relations[input.wordix]
@@ -63,6 +149,7 @@ def extract_dependency_child_words(input, val=1):
         feats["CHILD_WORD_DEP:" + bin_rel.child] = val
     return feats
 
+@requires_parse
 def extract_dependency_children_plus_target(input, val=1):
     relations = __parse__(input.sentence)
     relation = relations[input.wordix]
@@ -72,24 +159,28 @@ def extract_dependency_children_plus_target(input, val=1):
         feats["CHILD_DEP_TGT[" + input.sentence[input.wordix] + "]:" + bin_rel.relation + bin_rel.child] = val
     return feats
 
+@requires_parse
 def extract_dependency_head(input, val=1):
     relations = __parse__(input.sentence)
     relation = relations[input.wordix]
     feats = { "HEAD_DEP:" + relation.head + "->" + relation.relation : val }
     return feats
 
+@requires_parse
 def extract_dependency_head_word(input, val=1):
     relations = __parse__(input.sentence)
     relation = relations[input.wordix]
     feats = { "HEAD_WORD_DEP:" + relation.head: val }
     return feats
 
+@requires_parse
 def extract_dependency_head_plus_target(input, val=1):
     relations = __parse__(input.sentence)
     relation = relations[input.wordix]
     feats = { "HEAD_DEP_TGT[" + input.sentence[input.wordix] + "]:" + relation.head + "->" + relation.relation: val }
     return feats
 
+@requires_parse
 def extract_dependency_relation(input, val=1):
     relations = __parse__(input.sentence)
     relation = relations[input.wordix]
@@ -116,7 +207,7 @@ def fact_extract_positional_head_word_features(offset):
     # curry offset
     def fn_pos_hd_wd_feats(input, val=1):
         return extract_positional_head_word_features(offset, input, val)
-    return attach_function_identifier(fn_pos_hd_wd_feats, lcls)
+    return attach_function_identifier(requires_parse(fn_pos_hd_wd_feats), lcls)
 
 def extract_positional_head_word_features(offset, input, val = 1):
     """ offset      :   int
@@ -131,7 +222,7 @@ def extract_positional_head_word_features(offset, input, val = 1):
     start = input.wordix - offset
     stop  = input.wordix + offset
 
-    relations = parser.parse(input.sentence)
+    relations = __parse__(input.sentence)
 
     end = len(input.sentence) - 1
     for i in range(start, stop+1):
@@ -155,7 +246,9 @@ def fact_extract_positional_word_features(offset):
     # curry offset
     def fn_pos_wd_feats(input, val=1):
         return extract_positional_word_features(offset, input, val)
-    return attach_function_identifier(fn_pos_wd_feats, lcls)
+    def fn_pos_wd_feats_sentence(sentence, val=1):
+        return extract_positional_word_features_sentence(offset, sentence, val)
+    return attach_function_identifier(attach_sentence_extractor(fn_pos_wd_feats, fn_pos_wd_feats_sentence), lcls)
 
 def extract_positional_word_features(offset, input, val = 1):
     """ offset      :   int
@@ -182,6 +275,37 @@ def extract_positional_word_features(offset, input, val = 1):
             feats["WD:" + relative_offset + "->" + offset_word] = val
     return feats
 
+def extract_positional_word_features_sentence(offset, sentence, val = 1, words = None):
+    """ offset      :   int
+                           the number of words either side of the input to extract features from
+        sentence    :   tuple of str
+                            the sentence tokens
+        words       :   list of str (optional)
+                            the words to use in the features, in place of the tokens (e.g. their stems)
+        returns     :   list of dict
+                            dictionary of features for each word, as extract_positional_word_features
+    """
+    words = sentence if words is None else words
+    relative_offsets = range(-offset, offset + 1)
+    start_feats = ["WD" + __START__ + ":" + str(rel) for rel in relative_offsets]
+    end_feats   = ["WD" + __END__   + ":" + str(rel) for rel in relative_offsets]
+    prefixes    = ["WD:" + str(rel) + "->" for rel in relative_offsets]
+
+    num_words = len(words)
+    sentence_feats = []
+    for wordix in range(num_words):
+        feats = {}
+        for k, rel in enumerate(relative_offsets):
+            i = wordix + rel
+            if i < 0:
+                feats[start_feats[k]] = val
+            elif i >= num_words:
+                feats[end_feats[k]] = val
+            else:
+                feats[prefixes[k] + words[i]] = val
+        sentence_feats.append(feats)
+    return sentence_feats
+
 def fact_extract_positional_word_features_stemmed(offset):
     """ offset      :   int
                             the number of words either side of the input to extract features from
@@ -192,7 +316,10 @@ def fact_extract_positional_word_features_stemmed(offset):
     # curry offset
     def fn_pos_wd_feats_stemmed(input, val=1):
         return extract_positional_word_features_stemmed(offset, input, val)
-    return attach_function_identifier(fn_pos_wd_feats_stemmed, lcls) # recently renamed for mongodob logging
+    def fn_pos_wd_feats_stemmed_sentence(sentence, val=1):
+        return extract_positional_word_features_sentence(offset, sentence, val, words=[stem(wd) for wd in sentence])
+    return attach_function_identifier(attach_sentence_extractor(fn_pos_wd_feats_stemmed, fn_pos_wd_feats_stemmed_sentence),
+                                      lcls) # recently renamed for mongodob logging
 
 def extract_positional_word_features_stemmed(offset, input, val = 1):
     """ offset      :   int
@@ -229,7 +356,10 @@ def fact_extract_first_3_chars(offset):
     lcls = locals()
     def fn_extract_first_3_chars(input, val=1):
         return extract_first_3_chars(offset, input, val)
-    return attach_function_identifier(fn_extract_first_3_chars, lcls) # recently renamed for mongodob logging
+    def fn_extract_first_3_chars_sentence(sentence, val=1):
+        return extract_first_3_chars_sentence(offset, sentence, val)
+    return attach_function_identifier(attach_sentence_extractor(fn_extract_first_3_chars, fn_extract_first_3_chars_sentence),
+                                      lcls) # recently renamed for mongodob logging
 
 def extract_first_3_chars(offset, input, val = 1):
     """ offset      :   int
@@ -253,6 +383,30 @@ def extract_first_3_chars(offset, input, val = 1):
             feats["First3:" + relative_offset + "->" + offset_word[:3]] = val
     return feats
 
+def extract_first_3_chars_sentence(offset, sentence, val = 1):
+    """ offset      :   int
+                           the number of words either side of the input to extract features from
+        sentence    :   tuple of str
+                            the sentence tokens
+        returns     :   list of dict
+                            dictionary of features for each word, as extract_first_3_chars
+    """
+    first_3_chars = [wd.strip()[:3] for wd in sentence]
+    relative_offsets = range(-offset, offset + 1)
+    prefixes = ["First3:" + str(rel) + "->" for rel in relative_offsets]
+
+    # as extract_first_3_chars, this excludes the last word of the sentence
+    end = len(sentence) - 1
+    sentence_feats = []
+    for wordix in range(len(sentence)):
+        feats = {}
+        for k, rel in enumerate(relative_offsets):
+            i = wordix + rel
+            if i >= 0 and i < end:
+                feats[prefixes[k] + first_3_chars[i]] = val
+        sentence_feats.append(feats)
+    return sentence_feats
+
 """ BOW NGRAMS
 """
 def fact_extract_bow_ngram_features(offset, ngram_size):
@@ -267,7 +421,9 @@ def fact_extract_bow_ngram_features(offset, ngram_size):
     lcls = locals()
     def fn_bow_ngram_feat(input, val=1):
         return extract_bow_ngram_features(offset, ngram_size, input, val)
-    return attach_function_identifier(fn_bow_ngram_feat, lcls)
+    def fn_bow_ngram_feat_sentence(sentence, val=1):
+        return extract_bow_ngram_features_sentence(offset, ngram_size, sentence, val)
+    return attach_function_identifier(attach_sentence_extractor(fn_bow_ngram_feat, fn_bow_ngram_feat_sentence), lcls)
 
 def extract_bow_ngram_features(offset, ngram_size, input, val = 1):
     """ offset      :   int
@@ -306,6 +462,22 @@ def extract_bow_ngram_features(offset, ngram_size, input, val = 1):
 
     return feats
 
+def extract_bow_ngram_features_sentence(offset, ngram_size, sentence, val = 1):
+    """ offset      :   int
+                           the number of words either side of the input to extract features from
+        ngram_size  :   int
+                            the size of the ngrams
+        sentence    :   tuple of str
+                            the sentence tokens
+        returns     :   list of dict
+                            dictionary of features for each word, as extract_bow_ngram_features
+    """
+    prefix = "POS_" + str(ngram_size) + "GRAMS:BOW" + "->"
+    feat_names = [prefix + str_ngram for str_ngram in __window_ngrams_(sentence, offset, ngram_size)]
+    num_window_ngrams = 2 * offset + 2 - ngram_size
+    return [dict((feat_names[wordix + i], val) for i in range(num_window_ngrams))
+            for wordix in range(len(sentence))]
+
 """ POSITIONAL NGRAMS
 """
 def fact_extract_positional_ngram_features(offset, ngram_size):
@@ -320,8 +492,10 @@ def fact_extract_positional_ngram_features(offset, ngram_size):
     lcls = locals()
     def fn_pos_ngram_feat(input, val=1):
         return extract_positiomal_ngram_features(offset, ngram_size, input, val)
+    def fn_pos_ngram_feat_sentence(sentence, val=1):
+        return extract_positional_ngram_features_sentence(offset, ngram_size, sentence, val)
 
-    attach_function_identifier(fn_pos_ngram_feat, lcls)
+    attach_function_identifier(attach_sentence_extractor(fn_pos_ngram_feat, fn_pos_ngram_feat_sentence), lcls)
     return fn_pos_ngram_feat
 
 def extract_positiomal_ngram_features(offset, ngram_size, input, val = 1):
@@ -362,6 +536,24 @@ def extract_positiomal_ngram_features(offset, ngram_size, input, val = 1):
 
     return feats
 
+def extract_positional_ngram_features_sentence(offset, ngram_size, sentence, val = 1, words = None):
+    """ offset      :   int
+                           the number of words either side of the input to extract features from
+        ngram_size  :   int
+                            the size of the ngrams
+        sentence    :   tuple of str
+                            the sentence tokens
+        words       :   list of str (optional)
+                            the words to compute the ngrams from, in place of the tokens (e.g. their stems)
+        returns     :   list of dict
+                            dictionary of features for each word, as extract_positiomal_ngram_features
+    """
+    words = sentence if words is None else words
+    str_ngrams = __window_ngrams_(words, offset, ngram_size)
+    prefixes = ["POS_" + str(ngram_size) + "GRAMS:" + str(i - offset) + "->" for i in range(2 * offset + 2 - ngram_size)]
+    return [dict((prefix + str_ngrams[wordix + i], val) for i, prefix in enumerate(prefixes))
+            for wordix in range(len(words))]
+
 def fact_extract_ngram_features_stemmed(offset, ngram_size):
     """ offset      :   int
                             the number of words either side of the input to extract features from
@@ -374,7 +566,10 @@ def fact_extract_ngram_features_stemmed(offset, ngram_size):
     # curry offset and ngram size
     def fn_pos_ngram_feat_stemmed(input, val=1):
         return extract_ngram_features_stemmed(offset, ngram_size, input, val)
-    return attach_function_identifier(fn_pos_ngram_feat_stemmed, lcls)
+    def fn_pos_ngram_feat_stemmed_sentence(sentence, val=1):
+        # the stems of the words (but not the padding), as extract_ngram_features_stemmed
+        return extract_positional_ngram_features_sentence(offset, ngram_size, sentence, val, words=[stem(wd) for wd in sentence])
+    return attach_function_identifier(attach_sentence_extractor(fn_pos_ngram_feat_stemmed, fn_pos_ngram_feat_stemmed_sentence), lcls)
 
 def extract_ngram_features_stemmed(offset, ngram_size, input, val = 1):
     """ offset      :   int
@@ -416,10 +611,16 @@ def extract_ngram_features_stemmed(offset, ngram_size, input, val = 1):
     return feats
 
 __pos_tagger__ = PosTagger.PosTagger()
-@memoize
-def __tag__(tokens):
+@memoize_bounded(max_size=MAX_CACHED_SENTENCES)
+def __tag_sentence_(tokens):
     return __pos_tagger__.tag(tokens)
 
+def __tag__(tokens):
+    tag_pairs = __pos_tag_table__.get(tokens)
+    if tag_pairs is not None:
+        return tag_pairs
+    return __tag_sentence_(tokens)
+
 def fact_extract_bow_POS_features(offset):
     """ offset      :   int
                             the number of words either side of the input to extract POS features from
@@ -430,7 +631,7 @@ def fact_extract_bow_POS_features(offset):
     lcls = locals()
     def fn_bow_POS_feats(input, val=1):
         return extract_bow_POS_features(offset, input, val)
-    return attach_function_identifier(fn_bow_POS_feats, lcls)
+    return attach_function_identifier(requires_pos_tags(fn_bow_POS_feats), lcls)
 
 def extract_bow_POS_features(offset, input, val = 1):
     """ offset      :   int
@@ -469,7 +670,7 @@ def fact_extract_positional_POS_features(offset):
     # curry offset
     def fn_pos_POS_feats(input, val=1):
         return extract_positional_POS_features(offset, input, val)
-    return attach_function_identifier(fn_pos_POS_feats, lcls)
+    return attach_function_identifier(requires_pos_tags(fn_pos_POS_feats), lcls)
 
 def extract_positional_POS_features(offset, input, val = 1):
     """ offset      :   int
@@ -499,6 +700,7 @@ def extract_positional_POS_features(offset, input, val = 1):
             feats["POS_TAG:" + relative_offset + "->" + offset_word] = val
     return feats
 
+@requires_pos_tags
 def extract_POS_TAG(input, val = 1):
     """ input      :    FeatureExtactorInput
                             input to feature extractor
@@ -511,6 +713,7 @@ def extract_POS_TAG(input, val = 1):
     feats = {"POS_TAG_ONLY:" + tags[input.wordix] : val }
     return feats
 
+@requires_pos_tags
 def extract_POS_TAG_PLUS_WORD(input, val = 1):
     """ input      :    FeatureExtactorInput
                             input to feature extractor
@@ -533,7 +736,7 @@ def fact_extract_positional_POS_features_plus_word(offset):
     # curry offset
     def fn_pos_POS_feats_stemmed_plus_word(input, val=1):
         return extract_positional_POS_features_plus_word(offset, input, val)
-    return attach_function_identifier(fn_pos_POS_feats_stemmed_plus_word, lcls)
+    return attach_function_identifier(requires_pos_tags(fn_pos_POS_feats_stemmed_plus_word), lcls)
 
 def extract_positional_POS_features_plus_word(offset, input, val = 1):
     """ offset      :   int
@@ -563,6 +766,7 @@ def extract_positional_POS_features_plus_word(offset, input, val = 1):
             feats["POS_TAG_Posn_Word:" + relative_offset + "->" + offset_tag + ":" + input.sentence[i]] = val
     return feats
 
+@requires_parse
 def extract_brown_cluster(input, val = 1):
     """ input      :    FeatureExtactorInput
                             input to feature extractor
@@ -570,10 +774,11 @@ def extract_brown_cluster(input, val = 1):
                             dictionary of features
     """
 
-    clusters = parser.brown_cluster(input.sentence)
+    clusters = __brown_clusters_(input.sentence)
     feats = {"BRN_CL:" + clusters[input.wordix] : val }
     return feats
 
+@requires_parse
 def extract_brown_cluster_plus_word(input, val = 1):
     """ input      :    FeatureExtactorInput
                             input to feature extractor
@@ -581,10 +786,11 @@ def extract_brown_cluster_plus_word(input, val = 1):
                             dictionary of features
     """
 
-    clusters = parser.brown_cluster(input.sentence)
+    clusters = __brown_clusters_(input.sentence)
     feats = {"BRN_CL:" + clusters[input.wordix] + "-" + input.sentence[input.wordix] : val }
     return feats
 
+@requires_pos_tags
 def extract_POS_TAG_PLUS_WORD(input, val = 1):
     """ input      :    FeatureExtactorInput
                             input to feature extractor
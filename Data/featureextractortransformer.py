@@ -1,6 +1,24 @@
 __author__ = 'simon.hughes'
 
+import numpy as np
+import scipy.sparse as sp
+from sklearn.utils import murmurhash3_32
+
 from processessays import Essay
+from artifact_cache import function_name
+from essaystore import EssayStore
+
+def hash_feature(feat, n_features):
+    """ Signed hashing trick (as used by sklearn's FeatureHasher)
+        feat        :   str
+                            feature name
+        n_features  :   int
+                            width of the hashed feature space
+        returns     :   (int, int)
+                            the feature id, and the sign to apply to the feature value
+    """
+    h = murmurhash3_32(feat, seed=0)
+    return abs(h) % n_features, (1 if h >= 0 else -1)
 
 class Word(object):
     """ Holds a word for a sequence tagger approach.
@@ -21,6 +39,23 @@ class Word(object):
     def __repr__(self):
         return self.word + "->" + str(self.tags)[3:] + " - %s feats" % str(len(self.features))
 
+class FeatureBlock(object):
+    """ The features of a single feature extractor, for every word of a corpus
+        name            :   str
+                                the extractor's identifier (see featureextractionfunctions.attach_function_identifier)
+        matrix          :   CSR matrix
+                                one row per word, in essay, sentence and word order
+        feature_names   :   list of str, or None
+                                the feature of each column. None when the features were hashed
+    """
+    def __init__(self, name, matrix, feature_names=None):
+        self.name = name
+        self.matrix = matrix
+        self.feature_names = feature_names
+
+    def __repr__(self):
+        return "FeatureBlock(%s, %i x %i)" % (self.name, self.matrix.shape[0], self.matrix.shape[1])
+
 class FeatureExtractorInput(object):
     """ Holds all the input needed for a feature extractor
         wordix              :   int
@@ -45,16 +80,93 @@ class FeatureExtractorInput(object):
         self.word = self.sentence[wordix]
 
 class FeatureExtractorTransformer(object):
-    def __init__(self, feature_extractor_fns):
+    def __init__(self, feature_extractor_fns, hash_bits=None, batch_parse=True, sentence_level=True):
         """ feature_extractor_fns   :   list of fns
                                             fn: FeatureExtractorInput -> dict
             tag_transformer         :   fn str -> str
                                             tranformation to apply to tags
+            hash_bits               :   int (optional)
+                                            if set, features are hashed into 2 ** hash_bits columns and
+                                            stored per essay as a CSR matrix (essay.hashed_features),
+                                            rather than as a dictionary on each Word
+            batch_parse             :   bool
+                                            if any extractor uses the parse or POS tags of the sentence, parse
+                                            and tag all distinct sentences in bulk before extracting features
+            sentence_level          :   bool
+                                            use the sentence level version of an extractor (fn.sentence_fn, see
+                                            featureextractionfunctions.attach_sentence_extractor) when it has one
             returns: a list of Essay objects
         """
         self.feature_extractor_fns = feature_extractor_fns
+        self.hash_bits = hash_bits
+        self.batch_parse = batch_parse
+        self.sentence_level = sentence_level
 
     def transform(self, essays):
+        """ essays  :   list of Essay objects, or an essaystore.EssayStore
+            returns :   list of Essay objects, whose sentences are lists of Word objects
+        """
+
+        if self.hash_bits:
+            return self.__with_sentence_tables_(self.__transform_hashed_, essays)
+        return self.__with_sentence_tables_(self.__transform_, essays)
+
+    def transform_blocks(self, essays):
+        """ Extracts the features of each extractor into a separate (sparse) block, so that blocks can be
+            cached per extractor and stacked in any combination (see feature_block_store.FeatureBlockStore)
+
+            essays  :   list of Essay objects, or an essaystore.EssayStore
+            returns :   list of FeatureBlock, one per feature extractor fn
+        """
+        return self.__with_sentence_tables_(self.__transform_blocks_, essays)
+
+    def __with_sentence_tables_(self, transform, essays):
+        preprocessed = self.__preprocess_sentences_(essays)
+        try:
+            return transform(essays)
+        finally:
+            if preprocessed:
+                # the tables are only needed for the duration of the transform
+                from featureextractionfunctions import clear_sentence_tables
+                clear_sentence_tables()
+
+    def __preprocess_sentences_(self, essays):
+        if not self.batch_parse:
+            return False
+        parse   = any(getattr(fn, "requires_parse", False)    for fn in self.feature_extractor_fns)
+        pos_tag = any(getattr(fn, "requires_pos_tags", False) for fn in self.feature_extractor_fns)
+        if not (parse or pos_tag):
+            return False
+
+        # imported here so that the parser is only loaded when an extractor needs it
+        from featureextractionfunctions import preprocess_sentences
+        if isinstance(essays, EssayStore):
+            sentences = (tuple(essays.sentence_words(sent_ix)) for sent_ix in range(essays.num_sentences))
+        else:
+            sentences = (tuple(wd for wd, tags in tagged_sentence)
+                         for essay in essays
+                         for tagged_sentence in essay.sentences)
+        preprocess_sentences(sentences, parse=parse, pos_tag=pos_tag)
+        return True
+
+    def __sentence_features_(self, taggged_sentence, sent_ix, essay):
+        """ The features of each word in the sentence, as a list (per word) of the dictionaries returned by each
+            feature extractor. Extractors with a sentence level version are called once for the whole sentence
+        """
+        fns = self.feature_extractor_fns
+        sentence = tuple(wd for wd, tags in taggged_sentence)
+        sentence_feats = [fn.sentence_fn(sentence) if self.sentence_level and getattr(fn, "sentence_fn", None) is not None else None
+                          for fn in fns]
+        per_word = any(feats is None for feats in sentence_feats)
+
+        word_feats = []
+        for word_ix in range(len(sentence)):
+            input = FeatureExtractorInput(word_ix, taggged_sentence, sent_ix, essay) if per_word else None
+            word_feats.append([fn(input) if feats is None else feats[word_ix]
+                               for fn, feats in zip(fns, sentence_feats)])
+        return word_feats
+
+    def __transform_(self, essays):
 
         transformed = []
         for essay_ix, essay in enumerate(essays):
@@ -64,12 +176,110 @@ class FeatureExtractorTransformer(object):
                 t_sentence = []
                 t_essay.append(t_sentence)
 
-                for word_ix, (wd, tags) in enumerate(taggged_sentence):
+                word_feats = self.__sentence_features_(taggged_sentence, sent_ix, essay)
+                for (wd, tags), fn_feats in zip(taggged_sentence, word_feats):
                     word = Word(wd, tags)
-                    input = FeatureExtractorInput(word_ix, taggged_sentence, sent_ix, essay)
-                    for fn in self.feature_extractor_fns:
-                        d = fn(input)
+                    for d in fn_feats:
                         word.features.update(d)
                     t_sentence.append(word)
         return transformed
 
+    def __transform_hashed_(self, essays):
+
+        n_features = 2 ** self.hash_bits
+        # initial guess at the number of features per word, updated after each essay
+        est_feats_per_wd = 32
+
+        def grow(arr):
+            new_arr = np.empty(2 * len(arr), dtype=arr.dtype)
+            new_arr[:len(arr)] = arr
+            return new_arr
+
+        transformed = []
+        for essay_ix, essay in enumerate(essays):
+            t_essay = []
+            t_essay_obj = Essay(essay.name, t_essay)
+            transformed.append(t_essay_obj)
+
+            num_wds = sum(map(len, essay.sentences))
+            indptr  = np.zeros(num_wds + 1, dtype=np.int64)
+            indices = np.empty(max(1, num_wds * est_feats_per_wd), dtype=np.int32)
+            data    = np.empty(len(indices), dtype=np.float64)
+
+            nnz, row = 0, 0
+            for sent_ix, taggged_sentence in enumerate(essay.sentences):
+                t_sentence = []
+                t_essay.append(t_sentence)
+
+                word_feats = self.__sentence_features_(taggged_sentence, sent_ix, essay)
+                for (wd, tags), fn_feats in zip(taggged_sentence, word_feats):
+                    word = Word(wd, tags)
+                    for d in fn_feats:
+                        for feat, val in d.items():
+                            if nnz == len(indices):
+                                indices, data = grow(indices), grow(data)
+                            feat_id, sign = hash_feature(feat, n_features)
+                            indices[nnz] = feat_id
+                            data[nnz] = sign * val
+                            nnz += 1
+                    row += 1
+                    indptr[row] = nnz
+                    t_sentence.append(word)
+
+            xs = sp.csr_matrix((data[:nnz], indices[:nnz], indptr), shape=(num_wds, n_features))
+            # colliding features are summed
+            xs.sum_duplicates()
+            t_essay_obj.hashed_features = xs
+            if isinstance(essays, EssayStore):
+                # lets flatten_to_wordlevel_feat_tags read the tags straight from the store
+                t_essay_obj.store, t_essay_obj.essay_ix = essays, essay_ix
+            est_feats_per_wd = max(1, int(np.ceil(nnz / float(max(1, num_wds)))))
+        return transformed
+
+    def __transform_blocks_(self, essays):
+
+        fns = self.feature_extractor_fns
+        n_features = 2 ** self.hash_bits if self.hash_bits else None
+        # feature -> column, per extractor (when not hashing)
+        vocabs  = [{} for _ in fns]
+        indices = [[] for _ in fns]
+        data    = [[] for _ in fns]
+        indptrs = [[0] for _ in fns]
+
+        for essay in essays:
+            for sent_ix, taggged_sentence in enumerate(essay.sentences):
+                for fn_feats in self.__sentence_features_(taggged_sentence, sent_ix, essay):
+                    for fn_ix, d in enumerate(fn_feats):
+                        fn_indices, fn_data, vocab = indices[fn_ix], data[fn_ix], vocabs[fn_ix]
+                        for feat, val in d.items():
+                            if n_features:
+                                feat_id, sign = hash_feature(feat, n_features)
+                                val *= sign
+                            else:
+                                if isinstance(val, basestring):
+                                    # one hot encoded, as DictVectorizer does
+                                    feat, val = "%s=%s" % (feat, val), 1
+                                feat_id = vocab.get(feat)
+                                if feat_id is None:
+                                    feat_id = vocab[feat] = len(vocab)
+                            fn_indices.append(feat_id)
+                            fn_data.append(val)
+                        indptrs[fn_ix].append(len(fn_indices))
+
+        blocks = []
+        for fn_ix, fn in enumerate(fns):
+            n_cols = n_features if n_features else len(vocabs[fn_ix])
+            xs = sp.csr_matrix((np.asarray(data[fn_ix], dtype=np.float64),
+                                np.asarray(indices[fn_ix], dtype=np.int32),
+                                np.asarray(indptrs[fn_ix], dtype=np.int64)),
+                               shape=(len(indptrs[fn_ix]) - 1, n_cols))
+            feature_names = None
+            if not n_features:
+                feature_names = [None] * n_cols
+                for feat, col in vocabs[fn_ix].items():
+                    feature_names[col] = feat
+            else:
+                # colliding features are summed
+                xs.sum_duplicates()
+            blocks.append(FeatureBlock(function_name(fn), xs, feature_names))
+        return blocks
@@ -3,25 +3,63 @@ __author__ = 'simon.hughes'
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.base import TransformerMixin, BaseEstimator
 from collections import defaultdict
+from itertools import islice
+import heapq
+import os
+import shutil
+import tempfile
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+import numpy as np
+import scipy.sparse as sp
+
+# defaults for the streaming mode
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_MAX_COUNTER_SIZE = 1000000
+# ((key, feature name), count) pairs per pickle in a spill file
+SPILL_BLOCK_SIZE = 10000
 
 class FeatureVectorizer(BaseEstimator, TransformerMixin):
     """ Class to filter features by frequency and vectorize
     """
-    def __init__(self, min_feature_freq, sparse=False):
+    def __init__(self, min_feature_freq, sparse=False, streaming=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_counter_size=DEFAULT_MAX_COUNTER_SIZE, spill_folder=None):
         """ Parameters
             ----------
             min_feature_freq : int
                 Minimum feature frequency to retain to reduce dimensionality
+            sparse : bool
+                Return a sparse matrix from transform
+            streaming : bool
+                Fit and transform from any iterable of dictionaries (e.g. a generator) in bounded memory.
+                The feature counts are spilled to disk when they grow beyond max_counter_size features, and
+                transform builds the matrix chunk_size dictionaries at a time
+            chunk_size : int
+                (streaming) number of dictionaries vectorized at a time
+            max_counter_size : int
+                (streaming) maximum number of distinct features counted in memory
+            spill_folder : str (optional)
+                (streaming) folder for the spilled counts, defaults to the system temp folder
         """
         self.min_feature_freq = min_feature_freq
+        self.sparse = sparse
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.max_counter_size = max_counter_size
+        self.spill_folder = spill_folder
         self.vectorizer = DictVectorizer(sparse=sparse)
+        # set when fit on hashed features (see FeatureExtractorTransformer's hash_bits)
+        self.frequent_columns = None
 
     def fit(self, X, Y=None):
         """ Transform an array dictionaries into a numpy array
 
             Parameters
             ----------
-            X : array-like - a list or tuple of dictionaries
+            X : array-like - a list or tuple of dictionaries, or a sparse matrix of hashed features
                 features to vectorize
 
             Returns
@@ -29,6 +67,11 @@ class FeatureVectorizer(BaseEstimator, TransformerMixin):
             X_new : numpy array of shape [n_samples, n_features_new]
                 Transformed array
         """
+        if sp.issparse(X):
+            return self.__fit_hashed_(X)
+        if self.streaming:
+            return self.__fit_streaming_(X)
+
         # Get items above the frequency threshold
         feature_freq = defaultdict(int)
         for dct in X:
@@ -56,6 +99,137 @@ class FeatureVectorizer(BaseEstimator, TransformerMixin):
 
             Parameters
             ----------
-            X : array-like list or tuple of dictionaries
+            X : array-like list or tuple of dictionaries, or a sparse matrix of hashed features
         """
-        return self.vectorizer.transform(X)
\ No newline at end of file
+        if sp.issparse(X):
+            return self.__transform_hashed_(X)
+        if self.streaming:
+            return self.__transform_streaming_(X)
+        return self.vectorizer.transform(X)
+
+    def fit_transform(self, X, y=None):
+        if self.streaming and not sp.issparse(X) and iter(X) is X:
+            raise ValueError("fit_transform needs to iterate X twice in streaming mode, "
+                             "pass a list or other re-iterable collection rather than an iterator")
+        return super(FeatureVectorizer, self).fit_transform(X, y)
+
+    def __fit_hashed_(self, X):
+        # number of rows each hashed column is non-zero in
+        feature_freq = np.asarray((X != 0).sum(axis=0)).ravel()
+        self.frequent_columns = np.where(feature_freq >= self.min_feature_freq)[0]
+        return self
+
+    def __transform_hashed_(self, X):
+        xs = sp.csr_matrix(X)[:, self.frequent_columns]
+        if not self.sparse:
+            return xs.toarray()
+        return xs
+
+    """ Streaming """
+    def __feature_name_(self, k, v):
+        # as DictVectorizer, string values are one hot encoded
+        if isinstance(v, basestring):
+            return "%s%s%s" % (k, self.vectorizer.separator, v)
+        return k
+
+    def __fit_streaming_(self, X):
+        folder = tempfile.mkdtemp(prefix="featurevectorizer_", dir=self.spill_folder)
+        try:
+            feature_freq = defaultdict(int)
+            spill_files = []
+            for dct in X:
+                for k, v in dct.items():
+                    # min_feature_freq applies to keys, as in the default mode, so count each (key, feature name)
+                    # pair: a frequent key keeps the one hot features of all of its string values
+                    feature_freq[(k, self.__feature_name_(k, v))] += 1
+                if len(feature_freq) > self.max_counter_size:
+                    spill_files.append(__spill_counts__(feature_freq, folder, len(spill_files)))
+                    feature_freq = defaultdict(int)
+
+            runs = [__read_counts__(fname) for fname in spill_files] + [iter(sorted(feature_freq.items()))]
+            frequent = __frequent_features__(heapq.merge(*runs), self.min_feature_freq)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        self.frequent = set(frequent)
+        # set the fitted state of the vectorizer directly, rather than fitting it on a filtered copy of X
+        self.vectorizer.feature_names_ = frequent
+        self.vectorizer.vocabulary_ = dict((f, i) for i, f in enumerate(frequent))
+        return self
+
+    def __transform_streaming_(self, X):
+        vocab = self.vectorizer.vocabulary_
+        dtype = self.vectorizer.dtype
+        indices, data, row_lengths = [], [], []
+        it = iter(X)
+        while True:
+            chunk = list(islice(it, self.chunk_size))
+            if not chunk:
+                break
+            chunk_indices, chunk_data, chunk_lengths = [], [], []
+            for dct in chunk:
+                length = 0
+                for k, v in dct.items():
+                    if isinstance(v, basestring):
+                        k, v = self.__feature_name_(k, v), 1
+                    ix = vocab.get(k)
+                    if ix is not None:
+                        chunk_indices.append(ix)
+                        chunk_data.append(v)
+                        length += 1
+                chunk_lengths.append(length)
+            # only the current chunk is held as python objects
+            indices.append(np.asarray(chunk_indices, dtype=np.int32))
+            data.append(np.asarray(chunk_data, dtype=dtype))
+            row_lengths.append(np.asarray(chunk_lengths, dtype=np.int64))
+
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+        data = np.concatenate(data) if data else np.zeros(0, dtype=dtype)
+        row_lengths = np.concatenate(row_lengths) if row_lengths else np.zeros(0, dtype=np.int64)
+        indptr = np.zeros(len(row_lengths) + 1, dtype=np.int64)
+        np.cumsum(row_lengths, out=indptr[1:])
+
+        xs = sp.csr_matrix((data, indices, indptr), shape=(len(row_lengths), len(vocab)))
+        xs.sum_duplicates()
+        if not self.sparse:
+            return xs.toarray()
+        return xs
+
+def __spill_counts__(feature_freq, folder, file_num):
+    """ Writes the counts to disk, sorted by (key, feature name), in blocks of SPILL_BLOCK_SIZE """
+    fname = os.path.join(folder, "counts_%i.p" % file_num)
+    items = sorted(feature_freq.items())
+    with open(fname, "wb") as f:
+        for start in range(0, len(items), SPILL_BLOCK_SIZE):
+            pickle.dump(items[start:start + SPILL_BLOCK_SIZE], f, protocol=pickle.HIGHEST_PROTOCOL)
+    return fname
+
+def __read_counts__(fname):
+    """ Yields the ((key, feature name), count) pairs from a spill file, one block at a time """
+    with open(fname, "rb") as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            for item in block:
+                yield item
+
+def __frequent_features__(sorted_counts, min_feature_freq):
+    """ Sums the counts of each key over the (merged, sorted) runs of ((key, feature name), count) pairs,
+        returning the feature names of the frequent keys in order (as DictVectorizer.feature_names_)
+    """
+    frequent = []
+    first, current, count, names = True, None, 0, []
+    for (k, name), v in sorted_counts:
+        if first or k != current:
+            if not first and count >= min_feature_freq:
+                frequent.extend(names)
+            first, current, count, names = False, k, 0, []
+        count += v
+        # the same name can be in several runs
+        if not names or names[-1] != name:
+            names.append(name)
+    if not first and count >= min_feature_freq:
+        frequent.extend(names)
+    return sorted(frequent)
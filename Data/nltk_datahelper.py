@@ -1,12 +1,33 @@
 # coding=utf-8
 from collections import defaultdict
 from IterableFP import flatten
+from essaystore import EssayStore
 
 INSIDE = "I"
 OUTSIDE = "O"
 
+# Iterates the sentences of the essays as (words, tags) pairs, applying projection to the words.
+# For an EssayStore, the projection is applied once per word in the vocabulary, and the tag sets
+# are shared between words, rather than being computed per word
+def __projected_sentences__(essays, projection):
+    if isinstance(essays, EssayStore):
+        projected_vocab = [projection(wd) for wd in essays.vocab]
+        for sent_ix in range(essays.num_sentences):
+            start, end = essays.sentence_token_range(sent_ix)
+            words = [projected_vocab[wix] for wix in essays.token_ids[start:end].tolist()]
+            yield words, essays.sentence_tags(sent_ix)
+    else:
+        for essay in essays:
+            for sentence in essay.sentences:
+                yield [projection(wd) for wd, tags in sentence], [tags for wd, tags in sentence]
+
 # Computes the frequencies of each essay tag
 def tally_code_frequencies(tagged_essays):
+    if isinstance(tagged_essays, EssayStore):
+        # number of sentences containing each tag
+        sent_freq = tagged_essays.sentence_tag_matrix(tagged_essays.tags).sum(axis=0)
+        return defaultdict(int, ((tag, int(cnt)) for tag, cnt in zip(tagged_essays.tags, sent_freq) if cnt > 0))
+
     freq = defaultdict(int)
     all_codes = set()
     for essay in tagged_essays:
@@ -23,17 +44,15 @@ def tally_code_frequencies(tagged_essays):
 # tagged sentence is a list of tuples of (word, (INSIDE\OUTSIDE)
 def to_tagged_sentences_by_code(essays, codes, projection = lambda x:x):
     code2sents = defaultdict(list)
-    for essay in essays:
-        for i, sentence in enumerate(essay.sentences):
-            for code in codes:
-                sent = []
-                for wd, tags in sentence:
-                    wd = projection(wd)
-                    if code in tags:
-                        sent.append((wd, INSIDE))
-                    else:
-                        sent.append((wd, OUTSIDE))
-                code2sents[code].append(sent)
+    for words, sent_tags in __projected_sentences__(essays, projection):
+        for code in codes:
+            sent = []
+            for wd, tags in zip(words, sent_tags):
+                if code in tags:
+                    sent.append((wd, INSIDE))
+                else:
+                    sent.append((wd, OUTSIDE))
+            code2sents[code].append(sent)
     return code2sents
 
 # Takes a list of essay objects and a list of target codes,
@@ -43,19 +62,17 @@ def to_tagged_sentences_by_code(essays, codes, projection = lambda x:x):
 def to_most_common_code_tagged_sentences(essays, codes, code_freq, projection = lambda x:x):
     codes = set(codes)
     tagged = []
-    for essay in essays:
-        for i, sentence in enumerate(essay.sentences):
-            sent = []
-            for wd, tags in sentence:
-                wd = projection(wd)
-                # filter to target codes only
-                tags = codes.intersection(tags)
-                if len(tags) > 0:
-                    most_common = max(tags, key = lambda tag: code_freq[tag])
-                    sent.append((wd, most_common))
-                else:
-                    sent.append((wd, OUTSIDE))
-            tagged.append(sent)
+    for words, sent_tags in __projected_sentences__(essays, projection):
+        sent = []
+        for wd, tags in zip(words, sent_tags):
+            # filter to target codes only
+            tags = codes.intersection(tags)
+            if len(tags) > 0:
+                most_common = max(tags, key = lambda tag: code_freq[tag])
+                sent.append((wd, most_common))
+            else:
+                sent.append((wd, OUTSIDE))
+        tagged.append(sent)
     return tagged
 
 # Takes a list of essay objects and a list of target codes,
@@ -65,19 +82,17 @@ def to_most_common_code_tagged_sentences(essays, codes, code_freq, projection =
 def to_label_powerset_tagged_sentences(essays, codes, projection = lambda x:x):
     codes = set(codes)
     tagged = []
-    for essay in essays:
-        for i, sentence in enumerate(essay.sentences):
-            sent = []
-            for wd, tags in sentence:
-                wd = projection(wd)
-                # filter to target codes only
-                isect_tags = ",".join(sorted(codes.intersection(tags)))
-                if len(isect_tags) > 0:
-                    # append as powerset label
-                    sent.append((wd, isect_tags))
-                else:
-                    sent.append((wd, OUTSIDE))
-            tagged.append(sent)
+    for words, sent_tags in __projected_sentences__(essays, projection):
+        sent = []
+        for wd, tags in zip(words, sent_tags):
+            # filter to target codes only
+            isect_tags = ",".join(sorted(codes.intersection(tags)))
+            if len(isect_tags) > 0:
+                # append as powerset label
+                sent.append((wd, isect_tags))
+            else:
+                sent.append((wd, OUTSIDE))
+        tagged.append(sent)
     return tagged
 
 # Takes a set of tagged sentences (lists of tuples) and returns a list of sentences (list of tokens)
@@ -34,6 +34,8 @@ def fact_composite_feature_extractor(extraction_fns):
             fts = fn(tokens, idx)
             feats.extend(fts)
         return feats
+    # identifies the feature configuration, e.g. for caching the extracted features (see crf_feature_store)
+    composite_feature_extractor.func_name = "composite_feature_extractor[%s]" % ", ".join(fn.func_name for fn in extraction_fns)
     return composite_feature_extractor
 
 def fact_extract_positional_word_features(offset, positional=True, stem_words=False):
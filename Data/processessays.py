@@ -1,7 +1,7 @@
 
 from collections import defaultdict
 from SpellingCorrector import SpellingCorrector
-from Decorators import memoize
+from Decorators import memoize_bounded
 from nltk import PorterStemmer
 from nltk.corpus import stopwords
 from IterableFP import flatten
@@ -17,7 +17,7 @@ class Sentence(object):
         self.tagged_words = tagged_words
 
 
-def build_spelling_corrector(essays, lower_case, wd_sent_freq, folder=None):
+def build_spelling_corrector(essays, lower_case, wd_sent_freq, folder=None, build_index=True):
     all_words = []
     for essay in essays:
         for sentence in essay.tagged_sentences:
@@ -30,7 +30,11 @@ def build_spelling_corrector(essays, lower_case, wd_sent_freq, folder=None):
                     unique_wds.add(w)
                     wd_sent_freq[w] += 1
 
-    return SpellingCorrector(all_words, folder=folder)
+    corrector = SpellingCorrector(all_words, folder=folder)
+    if build_index:
+        # pickled along with the corrector, e.g. in the annotator bundle
+        corrector.build_index()
+    return corrector
 
 
 def process_essays(essays, min_df = 5,
@@ -55,13 +59,13 @@ def process_essays(essays, min_df = 5,
 
     if spelling_corrector is None:
         wd_sent_freq = defaultdict(int)
-        corrector = build_spelling_corrector(essays, lower_case, wd_sent_freq)
+        corrector = build_spelling_corrector(essays, lower_case, wd_sent_freq, build_index=spelling_correct)
     else:
         corrector = spelling_corrector
 
     corrections = defaultdict(int)
 
-    @memoize
+    @memoize_bounded()
     def correct_word(w):
         if len(w) > 2:
             if w.startswith("'") or w.startswith("\""):
@@ -78,7 +82,7 @@ def process_essays(essays, min_df = 5,
             cw = corrector.correct(w)
         return cw
 
-    @memoize
+    @memoize_bounded()
     def is_valid_wd(wd):
         wd = wd.strip()
         if wd in {".","?","!"}:
@@ -89,7 +93,7 @@ def process_essays(essays, min_df = 5,
             return True
         return False
 
-    @memoize
+    @memoize_bounded()
     def process_word(w):
 
         # Remove quotes at the start and end
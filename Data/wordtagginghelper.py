@@ -1,8 +1,15 @@
 __author__ = 'simon.hughes'
 from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
 
 import numpy as np
 import scipy
+import scipy.sparse
+import joblib
+from joblib import Parallel, delayed
 
 from IterableFP import flatten
 from processessays import Essay
@@ -21,8 +28,12 @@ def flatten_to_wordlevel_feat_tags(essay_feats):
     Returns
     -------
     feats, tags : a 2 tuple of a list of feature dictionaries and a list of sets of tags
-        The flattened features and tags from the essay words
+        The flattened features and tags from the essay words. If the features were hashed
+        (see FeatureExtractorTransformer's hash_bits), feats is a single CSR matrix instead
     """
+    if len(essay_feats) > 0 and getattr(essay_feats[0], "hashed_features", None) is not None:
+        return flatten_to_wordlevel_hashed_feat_tags(essay_feats)
+
     feats = []
     tags = []
     for essay_ix, essay in enumerate(essay_feats):
@@ -32,6 +43,32 @@ def flatten_to_wordlevel_feat_tags(essay_feats):
                 tags.append(wd.tags)
     return feats, tags
 
+def flatten_to_wordlevel_hashed_feat_tags(essay_feats):
+    """
+    Splits the essay-level hashed features into word level features for tagging
+
+    Parameters
+    ----------
+    essay_feats : a list of Essay objects with hashed_features
+        Essays transformed by a FeatureExtractorTransformer with hash_bits set
+
+    Returns
+    -------
+    feats, tags : a 2 tuple of a CSR matrix (one row per word) and a list of sets of tags
+    """
+    tags = []
+    for essay_ix, essay in enumerate(essay_feats):
+        store = getattr(essay, "store", None)
+        if store is not None:
+            # transformed from an EssayStore - the tag sets are shared between words
+            tags.extend(store.word_tags(*store.essay_token_range(essay.essay_ix)))
+            continue
+        for sent_ix, taggged_sentence in enumerate(essay.sentences):
+            for word_ix, (wd) in enumerate(taggged_sentence):
+                tags.append(wd.tags)
+    feats = scipy.sparse.vstack([essay.hashed_features for essay in essay_feats], format="csr")
+    return feats, tags
+
 def flatten_to_wordlevel_vectors_tags(essay_feats, sparse=True):
     """
     Splits the essay-level features into
@@ -251,8 +288,36 @@ class always_false(object):
     def decision_function(self, x):
         return -1.0 * np.ones((x.shape[0],), dtype=np.float64)
 
-#TODO Parallelize
-def train_classifier_per_code(xs, ysByCode, fn_create_cls, tags=None, verbose=True):
+@contextmanager
+def memmapped(xs):
+    """
+    Dumps xs to a temporary file and re-loads it memory-mapped, so that worker processes
+    receive a reference to the file rather than a pickled copy of xs
+
+    Parameters
+    ----------
+    xs : numpy array or scipy sparse matrix
+
+    Returns
+    -------
+    a copy-on-write memory-mapped version of xs (the file is removed on exit)
+    """
+    folder = tempfile.mkdtemp(prefix="wordtagginghelper_")
+    try:
+        fname = os.path.join(folder, "xs.pkl")
+        joblib.dump(xs, fname)
+        # copy on write, as some estimators write to their inputs
+        yield joblib.load(fname, mmap_mode="c")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def __fit_classifier_(code, xs, ys, cls, verbose):
+    if verbose:
+        print("Training for :" + code)
+    cls.fit(xs, ys)
+    return cls
+
+def train_classifier_per_code(xs, ysByCode, fn_create_cls, tags=None, verbose=True, n_jobs=1):
     """
     Trains an instance of the classifier per code in codes
 
@@ -266,6 +331,9 @@ def train_classifier_per_code(xs, ysByCode, fn_create_cls, tags=None, verbose=Tr
         factory function to create the classifier
     tags : (optional) a collection of str
         Tags to classify - can be used to filter ysByCode
+    n_jobs : (optional) int
+        Number of worker processes to fit the classifiers with. xs is memory-mapped and shared
+        with the workers. The classifiers are created in this process, so fn_create_cls can be a lambda
 
     Returns
     -------
@@ -277,15 +345,34 @@ def train_classifier_per_code(xs, ysByCode, fn_create_cls, tags=None, verbose=Tr
     if tags == None:
         tags = ysByCode.keys()
     tag2classifier = OrderedDict()
+    if n_jobs == 1:
+        for code in sorted(tags):
+            if verbose:
+                print("Training for :" + code)
+            ys = np.asarray(ysByCode[code])
+            if len(ys) == 0 or max(ys) == 0:
+                cls = always_false()
+            else:
+                cls = fn_create_cls()
+                cls.fit(xs, ys)
+            tag2classifier[code] = cls
+        return tag2classifier
+
+    to_fit = []
     for code in sorted(tags):
-        if verbose:
-            print("Training for :" + code)
         ys = np.asarray(ysByCode[code])
         if len(ys) == 0 or max(ys) == 0:
-            cls = always_false()
+            tag2classifier[code] = always_false()
         else:
-            cls = fn_create_cls()
-            cls.fit(xs, ys)
+            # placeholder to preserve the sorted order
+            tag2classifier[code] = None
+            to_fit.append((code, ys))
+
+    with memmapped(xs) as mm_xs:
+        fitted = Parallel(n_jobs=n_jobs)(
+            delayed(__fit_classifier_)(code, mm_xs, ys, fn_create_cls(), verbose) for code, ys in to_fit)
+
+    for (code, _), cls in zip(to_fit, fitted):
         tag2classifier[code] = cls
     return tag2classifier
 
@@ -322,7 +409,7 @@ def probability_for_tag(tag, xs, codeToClassifier):
 def decision_function_for_tag(tag, xs, codeToClassifier):
     return codeToClassifier[tag].decision_function(xs)
 
-def test_classifier_per_code(xs, tagToClassifier, tags=None, predict_fn=predict_for_tag):
+def test_classifier_per_code(xs, tagToClassifier, tags=None, predict_fn=predict_for_tag, n_jobs=1):
     """
     Compute metrics over tagging data
 
@@ -336,6 +423,9 @@ def test_classifier_per_code(xs, tagToClassifier, tags=None, predict_fn=predict_
         List of tags to test over. Use ysByCode.keys() if none
     predict_fn : (tag,xs,codeToClassifier) => np.array
         A function to predict the labels for a given tag
+    n_jobs : (optional) int
+        Number of worker processes to predict with. xs is memory-mapped and shared with the workers,
+        and each worker is only sent the classifier for its tag. predict_fn must be a module level function
     Returns
     -------
     predictions_by_code : a pair of dict's mapping tags to their actual labels \ predictions
@@ -344,10 +434,20 @@ def test_classifier_per_code(xs, tagToClassifier, tags=None, predict_fn=predict_
         tags = tagToClassifier.keys()
 
     predictions_by_code = dict()
-    for tag in sorted(tags):
-        pred_ys = predict_fn(tag, xs, tagToClassifier)
-        predictions_by_code[tag] = pred_ys
-
+    if n_jobs == 1:
+        for tag in sorted(tags):
+            pred_ys = predict_fn(tag, xs, tagToClassifier)
+            predictions_by_code[tag] = pred_ys
+        return predictions_by_code
+
+    sorted_tags = sorted(tags)
+    with memmapped(xs) as mm_xs:
+        lst_pred_ys = Parallel(n_jobs=n_jobs)(
+            delayed(predict_fn)(tag, mm_xs, {tag: tagToClassifier[tag]}) for tag in sorted_tags)
+
+    for tag, pred_ys in zip(sorted_tags, lst_pred_ys):
+        # don't hand back arrays backed by the (deleted) temporary file
+        predictions_by_code[tag] = np.array(pred_ys)
     return predictions_by_code
 
 def essaysfeats_to_most_common_tags(essay_feats, tag_freq):
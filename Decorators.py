@@ -3,15 +3,10 @@
 """
 
 import time
-import os
-try:
-    import cPickle as pickle
-except:
-    import pickle
-
-from collections import defaultdict
-from argument_hasher import argument_hasher
-import hashlib
+import threading
+from collections import defaultdict, OrderedDict
+from functools import partial
+from artifact_cache import ArtifactCache, CacheStats
 
 def timeit(method):
 
@@ -112,34 +107,111 @@ def memoize(f):
             return ret
     return memo_dict(f)
 
-class memoize_to_disk(object):
+DEFAULT_MEMO_SIZE = 100000
+# for caches keyed on whole sentences (e.g. parses), whose values are large
+MAX_CACHED_SENTENCES = 10000
+
+def __freeze_(value):
+    """ Converts (nested) lists, dicts and sets to hashable equivalents """
+    if isinstance(value, (list, tuple)):
+        return tuple(__freeze_(v) for v in value)
+    elif isinstance(value, (dict, defaultdict)):
+        return tuple(sorted((k, __freeze_(v)) for k, v in value.items()))
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(__freeze_(v) for v in value)
+    return value
+
+def memo_key(args, kwargs):
+    """ Builds a tuple key for the arguments, only copying them when they are not hashable """
+    key = args
+    if kwargs:
+        key = args + (__KWARGS_MARKER__,) + tuple(sorted(kwargs.items()))
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return __freeze_(key)
+
+# separates the positional from the keyword arguments in a memo key
+__KWARGS_MARKER__ = object()
+
+class BoundedMemo(object):
+    """ A thread safe, least recently used cache of the results of func, holding at most max_size results """
+    def __init__(self, func, max_size=DEFAULT_MEMO_SIZE):
+        self.func = func
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self.__cache_ = OrderedDict()
+        self.__lock_ = threading.Lock()
+        self.func_name = getattr(func, "func_name", getattr(func, "__name__", "BoundedMemo"))
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls=None):
+        # decorated methods - the instance becomes part of the key
+        if obj is None:
+            return self
+        return partial(self.__call__, obj)
+
+    def __call__(self, *args, **kwargs):
+        key = memo_key(args, kwargs)
+        with self.__lock_:
+            if key in self.__cache_:
+                # move to the most recently used end
+                result = self.__cache_.pop(key)
+                self.__cache_[key] = result
+                self.stats.hits += 1
+                return result
+            self.stats.misses += 1
+
+        # don't hold the lock while computing the result, so slow or re-entrant functions don't block other threads
+        result = self.func(*args, **kwargs)
+        with self.__lock_:
+            self.__cache_[key] = result
+            self.stats.stores += 1
+            while len(self.__cache_) > self.max_size:
+                self.__cache_.popitem(last=False)
+                self.stats.evictions += 1
+        return result
+
+    def __len__(self):
+        return len(self.__cache_)
+
+    def clear(self):
+        with self.__lock_:
+            self.__cache_.clear()
+
+class memoize_bounded(object):
+    """ Memoization decorator holding at most max_size results, evicting the least recently used.
+        Use in place of memoize for functions called on an unbounded set of inputs (e.g. sentences).
+        The decorated function exposes .stats (hits, misses, evictions) and .clear()
+    """
+    def __init__(self, max_size=DEFAULT_MEMO_SIZE):
+        self.max_size = max_size
+
+    def __call__(self, f):
+        return BoundedMemo(f, self.max_size)
 
-    def __init__(self, filename_prefix, verbose=True):
+class memoize_to_disk(object):
+    """ Caches the results of the decorated function on disk, keyed on a stable hash of
+        ALL of its arguments (see artifact_cache.ArtifactCache)
+    """
+    def __init__(self, filename_prefix, verbose=True, compress=False, max_size_mb=None, version=None):
         self.filename_prefix = filename_prefix
         self.verbose = verbose
+        self.cache = ArtifactCache(filename_prefix, compress=compress, max_size_mb=max_size_mb, version=version)
 
     def __call__(self, f):
         # decorate f
+        cached_f = self.cache(f)
         def wrapped_f(*args, **kwargs):
-            # don't hash args, just kwargs
-            s_pickle_key = "_".join(map(lambda tpl: tpl[0] + "_" + self.__value2str__(tpl[1]), sorted(kwargs.items())))
-            # hash long filesnames
-            #if len(pickle_key) > 225:
+            hits = self.cache.stats.hits
+            result = cached_f(*args, **kwargs)
             if self.verbose:
-                print("Pickle Key:", s_pickle_key)
-
-            pickle_key = str(hash(s_pickle_key))
-            pickle_file = self.filename_prefix + pickle_key
-            if os.path.exists(pickle_file):
-                return pickle.load(open(pickle_file, "r+"))
-            result = f(*args, **kwargs)
-            pickle.dump(result, open(pickle_file, "w+"))
+                print("memoize_to_disk: %s %s (%s)" % (f.__name__, "hit" if self.cache.stats.hits > hits else "miss", str(self.cache.stats)))
             return result
+        wrapped_f.cache = self.cache
         return wrapped_f
 
-    def __value2str__(self, value):
-        return argument_hasher(value)
-
 if __name__ == "__main__":
 
     import time
@@ -9,7 +9,7 @@ from nltk_featureextractionfunctions import stem
 
 from collections import defaultdict
 
-from nltk.tag.hmm import HiddenMarkovModelTrainer
+from hmm_tagger import HMMTrainer
 from wordtagginghelper import merge_dictionaries
 from nltk_datahelper import to_sentences, to_flattened_binary_tags, to_tagged_sentences_by_code
 
@@ -85,7 +85,7 @@ for fold, (essays_TD, essays_VD) in enumerate(folds):
         print("Fold %i Training code: %s" % (fold, code))
         td, vd = td_sents_by_code[code], vd_sents_by_code[code]
 
-        trainer = HiddenMarkovModelTrainer()
+        trainer = HMMTrainer()
         model = trainer.train_supervised(td)
         code2model[code] = model
 
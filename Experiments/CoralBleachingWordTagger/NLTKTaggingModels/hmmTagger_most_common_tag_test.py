@@ -10,7 +10,7 @@ from nltk_featureextractionfunctions import *
 from collections import defaultdict
 from joblib import Parallel, delayed
 
-from nltk.tag.hmm import HiddenMarkovModelTrainer
+from hmm_tagger import HMMTrainer
 from wordtagginghelper import merge_dictionaries
 from nltk_datahelper import to_sentences, to_flattened_binary_tags_by_code, tally_code_frequencies, \
     to_most_common_code_tagged_sentences
@@ -37,7 +37,7 @@ def train_classifer_on_fold(essays_TD, essays_VD, regular_tags, fold):
     td_sents = to_most_common_code_tagged_sentences(essays_TD, regular_tags, code_freq, projection=projection)
     vd_sents = to_most_common_code_tagged_sentences(essays_VD, regular_tags, code_freq, projection=projection)
 
-    trainer = HiddenMarkovModelTrainer()
+    trainer = HMMTrainer()
     model = trainer.train_supervised(td_sents)
 
     td_predictions = model.tag_sents(to_sentences(td_sents))
@@ -10,7 +10,7 @@ from nltk_featureextractionfunctions import *
 from collections import defaultdict
 from joblib import Parallel, delayed
 
-from nltk.tag.crf import CRFTagger
+from crf_feature_store import FeatureStoreCRFTagger, build_feature_store
 from wordtagginghelper import merge_dictionaries
 from nltk_datahelper import to_sentences, to_flattened_binary_tags_by_code, to_most_common_code_tagged_sentences, \
     tally_code_frequencies
@@ -32,7 +32,8 @@ def train_classifer_on_fold(essays_TD, essays_VD, regular_tags, fold, code_freq,
 
     model_filename = models_folder + "/" + "%i_%s__%s" % (fold, "most_freq_code", str(randint(0, 9999999)))
 
-    model = CRFTagger(feature_func=comp_feat_extactor, verbose=False, training_opt=training_opt)
+    # features come from the store built (once) below, shared by all folds and hyper parameter settings
+    model = FeatureStoreCRFTagger(feature_store, verbose=False, training_opt=training_opt)
     model.train(td_sents, model_filename)
 
     td_predictions = model.tag_sents(to_sentences(td_sents))
@@ -77,6 +78,7 @@ root_folder =           settings.data_directory + "CoralBleaching/Thesis_Dataset
 folder =                            root_folder + "Training/"
 processed_essay_filename_prefix =   root_folder + "Pickled/essays_proc_pickled_"
 features_filename_prefix =          root_folder + "Pickled/feats_pickled_"
+crf_features_filename_prefix =      root_folder + "Pickled/crf_feats_pickled_"
 
 models_folder = settings.data_directory + "CoralBleaching/models/CRF"
 
@@ -114,6 +116,9 @@ extractors = [
 ]
 
 comp_feat_extactor = fact_composite_feature_extractor(extractors)
+# extract the features of every sentence once, rather than for every fold x hyper parameter setting
+feature_store = build_feature_store(comp_feat_extactor, tagged_essays, filename_prefix=crf_features_filename_prefix)
+logger.info("Features extracted")
 
 code_freq = tally_code_frequencies(tagged_essays)
 folds = cross_validation(tagged_essays, CV_FOLDS)
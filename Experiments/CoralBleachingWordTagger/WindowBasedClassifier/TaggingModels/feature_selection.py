@@ -1,8 +1,9 @@
 # coding=utf-8
 from Decorators import memoize_to_disk
-from load_data import load_process_essays, extract_features
+from load_data import load_process_essays
 
 from featurevectorizer import FeatureVectorizer
+from feature_block_store import FeatureBlockStore
 from featureextractionfunctions import *
 from CrossValidation import cross_validation
 from wordtagginghelper import *
@@ -44,6 +45,7 @@ root_folder = settings.data_directory + "CoralBleaching/Thesis_Dataset/"
 folder =                            root_folder + "Training/"
 processed_essay_filename_prefix =   root_folder + "Pickled/essays_proc_pickled_"
 features_filename_prefix =          root_folder + "Pickled/feats_pickled_"
+feature_blocks_filename_prefix =    root_folder + "Pickled/feat_blocks_pickled_"
 
 config = get_config(folder)
 
@@ -53,6 +55,8 @@ tagged_essays = mem_process_essays( **config )
 logger.info("Essays loaded")
 """ End load Essays """
 
+feature_block_store = FeatureBlockStore(filename_prefix=feature_blocks_filename_prefix)
+
 def evaluate_window_size(config, window_size, features_filename_prefix):
 
     config["window_size"] = window_size
@@ -133,12 +137,9 @@ def evaluate_window_size(config, window_size, features_filename_prefix):
 def evaluate_feature_set(config, existing_extractors, new_extractor, features_filename_prefix):
 
     feat_extractors = existing_extractors + [new_extractor]
-    feat_config = dict(config.items() + [("extractors", feat_extractors)])
     """ LOAD FEATURES """
-    # most params below exist ONLY for the purposes of the hashing to and from disk
-    #mem_extract_features = memoize_to_disk(filename_prefix=features_filename_prefix, verbose=False)(extract_features)
-    #essay_feats = mem_extract_features(tagged_essays, **feat_config)
-    essay_feats = extract_features(tagged_essays, **feat_config)
+    # only the new extractor's features are extracted, the others are cached per extractor
+    essay_feats = feature_block_store.transform(tagged_essays, feat_extractors)
     """ DEFINE TAGS """
     _, lst_all_tags = flatten_to_wordlevel_feat_tags(essay_feats)
     regular_tags = list(set((t for t in flatten(lst_all_tags) if t[0].isdigit())))
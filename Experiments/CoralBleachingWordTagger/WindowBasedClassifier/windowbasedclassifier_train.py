@@ -22,6 +22,8 @@ from sklearn.lda import LDA
 
 from window_based_tagger_config import get_config
 from model_store import ModelStore
+from annotator_bundle import build_annotator_bundle
+from BrattEssay import load_bratt_essays
 
 # END Classifiers
 
@@ -146,4 +148,10 @@ sent_td_xs, sent_td_ys_bycode = get_sent_feature_for_stacking_from_tagging_model
 tag2sent_classifier = train_classifier_per_code(sent_td_xs, sent_td_ys_bycode , fn_create_sent_cls, sent_output_train_test_tags)
 
 """ Persist Models """
-model_store.store(feature_transformer, tag2word_classifier, tag2sent_classifier)
\ No newline at end of file
+model_store.store(feature_transformer, tag2word_classifier, tag2sent_classifier)
+
+""" Persist Annotator Bundle (so the API can start without re-parsing the essays) """
+raw_essays = load_bratt_essays(folder, include_vague=config["include_vague"], include_normal=config["include_normal"], load_annotations=True)
+bundle = build_annotator_bundle(raw_essays, config, settings.root_path + "Data/PublicDataSets/",
+                                feature_transformer, tag2word_classifier, tag2sent_classifier)
+model_store.store_annotator_bundle(bundle)
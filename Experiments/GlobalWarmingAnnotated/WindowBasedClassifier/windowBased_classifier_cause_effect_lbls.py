@@ -4,9 +4,8 @@ from TagTransformer import replace_periods
 from sent_feats_for_stacking import *
 from load_data import load_process_essays, extract_features
 
-from featurevectorizer import FeatureVectorizer
 from featureextractionfunctions import *
-from CrossValidation import cross_validation
+from stacked_cv_runner import cross_validate_stacked_tagger
 from wordtagginghelper import *
 from IterableFP import flatten
 from predictions_to_file import predictions_to_file
@@ -134,63 +133,23 @@ if type(fn_create_sent_cls()) == GradientBoostingClassifier:
 f_output_file = open(out_predictions_file, "w+")
 f_output_file.write("Essay|Sent Number|Processed Sentence|Concept Codes|Predictions\n")
 
-# Gather metrics per fold
-cv_wd_td_ys_by_tag, cv_wd_td_predictions_by_tag = defaultdict(list), defaultdict(list)
-cv_wd_vd_ys_by_tag, cv_wd_vd_predictions_by_tag = defaultdict(list), defaultdict(list)
-
-cv_sent_td_ys_by_tag, cv_sent_td_predictions_by_tag = defaultdict(list), defaultdict(list)
-cv_sent_vd_ys_by_tag, cv_sent_vd_predictions_by_tag = defaultdict(list), defaultdict(list)
-
-folds = cross_validation(essay_feats, CV_FOLDS)
-#TODO Parallelize
-for i,(essays_TD, essays_VD) in enumerate(folds):
-
-    # TD and VD are lists of Essay objects. The sentences are lists
-    # of featureextractortransformer.Word objects
-    print "\nFold %s" % i
-    print "Training Tagging Model"
-    """ Data Partitioning and Training """
-    td_feats, td_tags = flatten_to_wordlevel_feat_tags(essays_TD)
-    vd_feats, vd_tags = flatten_to_wordlevel_feat_tags(essays_VD)
-
-    feature_transformer = FeatureVectorizer(min_feature_freq=MIN_FEAT_FREQ, sparse=SPARSE_WD_FEATS)
-    td_X, vd_X = feature_transformer.fit_transform(td_feats), feature_transformer.transform(vd_feats)
-    wd_td_ys_bytag = get_wordlevel_ys_by_code(td_tags, wd_train_tags)
-    wd_vd_ys_bytag = get_wordlevel_ys_by_code(vd_tags, wd_train_tags)
-
-    """ TRAIN Tagger """
-    tag2word_classifier = train_classifier_per_code(td_X, wd_td_ys_bytag, fn_create_wd_cls, wd_train_tags)
-
-    """ TEST Tagger """
-    td_wd_predictions_by_code = test_classifier_per_code(td_X, tag2word_classifier, wd_test_tags)
-    vd_wd_predictions_by_code = test_classifier_per_code(vd_X, tag2word_classifier, wd_test_tags)
-
-    print "\nTraining Sentence Model"
-    """ SENTENCE LEVEL PREDICTIONS FROM STACKING """
-    sent_td_xs, sent_td_ys_bycode = get_sent_feature_for_stacking_from_tagging_model(sent_input_feat_tags, sent_input_interaction_tags, essays_TD, td_X, wd_td_ys_bytag, tag2word_classifier, SPARSE_SENT_FEATS, LOOK_BACK)
-    sent_vd_xs, sent_vd_ys_bycode = get_sent_feature_for_stacking_from_tagging_model(sent_input_feat_tags, sent_input_interaction_tags, essays_VD, vd_X, wd_vd_ys_bytag, tag2word_classifier, SPARSE_SENT_FEATS, LOOK_BACK)
-
-    """ Train Stacked Classifier """
-    tag2sent_classifier = train_classifier_per_code(sent_td_xs, sent_td_ys_bycode , fn_create_sent_cls, sent_output_train_test_tags)
-
-    """ Test Stack Classifier """
-    td_sent_predictions_by_code \
-        = test_classifier_per_code(sent_td_xs, tag2sent_classifier, sent_output_train_test_tags )
-
-    vd_sent_predictions_by_code \
-        = test_classifier_per_code(sent_vd_xs, tag2sent_classifier, sent_output_train_test_tags )
+def write_fold_predictions(fold, essays_VD, sent_vd_ys_bycode, vd_sent_predictions_by_code):
+    predictions_to_file(f_output_file, sent_vd_ys_bycode, vd_sent_predictions_by_code, essays_VD, codes=sent_output_train_test_tags)
 
-    merge_dictionaries(wd_td_ys_bytag, cv_wd_td_ys_by_tag)
-    merge_dictionaries(wd_vd_ys_bytag, cv_wd_vd_ys_by_tag)
-    merge_dictionaries(td_wd_predictions_by_code, cv_wd_td_predictions_by_tag)
-    merge_dictionaries(vd_wd_predictions_by_code, cv_wd_vd_predictions_by_tag)
+results = cross_validate_stacked_tagger(essay_feats, CV_FOLDS,
+                                        wd_train_tags, wd_test_tags,
+                                        sent_input_feat_tags, sent_input_interaction_tags, sent_output_train_test_tags,
+                                        fn_create_wd_cls, fn_create_sent_cls,
+                                        min_feat_freq=MIN_FEAT_FREQ, sparse_wd_feats=SPARSE_WD_FEATS,
+                                        sparse_sent_feats=SPARSE_SENT_FEATS, look_back=LOOK_BACK,
+                                        fn_on_fold_complete=write_fold_predictions)
 
-    merge_dictionaries(sent_td_ys_bycode, cv_sent_td_ys_by_tag)
-    merge_dictionaries(sent_vd_ys_bycode, cv_sent_vd_ys_by_tag)
-    merge_dictionaries(td_sent_predictions_by_code, cv_sent_td_predictions_by_tag)
-    merge_dictionaries(vd_sent_predictions_by_code, cv_sent_vd_predictions_by_tag)
+# Gather metrics per fold
+cv_wd_td_ys_by_tag, cv_wd_td_predictions_by_tag = results.cv_wd_td_ys_by_tag, results.cv_wd_td_predictions_by_tag
+cv_wd_vd_ys_by_tag, cv_wd_vd_predictions_by_tag = results.cv_wd_vd_ys_by_tag, results.cv_wd_vd_predictions_by_tag
 
-    predictions_to_file(f_output_file, sent_vd_ys_bycode, vd_sent_predictions_by_code, essays_VD, codes=sent_output_train_test_tags)
+cv_sent_td_ys_by_tag, cv_sent_td_predictions_by_tag = results.cv_sent_td_ys_by_tag, results.cv_sent_td_predictions_by_tag
+cv_sent_vd_ys_by_tag, cv_sent_vd_predictions_by_tag = results.cv_sent_vd_ys_by_tag, results.cv_sent_vd_predictions_by_tag
 
 f_output_file.close()
 # print results for each code
@@ -1,7 +1,7 @@
 __author__ = 'simon.hughes'
 
 from spacy.en import English
-from Decorators import memoize
+from Decorators import memoize_bounded, MAX_CACHED_SENTENCES
 from collections import defaultdict
 
 class BinaryRelation(object):
@@ -37,6 +37,12 @@ class Relation(object):
         self.__binary_relns_ = rels
         return rels
 
+class SentenceParse(object):
+    """ The parser output for a sentence used by the feature extractors """
+    def __init__(self, relations, brown_clusters):
+        self.relations = relations
+        self.brown_clusters = brown_clusters
+
 class Parser(object):
 
     def __init__(self):
@@ -46,6 +52,32 @@ class Parser(object):
         stokens = unicode(" ".join(tokens))
 
         tokens = self.__tokenize_(stokens)
+        return self.__relations_(tokens)
+
+    def parse_many(self, token_lists, batch_size=1000, n_threads=4):
+        """
+        Parses many sentences in one pass through spaCy's (multi-threaded) pipe, which is much
+        faster than calling parse for each sentence
+
+        Parameters
+        ----------
+        token_lists : iterable of list[str]
+            the tokenized sentences
+        batch_size : int
+            number of sentences spaCy processes per batch
+        n_threads : int
+            number of threads spaCy uses to parse each batch
+
+        Returns
+        -------
+        generator of SentenceParse : one per sentence, in the order given
+        """
+        texts = (unicode(" ".join(tokens)) for tokens in token_lists)
+        for doc in self.nlp.pipe(texts, batch_size=batch_size, n_threads=n_threads):
+            tokens = list(doc)
+            yield SentenceParse(self.__relations_(tokens), [str(t.cluster) for t in tokens])
+
+    def __relations_(self, tokens):
         children_for_head = defaultdict(set)
         for token in tokens:
             children_for_head[token.head.i].add(token.string.strip())
@@ -79,7 +111,7 @@ class Parser(object):
         # yields a list of (300,) dimensional numpy arrays
         return map(lambda t: t.repvec, tokens)
 
-    @memoize
+    @memoize_bounded(max_size=MAX_CACHED_SENTENCES)
     def __tokenize_(self, sentence):
         return list(self.nlp(sentence, tag=True, parse=True))
 
@@ -1,6 +1,7 @@
 from collections import defaultdict
 import numpy as np
 import scipy
+import scipy.sparse
 
 CAUSAL_REL   = "_CRel"
 RESULT_REL   = "_RRel"
@@ -33,110 +34,138 @@ def num_different_tags(pred):
             new_tag = False
     return cnt
 
-def get_sent_feature_for_stacking_from_tagging_model(sent_input_feats, interaction_tags, essays, word_feats, ys_bytag, tag2Classifier, sparse=False, look_back=0):
-
+def __predict_by_tag_(tags, word_feats, tag2Classifier):
     # dicts, key = tag, to a 1D array of word-level predictions
     real_num_predictions_bytag = dict()
     predictions_bytag = dict()
-    sent_input_feats = set(sent_input_feats)
-    for tag in sent_input_feats:
+    for tag in tags:
 
         cls = tag2Classifier[tag]
         if hasattr(cls, "decision_function"):
             real_num_predictions = cls.decision_function(word_feats)
         else:
-            real_num_predictions = cls.predict_proba(word_feats)
+            # one column per class (sorted, so the positive class is last), keep the positive class's probability
+            real_num_predictions = cls.predict_proba(word_feats)[:, -1]
         predictions = cls.predict(word_feats)
         real_num_predictions_bytag[tag] = real_num_predictions
         predictions_bytag[tag] = predictions
+    return real_num_predictions_bytag, predictions_bytag
+
+def __segment_reduce_(ufunc, matrix, sent_lens):
+    """ Applies ufunc over the rows of each sentence (sent_lens rows each, in order). Empty sentences get zeros """
+    reduced = np.zeros((len(sent_lens), matrix.shape[1]), dtype=matrix.dtype)
+    non_empty = sent_lens > 0
+    if non_empty.any():
+        # reduceat can't reduce an empty segment, so only the non empty sentences' starts are passed
+        starts = (np.cumsum(sent_lens) - sent_lens)[non_empty]
+        reduced[non_empty] = ufunc.reduceat(matrix, starts, axis=0)
+    return reduced
 
+def get_sent_feature_for_stacking_from_tagging_model(sent_input_feats, interaction_tags, essays, word_feats, ys_bytag, tag2Classifier, sparse=False, look_back=0):
+    """
+    Computes the sentence level features for the stacked sentence classifier from the word tagger's predictions:
+    the max and min real valued prediction and the max prediction of each tag over the sentence's words, followed
+    by the pairwise interactions of the predicted tags, and the features of the previous look_back sentences.
+    Sentences without words get all zero features and labels.
+
+    The word level predictions are stacked into (words x tags) matrices, and reduced over each sentence's rows in
+    one call per statistic, rather than sentence by sentence
+
+    Parameters
+    ----------
+    sent_input_feats : list[str]
+        tags whose word tagger predictions are used as features
+    interaction_tags : list[str]
+        tags whose pairwise (predicted) co-occurrence is used as a feature
+    essays : list[Essay]
+        essays whose sentences are lists of featureextractortransformer.Word objects
+    word_feats : matrix
+        word level features, one row per word in essays
+    ys_bytag : dict[str, np.array]
+        word level labels by tag
+    tag2Classifier : dict[str, BaseEstimator]
+        word tagger per tag
+    sparse : bool
+        return the features as a CSR matrix
+    look_back : int
+        number of previous sentences (in the same essay) whose features are appended
+
+    Returns
+    -------
+    xs, ys_by_code : the sentence features, and the sentence labels by tag
+    """
+    sent_lens = np.asarray([len(taggged_sentence) for essay in essays for taggged_sentence in essay.sentences], dtype=np.int64)
+    feat_tags = [tag for tag in ys_bytag.keys() if tag in set(sent_input_feats)]
+    real_num_predictions_bytag, predictions_bytag = __predict_by_tag_(feat_tags, word_feats, tag2Classifier)
+    num_sents = len(sent_lens)
+
+    """ Labels """
+    all_tags = list(ys_bytag.keys())
+    wd_ys = np.empty((sent_lens.sum(), len(all_tags)), dtype=np.int8)
+    for col, tag in enumerate(all_tags):
+        wd_ys[:, col] = np.asarray(ys_bytag[tag]) > 0
+    sent_ys = __segment_reduce_(np.maximum, wd_ys, sent_lens) > 0
+    tag_col = dict((tag, col) for col, tag in enumerate(all_tags))
+
+    def sent_ys_for(tag):
+        if tag in tag_col:
+            return sent_ys[:, tag_col[tag]]
+        return np.zeros(num_sents, dtype=np.bool_)
 
-    # features for the sentence level predictions
-    td_sent_feats = []
     ys_by_code = defaultdict(list)
-    ix = 0
-    lst_look_back = range(look_back)
-    for essay_ix, essay in enumerate(essays):
-
-        tmp_essays_xs = []
-        for sent_ix, taggged_sentence in enumerate(essay.sentences):
-            tmp_sentence_xs = []
-
-            # unique
-            sent_unique_true_ys = set()
-            un_pred_tags = set()
-            # ixs into the tagged words
-            ixs = range(ix, ix + len(taggged_sentence))
-            ix += len(taggged_sentence)
-
-            for tag in ys_bytag.keys():
-                ys = ys_bytag[tag][ixs]
-                if np.max(ys, axis=0) > 0:
-                    sent_unique_true_ys.add(tag)
-
-                if tag not in sent_input_feats:
-                    continue
-
-                real_pred = real_num_predictions_bytag[tag][ixs]
-                pred = predictions_bytag[tag][ixs]
-
-                assert ys.shape[0] == real_pred.shape[0] == pred.shape[0]
-                mx = np.max(real_pred, axis=0)
-                mn = np.min(real_pred, axis=0)
-
-                tmp_sentence_xs.append(mx)
-                tmp_sentence_xs.append(mn)
-
-                yes_no = np.max(pred)
-                tmp_sentence_xs.append(yes_no)
-
-                if yes_no > 0.0:
-                    un_pred_tags.add(tag)
-                    # for adding 2-way feature combos
-
-            #pairwise interactions (2 way interactions of predicted tags)
-            for a in interaction_tags:
-                for b in interaction_tags:
-                    if b < a:
-                        if a in un_pred_tags and b in un_pred_tags:
-                            tmp_sentence_xs.append(1)
-                        else:
-                            tmp_sentence_xs.append(0)
-
-            extract_ys_by_code(sent_unique_true_ys, sent_input_feats, ys_by_code)
-            tmp_essays_xs.append(tmp_sentence_xs)
-            # end sentence processing
-
-        feats_per_sentence = len(tmp_essays_xs[0])
-        blank = [0] * feats_per_sentence
-
-        """ LOOK BACK """
-        # Right now this isn't very useful. What we need to do is to add on only concept codes
-        # from the previous sentence as additional feats, and possibly interactions between codes
-        # in the previous sentence(s) and the current, treating prev sent codes as different to
-        # current sent codes (e.g. a 50 in sent -1 is different to a 50 in current sentence)
-        for i, sent_feats in enumerate(tmp_essays_xs):
-            concat_feats = list(sent_feats)
-            offset = -1
-            for j in lst_look_back:
-                ix = i + offset
-                if ix < 0:
-                    to_add = blank
-                else:
-                    to_add = tmp_essays_xs[ix]
-                concat_feats.extend(to_add)
-                offset -= 1
-            td_sent_feats.append(concat_feats)
-
-    for k in ys_by_code.keys():
-        ys_by_code[k] = np.asarray(ys_by_code[k])
+    for code in set(sent_input_feats):
+        if code not in __CSL_REL__:
+            ys_by_code[code] = sent_ys_for(code).astype(np.int)
+    causer, result, explicit = sent_ys_for("Causer"), sent_ys_for("Result"), sent_ys_for("explicit")
+    ys_by_code[CAUSAL_REL]   = (causer & explicit).astype(np.int)
+    ys_by_code[RESULT_REL]   = (result & explicit).astype(np.int)
+    ys_by_code[CAUSE_RESULT] = (causer & result & explicit).astype(np.int)
+
+    """ Tag Features """
+    real_preds = np.column_stack([real_num_predictions_bytag[tag] for tag in feat_tags]).astype(np.float64) if feat_tags else np.zeros((sent_lens.sum(), 0))
+    preds      = np.column_stack([predictions_bytag[tag]          for tag in feat_tags]).astype(np.float64) if feat_tags else np.zeros((sent_lens.sum(), 0))
+    sent_max, sent_min = __segment_reduce_(np.maximum, real_preds, sent_lens), __segment_reduce_(np.minimum, real_preds, sent_lens)
+    sent_pred = __segment_reduce_(np.maximum, preds, sent_lens)
+    # max, min then prediction, for each tag in turn
+    tag_feats = np.dstack([sent_max, sent_min, sent_pred]).reshape((num_sents, 3 * len(feat_tags)))
+
+    """ Interactions """
+    # predicted tag indicators, with a trailing all zero column for interaction tags that are never predicted
+    predicted = np.zeros((num_sents, len(feat_tags) + 1), dtype=np.bool_)
+    predicted[:, :len(feat_tags)] = sent_pred > 0.0
+    feat_col = dict((tag, col) for col, tag in enumerate(feat_tags))
+    pairs = [(feat_col.get(a, len(feat_tags)), feat_col.get(b, len(feat_tags)))
+             for a in interaction_tags for b in interaction_tags if b < a]
+    a_cols = np.asarray([a for a, b in pairs], dtype=np.int64)
+    b_cols = np.asarray([b for a, b in pairs], dtype=np.int64)
+    # row-wise product of the indicator matrix with itself, restricted to the tag pairs
+    interactions = predicted[:, a_cols] & predicted[:, b_cols]
 
-    assert len(td_sent_feats) == len(ys_by_code[ys_by_code.keys()[0]])
     if sparse:
-        xs = scipy.sparse.csr_matrix(td_sent_feats)
+        sent_feats = scipy.sparse.hstack([scipy.sparse.csr_matrix(tag_feats), scipy.sparse.csr_matrix(interactions, dtype=np.float64)], format="csr")
     else:
-        xs = np.asarray(td_sent_feats)
-    return xs, ys_by_code
+        sent_feats = np.hstack([tag_feats, interactions.astype(np.float64)])
+
+    """ LOOK BACK """
+    if look_back > 0:
+        sent_essay_start = np.repeat(np.cumsum([0] + [len(essay.sentences) for essay in essays])[:-1],
+                                     [len(essay.sentences) for essay in essays])
+        blocks = [sent_feats]
+        for offset in range(1, look_back + 1):
+            src = np.arange(num_sents) - offset
+            # sentences before the start of the essay get blank (all zero) features
+            valid = src >= sent_essay_start
+            src[~valid] = 0
+            if sparse:
+                blocks.append(scipy.sparse.diags(valid.astype(np.float64), 0).dot(sent_feats[src]))
+            else:
+                blocks.append(sent_feats[src] * valid[:, None])
+        if sparse:
+            sent_feats = scipy.sparse.hstack(blocks, format="csr")
+        else:
+            sent_feats = np.hstack(blocks)
+
+    return sent_feats, ys_by_code
 
 # Similar to above, but where we already have the predictions per class
 def get_sent_feature_for_stacking_from_multiclass_tagging_model(sent_input_tags, sent_output_tags, interaction_tags, essays, ys_bytag, predictions_bytag, real_num_predictions_bytag, sparse=False, look_back=0):
@@ -213,11 +242,12 @@ def get_sent_feature_for_stacking_from_multiclass_tagging_model(sent_input_tags,
             concat_feats = list(sent_feats)
             offset = -1
             for j in lst_look_back:
-                ix = i + offset
-                if ix < 0:
+                # not ix, which indexes the words of the next essay
+                prev_ix = i + offset
+                if prev_ix < 0:
                     to_add = blank
                 else:
-                    to_add = tmp_essays_xs[ix]
+                    to_add = tmp_essays_xs[prev_ix]
                 concat_feats.extend(to_add)
                 offset -= 1
             td_sent_feats.append(concat_feats)
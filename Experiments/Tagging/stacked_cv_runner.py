@@ -0,0 +1,170 @@
+__author__ = 'simon.hughes'
+
+import logging
+from collections import defaultdict
+
+from joblib import Parallel, delayed
+
+from CrossValidation import cross_validation_edges
+from featurevectorizer import FeatureVectorizer
+from sent_feats_for_stacking import get_sent_feature_for_stacking_from_tagging_model
+from wordtagginghelper import flatten_to_wordlevel_feat_tags, get_wordlevel_ys_by_code, \
+    train_classifier_per_code, test_classifier_per_code, merge_dictionaries
+
+logger = logging.getLogger(__name__)
+
+class StackedCVResults(object):
+    """ The merged cross validation results for a stacked (word tagger + sentence classifier) model.
+        Each attribute is a defaultdict mapping a tag to the list of labels or predictions
+        over all folds, in fold order
+    """
+    def __init__(self):
+        self.cv_wd_td_ys_by_tag, self.cv_wd_td_predictions_by_tag = defaultdict(list), defaultdict(list)
+        self.cv_wd_vd_ys_by_tag, self.cv_wd_vd_predictions_by_tag = defaultdict(list), defaultdict(list)
+
+        self.cv_sent_td_ys_by_tag, self.cv_sent_td_predictions_by_tag = defaultdict(list), defaultdict(list)
+        self.cv_sent_vd_ys_by_tag, self.cv_sent_vd_predictions_by_tag = defaultdict(list), defaultdict(list)
+
+    def merge_fold(self, fold_result):
+        merge_dictionaries(fold_result["wd_td_ys_bytag"],               self.cv_wd_td_ys_by_tag)
+        merge_dictionaries(fold_result["wd_vd_ys_bytag"],               self.cv_wd_vd_ys_by_tag)
+        merge_dictionaries(fold_result["td_wd_predictions_by_code"],    self.cv_wd_td_predictions_by_tag)
+        merge_dictionaries(fold_result["vd_wd_predictions_by_code"],    self.cv_wd_vd_predictions_by_tag)
+
+        merge_dictionaries(fold_result["sent_td_ys_bycode"],            self.cv_sent_td_ys_by_tag)
+        merge_dictionaries(fold_result["sent_vd_ys_bycode"],            self.cv_sent_vd_ys_by_tag)
+        merge_dictionaries(fold_result["td_sent_predictions_by_code"],  self.cv_sent_td_predictions_by_tag)
+        merge_dictionaries(fold_result["vd_sent_predictions_by_code"],  self.cv_sent_vd_predictions_by_tag)
+
+def __split_fold_(essay_feats, edges, fold):
+    l, r = edges[fold]
+    return essay_feats[:l] + essay_feats[r:], essay_feats[l:r]
+
+def run_fold(fold, essays_TD, essays_VD, ctx):
+    """
+    Trains and tests the word tagger and stacked sentence classifier on a single fold
+
+    Parameters
+    ----------
+    fold : int
+        index of the fold
+    essays_TD, essays_VD : list[Essay]
+        the training and test essays of the fold
+    ctx : dict
+        the tags, classifier factories and settings, see cross_validate_stacked_tagger
+
+    Returns
+    -------
+    dict[str, dict[str, np.array]] : the labels and predictions for the fold
+    """
+    # TD and VD are lists of Essay objects. The sentences are lists
+    # of featureextractortransformer.Word objects
+    logger.info("Fold %s: training tagging model" % fold)
+    """ Data Partitioning and Training """
+    td_feats, td_tags = flatten_to_wordlevel_feat_tags(essays_TD)
+    vd_feats, vd_tags = flatten_to_wordlevel_feat_tags(essays_VD)
+
+    feature_transformer = FeatureVectorizer(min_feature_freq=ctx["min_feat_freq"], sparse=ctx["sparse_wd_feats"])
+    td_X, vd_X = feature_transformer.fit_transform(td_feats), feature_transformer.transform(vd_feats)
+    wd_td_ys_bytag = get_wordlevel_ys_by_code(td_tags, ctx["wd_train_tags"])
+    wd_vd_ys_bytag = get_wordlevel_ys_by_code(vd_tags, ctx["wd_train_tags"])
+
+    """ TRAIN Tagger """
+    tag2word_classifier = train_classifier_per_code(td_X, wd_td_ys_bytag, ctx["fn_create_wd_cls"], ctx["wd_train_tags"])
+
+    """ TEST Tagger """
+    td_wd_predictions_by_code = test_classifier_per_code(td_X, tag2word_classifier, ctx["wd_test_tags"])
+    vd_wd_predictions_by_code = test_classifier_per_code(vd_X, tag2word_classifier, ctx["wd_test_tags"])
+
+    logger.info("Fold %s: training sentence model" % fold)
+    """ SENTENCE LEVEL PREDICTIONS FROM STACKING """
+    sent_td_xs, sent_td_ys_bycode = get_sent_feature_for_stacking_from_tagging_model(
+        ctx["sent_input_feat_tags"], ctx["sent_input_interaction_tags"], essays_TD, td_X, wd_td_ys_bytag, tag2word_classifier, ctx["sparse_sent_feats"], ctx["look_back"])
+
+    sent_vd_xs, sent_vd_ys_bycode = get_sent_feature_for_stacking_from_tagging_model(
+        ctx["sent_input_feat_tags"], ctx["sent_input_interaction_tags"], essays_VD, vd_X, wd_vd_ys_bytag, tag2word_classifier, ctx["sparse_sent_feats"], ctx["look_back"])
+
+    """ Train Stacked Classifier """
+    tag2sent_classifier = train_classifier_per_code(sent_td_xs, sent_td_ys_bycode, ctx["fn_create_sent_cls"], ctx["sent_output_train_test_tags"])
+
+    """ Test Stack Classifier """
+    td_sent_predictions_by_code \
+        = test_classifier_per_code(sent_td_xs, tag2sent_classifier, ctx["sent_output_train_test_tags"])
+
+    vd_sent_predictions_by_code \
+        = test_classifier_per_code(sent_vd_xs, tag2sent_classifier, ctx["sent_output_train_test_tags"])
+
+    # convert to plain dicts, as defaultdicts with lambda factories can't be pickled back to the parent
+    return dict((name, dict(d)) for name, d in [
+        ("wd_td_ys_bytag",              wd_td_ys_bytag),
+        ("wd_vd_ys_bytag",              wd_vd_ys_bytag),
+        ("td_wd_predictions_by_code",   td_wd_predictions_by_code),
+        ("vd_wd_predictions_by_code",   vd_wd_predictions_by_code),
+        ("sent_td_ys_bycode",           sent_td_ys_bycode),
+        ("sent_vd_ys_bycode",           sent_vd_ys_bycode),
+        ("td_sent_predictions_by_code", td_sent_predictions_by_code),
+        ("vd_sent_predictions_by_code", vd_sent_predictions_by_code)
+    ])
+
+def cross_validate_stacked_tagger(essay_feats, cv_folds,
+                                  wd_train_tags, wd_test_tags,
+                                  sent_input_feat_tags, sent_input_interaction_tags, sent_output_train_test_tags,
+                                  fn_create_wd_cls, fn_create_sent_cls,
+                                  min_feat_freq, sparse_wd_feats=True, sparse_sent_feats=True, look_back=0,
+                                  n_jobs=None, fn_on_fold_complete=None):
+    """
+    Runs k fold cross validation of the window based word tagger, stacked with the sentence classifier,
+    running the folds in parallel
+
+    Parameters
+    ----------
+    essay_feats : list[Essay]
+        essays whose sentences are lists of featureextractortransformer.Word objects
+    cv_folds : int
+        number of folds (split as in CrossValidation.cross_validation)
+    fn_create_wd_cls, fn_create_sent_cls : function ()-> BaseEstimator
+        factory functions to create the word and sentence classifiers
+    n_jobs : int (optional)
+        number of worker processes. Defaults to one per fold
+    fn_on_fold_complete : function (fold, essays_VD, sent_vd_ys_bycode, vd_sent_predictions_by_code) -> None (optional)
+        called in the parent process for each fold, in fold order (e.g. to write out the predictions)
+
+    Returns
+    -------
+    StackedCVResults : the labels and predictions merged over all folds, in fold order
+    """
+    if n_jobs is None:
+        n_jobs = cv_folds
+
+    edges = cross_validation_edges(len(essay_feats), cv_folds)
+    ctx = {
+        "wd_train_tags"                 : wd_train_tags,
+        "wd_test_tags"                  : wd_test_tags,
+        "sent_input_feat_tags"          : sent_input_feat_tags,
+        "sent_input_interaction_tags"   : sent_input_interaction_tags,
+        "sent_output_train_test_tags"   : sent_output_train_test_tags,
+        "fn_create_wd_cls"              : fn_create_wd_cls,
+        "fn_create_sent_cls"            : fn_create_sent_cls,
+        "min_feat_freq"                 : min_feat_freq,
+        "sparse_wd_feats"               : sparse_wd_feats,
+        "sparse_sent_feats"             : sparse_sent_feats,
+        "look_back"                     : look_back
+    }
+
+    # the fold's essays and settings are passed to each task, so the workers need not be forked
+    # from this process (e.g. joblib's default loky backend). The factories are pickled by
+    # cloudpickle, so they can be lambdas
+    tasks = []
+    for fold in range(cv_folds):
+        essays_TD, essays_VD = __split_fold_(essay_feats, edges, fold)
+        tasks.append(delayed(run_fold)(fold, essays_TD, essays_VD, ctx))
+    # Parallel returns the results in the order the folds were submitted
+    fold_results = Parallel(n_jobs=n_jobs)(tasks)
+
+    results = StackedCVResults()
+    for fold, fold_result in enumerate(fold_results):
+        results.merge_fold(fold_result)
+        if fn_on_fold_complete is not None:
+            _, essays_VD = __split_fold_(essay_feats, edges, fold)
+            fn_on_fold_complete(fold, essays_VD, fold_result["sent_vd_ys_bycode"], fold_result["vd_sent_predictions_by_code"])
+    return results
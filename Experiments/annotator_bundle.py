@@ -0,0 +1,110 @@
+__author__ = 'simon.hughes'
+
+import cPickle as pickle
+from collections import defaultdict
+
+from processessays import build_spelling_corrector
+from sent_feats_for_stacking import CAUSAL_REL, RESULT_REL, CAUSE_RESULT
+
+# bump this whenever the contents of the bundle change, so stale bundles fail fast rather than mis-annotate
+ANNOTATOR_BUNDLE_VERSION = 2
+MIN_TAG_FREQ = 5
+
+def get_annotator_tags(tagged_essays, min_tag_freq=MIN_TAG_FREQ):
+    """
+    Determines the tags the annotator predicts from the (un-processed) training essays
+
+    Parameters
+    ----------
+    tagged_essays : list[BrattEssay.Essay]
+        essays loaded with their annotations
+    min_tag_freq : int
+        minimum number of sentences a tag must occur in to be used as a stacking feature
+
+    Returns
+    -------
+    dict[str, list[str]] : the tag lists, keyed by the Annotator attribute name they populate
+    """
+    tag_freq = defaultdict(int)
+    for essay in tagged_essays:
+        for sentence in essay.tagged_sentences:
+            un_tags = set()
+            for word, tags in sentence:
+                for tag in tags:
+                    if "5b" in tag:
+                        continue
+                    if      (tag[-1].isdigit() or tag in {"Causer", "explicit", "Result"} \
+                                or tag.startswith("Causer") or tag.startswith("Result") \
+                                or tag.startswith("explicit") or "->" in tag) \
+                            and not ("Anaphor" in tag or "rhetorical" in tag or "other" in tag):
+                        # if not ("Anaphor" in tag or "rhetorical" in tag or "other" in tag):
+                        un_tags.add(tag)
+            for tag in un_tags:
+                tag_freq[tag] += 1
+
+    all_tags = list(tag_freq.keys())
+    freq_tags = list(set((tag for tag, freq in tag_freq.items() if freq >= min_tag_freq)))
+    non_causal = [t for t in freq_tags if "->" not in t]
+
+    CAUSE_TAGS = ["Causer", "Result", "explicit"]
+    CAUSAL_REL_TAGS = [CAUSAL_REL, CAUSE_RESULT, RESULT_REL]  # + ["explicit"]
+
+    return {
+        # Include all tags for the output
+        "wd_test_tags"                  : list(set(all_tags + CAUSE_TAGS)),
+        # tags from tagging model used to train the stacked model
+        "sent_input_feat_tags"          : list(set(freq_tags + CAUSE_TAGS)),
+        # find interactions between these predicted tags from the word tagger to feed to the sentence tagger
+        "sent_input_interaction_tags"   : list(set(non_causal + CAUSE_TAGS)),
+        # tags to train (as output) for the sentence based classifier
+        "sent_output_train_test_tags"   : list(set(all_tags + CAUSE_TAGS + CAUSAL_REL_TAGS))
+    }
+
+def build_annotator_bundle(tagged_essays, config, spell_check_dict, feat_transform, tag_2_wd_classifier, tag_2_sent_classifier):
+    """
+    Compiles everything the Annotator needs at start up into a single dictionary, so that
+    the server does not need access to the essay corpus
+
+    Parameters
+    ----------
+    tagged_essays : list[BrattEssay.Essay]
+        the (un-processed) training essays, loaded with their annotations
+    config : dict
+        the window based tagger config (see window_based_tagger_config.get_config)
+    spell_check_dict : str
+        folder containing the words.lst dictionary for the spelling corrector
+    feat_transform : FeatureVectorizer
+    tag_2_wd_classifier : dict[str, BaseEstimator]
+    tag_2_sent_classifier : dict[str, BaseEstimator]
+
+    Returns
+    -------
+    dict : the bundle
+    """
+    wd_sent_freq = defaultdict(int)
+    spelling_corrector = build_spelling_corrector(tagged_essays, config["lower_case"], wd_sent_freq, folder=spell_check_dict)
+
+    bundle = {
+        "version"               : ANNOTATOR_BUNDLE_VERSION,
+        "config"                : dict(config),
+        "wd_sent_freq"          : wd_sent_freq,
+        "spelling_corrector"    : spelling_corrector,
+        "feat_transform"        : feat_transform,
+        "tag_2_wd_classifier"   : tag_2_wd_classifier,
+        "tag_2_sent_classifier" : tag_2_sent_classifier
+    }
+    bundle.update(get_annotator_tags(tagged_essays))
+    return bundle
+
+def store_annotator_bundle(bundle, fname):
+    with open(fname, "wb+") as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_annotator_bundle(fname):
+    with open(fname, "rb") as f:
+        bundle = pickle.load(f)
+    version = bundle.get("version")
+    if version != ANNOTATOR_BUNDLE_VERSION:
+        raise Exception("Annotator bundle %s has version %s, expected version %s. Please re-run the training script."
+                        % (fname, str(version), str(ANNOTATOR_BUNDLE_VERSION)))
+    return bundle
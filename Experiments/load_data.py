@@ -6,9 +6,11 @@ def load_process_essays(window_size, min_sentence_length, folder, min_df, remove
                        spelling_correct,
                        replace_nums, stem, remove_stop_words,
                        remove_punctuation, lower_case,
-                       include_vague, include_normal):
+                       include_vague, include_normal,
+                       n_jobs=1, cache_folder=None):
 
-    essays = load_bratt_essays(directory=folder, include_vague=include_vague, include_normal=include_normal)
+    essays = load_bratt_essays(directory=folder, include_vague=include_vague, include_normal=include_normal,
+                               n_jobs=n_jobs, cache_folder=cache_folder)
     return process_essays(essays, min_df=min_df, remove_infrequent=remove_infrequent, spelling_correct=spelling_correct,
                           replace_nums=replace_nums, stem=stem, remove_stop_words=remove_stop_words,
                           remove_punctuation=remove_punctuation, lower_case=lower_case, spelling_corrector=None)
@@ -17,9 +19,11 @@ def load_process_essays_without_annotations(window_size, min_sentence_length, fo
                             spelling_correct,
                             replace_nums, stem, remove_stop_words,
                             remove_punctuation, lower_case,
-                            include_vague, include_normal):
+                            include_vague, include_normal,
+                            n_jobs=1, cache_folder=None):
 
-    essays = load_bratt_essays(directory=folder, include_vague=include_vague, include_normal=include_normal, load_annotations=False)
+    essays = load_bratt_essays(directory=folder, include_vague=include_vague, include_normal=include_normal, load_annotations=False,
+                               n_jobs=n_jobs, cache_folder=cache_folder)
     return process_essays(essays, min_df=min_df, remove_infrequent=remove_infrequent, spelling_correct=spelling_correct,
                           replace_nums=replace_nums, stem=stem, remove_stop_words=remove_stop_words,
                           remove_punctuation=remove_punctuation, lower_case=lower_case, spelling_corrector=None)
@@ -31,6 +35,6 @@ def extract_features(tagged_essays, extractors=None, window_size=None, min_sente
                      spelling_correct=None,
                      replace_nums=None, stem=None, remove_stop_words=None,
                      remove_punctuation=None, lower_case=None,
-                     include_vague=None, include_normal=None):
-    feature_extractor = FeatureExtractorTransformer(extractors)
+                     include_vague=None, include_normal=None, hash_bits=None):
+    feature_extractor = FeatureExtractorTransformer(extractors, hash_bits=hash_bits)
     return feature_extractor.transform(tagged_essays)
@@ -2,6 +2,7 @@ __author__ = 'simon.hughes'
 
 import os
 import cPickle as pickle
+from annotator_bundle import store_annotator_bundle, load_annotator_bundle
 
 class ModelStore():
     def __init__(self, models_folder=None):
@@ -13,6 +14,7 @@ class ModelStore():
         self.feat_transform_file = models_folder + "feat_extractor_pickled.p"
         self.tag_2_wd_classifiers_file = models_folder + "tag_2_wd_classifier_pickled.p"
         self.tag_2_sent_classifiers_file = models_folder + "tag_2_sent_classifier_pickled.p"
+        self.annotator_bundle_file = models_folder + "annotator_bundle_pickled.p"
 
     def __store_model_(self, obj, fname):
         with open(fname, "w+") as f:
@@ -23,6 +25,9 @@ class ModelStore():
         self.__store_model_(tag_2_wd_classifier,    self.tag_2_wd_classifiers_file)
         self.__store_model_(tag_2_sent_classifier,  self.tag_2_sent_classifiers_file)
 
+    def store_annotator_bundle(self, bundle):
+        store_annotator_bundle(bundle, self.annotator_bundle_file)
+
     def __load_model_(self, fname):
         with open(fname, "r+") as f:
             return pickle.load(f)
@@ -35,3 +40,6 @@ class ModelStore():
 
     def get_tag_2_sent_classifier(self):
         return self.__load_model_(self.tag_2_sent_classifiers_file)
+
+    def get_annotator_bundle(self):
+        return load_annotator_bundle(self.annotator_bundle_file)
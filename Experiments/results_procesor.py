@@ -1,8 +1,8 @@
 __author__ = 'simon.hughes'
 
-import pymongo
+from results_sinks import BufferedSink, create_sink
 from Rpfa import mean_rpfa, weighted_mean_rpfa, rpfa, micro_rpfa
-from Metrics import compute_tp_fp_fn, rpf1a_from_tp_fp_tn_fn
+from Metrics import compute_tp_fp_tn_fn_by_tag, rpf1a_from_tp_fp_tn_fn
 from collections import defaultdict
 from datetime import datetime
 
@@ -15,12 +15,24 @@ def is_a_regular_code(code):
 
 class ResultsProcessor(object):
 
-    def __init__(self, fltr = None):
+    def __init__(self, fltr = None, sink = None, buffered = True):
+        """
+        Parameters
+        ----------
+        fltr : function (optional)
+            selects the concept codes for the mean metrics
+        sink : sink (optional)
+            where the results are stored, see results_sinks. Defaults to the sink named by the RESULTS_SINK
+            environment variable (e.g. sqlite:/data/results.db), or else mongo
+        buffered : bool
+            write the results in bulk from a background thread (see results_sinks.BufferedSink)
+        """
         if not fltr:
             fltr = lambda k: k[0].isdigit()
         self.fltr = fltr
-        self.client = pymongo.MongoClient()
-        self.db = self.client.metrics
+        if sink is None:
+            sink = create_sink()
+        self.sink = BufferedSink(sink) if buffered else sink
 
     def __add_meta_data_(self, db_row, experiment_args):
         db_row["parameters"] = experiment_args
@@ -30,22 +42,13 @@ class ResultsProcessor(object):
     def compute_metrics(ys_by_tag, predictions_by_tag):
         """ Compute metrics for all predicted codes """
         metrics_by_tag = dict()
-        for tag, pred_ys in predictions_by_tag.items():
-            try:
-                ys = ys_by_tag[tag]
-                if len(ys) == 0:
-                    continue
-
-                tp, fp, fn = compute_tp_fp_fn(ys, pred_ys)
-                tn = len(ys) - (tp + fp + fn)
-                r, p, f1, acc = rpf1a_from_tp_fp_tn_fn(tp, fp, tn, fn)
-                metric = rpfa(r, p, f1, acc,
-                              nc=len([1 for y in ys if y > 0.0]), data_points=len(ys),
-                              tp=tp, fp=fp, tn=tn, fn=fn)
-                metrics_by_tag[tag] = metric
-            except Exception as e:
-                print("Exception processing tag: %s" % str(tag))
-                raise e
+        # counts for all tags are computed together, see compute_tp_fp_tn_fn_by_tag
+        for tag, (tp, fp, tn, fn, nc) in compute_tp_fp_tn_fn_by_tag(ys_by_tag, predictions_by_tag).items():
+            r, p, f1, acc = rpf1a_from_tp_fp_tn_fn(tp, fp, tn, fn)
+            metric = rpfa(r, p, f1, acc,
+                          nc=nc, data_points=len(ys_by_tag[tag]),
+                          tp=tp, fp=fp, tn=tn, fn=fn)
+            metrics_by_tag[tag] = metric
         return metrics_by_tag
 
     @staticmethod
@@ -106,7 +109,15 @@ class ResultsProcessor(object):
         for key, val in kwargs.items():
             db_row[key] = val
         self.__add_meta_data_(db_row, experiment_args)
-        return self.db[dbcollection].insert(db_row)
+        return self.sink.insert(dbcollection, db_row)
+
+    def flush(self):
+        """ Blocks until all the persisted results are written """
+        if hasattr(self.sink, "flush"):
+            self.sink.flush()
+
+    def close(self):
+        self.sink.close()
 
     @staticmethod
     def __metrics_to_str__(pad_str, tag, td_rpfa, vd_rpfa):
@@ -156,14 +167,14 @@ class ResultsProcessor(object):
 
     def results_to_string(self, td_objectid, td_collection, vd_objectid, vd_collection, header):
 
-        td_metrics = self.db[td_collection].find_one({"_id": td_objectid})
-        vd_metrics = self.db[vd_collection].find_one({"_id": vd_objectid})
+        td_metrics = self.sink.find_one(td_collection, {"_id": td_objectid})
+        vd_metrics = self.sink.find_one(vd_collection, {"_id": vd_objectid})
 
         return ResultsProcessor.metrics_to_string(td_metrics, vd_metrics, header)
 
     def get_metric(self, collection, objectid, metric_key):
 
-        metrics = self.db[collection].find_one({"_id": objectid})
+        metrics = self.sink.find_one(collection, {"_id": objectid})
         return metrics[metric_key]
 
 if __name__ == "__main__":
@@ -0,0 +1,397 @@
+"""
+Storage backends for the experiment results written by results_procesor.ResultsProcessor.
+
+A sink stores result documents (dicts) in named collections, and supports the small query surface the
+ResultsProcessor needs:
+
+    new_id()                            a new, unique document id
+    insert(collection, row)             stores one document, returning its id
+    insert_many(collection, rows)       stores many documents in one round trip
+    find_one(collection, query)         the first document matching the query (e.g. {"_id": id}), or None
+    find(collection, query)             all the documents matching the query
+    close()
+
+MongoSink writes to the metrics database in mongo, SQLiteSink to a local file (so sweeps can run on a node
+without mongo, and be synced to mongo later, see SQLiteSink.sync), and BufferedSink wraps either, writing
+in bulk from a background thread.
+"""
+__author__ = 'simon.hughes'
+
+import atexit
+import copy
+import json
+import logging
+import multiprocessing.util
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+# set this to choose the results store without changing the experiment scripts, see create_sink
+RESULTS_SINK_ENV = "RESULTS_SINK"
+DEFAULT_SINK_URI = "mongo"
+
+__DATE_KEY__ = "$date"
+__DATE_FORMAT__ = "%Y-%m-%dT%H:%M:%S.%f"
+
+def __matches__(document, query):
+    # equality on top level fields, which is all the ResultsProcessor queries on
+    if not query:
+        return True
+    for key, value in query.items():
+        if key not in document or document[key] != value:
+            return False
+    return True
+
+class MongoSink(object):
+    def __init__(self, host=None, db_name="metrics"):
+        import pymongo
+        # as before, fails fast if mongo isn't running
+        self.client = pymongo.MongoClient(host)
+        self.db = self.client[db_name]
+
+    def new_id(self):
+        from bson.objectid import ObjectId
+        return ObjectId()
+
+    def insert(self, collection, row):
+        return self.db[collection].insert(row)
+
+    def insert_many(self, collection, rows):
+        if not rows:
+            return []
+        if hasattr(self.db[collection], "insert_many"):
+            return self.db[collection].insert_many(rows).inserted_ids
+        return self.db[collection].insert(rows)
+
+    def find_one(self, collection, query=None):
+        return self.db[collection].find_one(query)
+
+    def find(self, collection, query=None):
+        return list(self.db[collection].find(query))
+
+    def close(self):
+        self.client.close()
+
+def __to_json_(value):
+    if isinstance(value, datetime):
+        return {__DATE_KEY__: value.strftime(__DATE_FORMAT__)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    # as for mongo, rather than silently storing the str of an unknown object
+    raise TypeError("%s is not JSON serializable: %r" % (type(value).__name__, value))
+
+def __from_json_(dct):
+    if len(dct) == 1 and __DATE_KEY__ in dct:
+        return datetime.strptime(dct[__DATE_KEY__], __DATE_FORMAT__)
+    return dct
+
+def encode_document(document):
+    return json.dumps(document, default=__to_json_, sort_keys=True)
+
+def decode_document(s):
+    return json.loads(s, object_hook=__from_json_)
+
+class SQLiteSink(object):
+    """ Stores the documents as json, in a single table of a local SQLite database. Safe to share
+        between threads, and between processes writing to the same file.
+    """
+    def __init__(self, filename, timeout=60.0):
+        folder = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.filename = filename
+        self.timeout = timeout
+        self.__connect_()
+        with self.__lock_:
+            self.__conn_.execute("""CREATE TABLE IF NOT EXISTS results (
+                                        id          TEXT PRIMARY KEY,
+                                        collection  TEXT NOT NULL,
+                                        document    TEXT NOT NULL,
+                                        synced      INTEGER NOT NULL DEFAULT 0)""")
+            self.__conn_.execute("CREATE INDEX IF NOT EXISTS ix_results_collection ON results (collection)")
+            self.__conn_.commit()
+
+    def __connect_(self):
+        self.__pid_ = os.getpid()
+        self.__lock_ = threading.Lock()
+        self.__conn_ = sqlite3.connect(self.filename, timeout=self.timeout, check_same_thread=False)
+
+    def __connection_(self):
+        # sqlite connections can't be used across a fork, so a forked process (e.g. a joblib worker) opens its own
+        if self.__pid_ != os.getpid():
+            self.__connect_()
+        return self.__conn_
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def insert(self, collection, row):
+        return self.insert_many(collection, [row])[0]
+
+    def insert_many(self, collection, rows):
+        ids, records = [], []
+        for row in rows:
+            if "_id" not in row:
+                row["_id"] = self.new_id()
+            ids.append(row["_id"])
+            records.append((str(row["_id"]), collection, encode_document(row)))
+        conn = self.__connection_()
+        with self.__lock_:
+            # one transaction for the batch
+            with conn:
+                conn.executemany("INSERT INTO results (id, collection, document) VALUES (?, ?, ?)", records)
+        return ids
+
+    def find(self, collection, query=None):
+        conn = self.__connection_()
+        with self.__lock_:
+            if query and "_id" in query:
+                rows = conn.execute("SELECT document FROM results WHERE collection = ? AND id = ?",
+                                            (collection, str(query["_id"]))).fetchall()
+            else:
+                rows = conn.execute("SELECT document FROM results WHERE collection = ? ORDER BY rowid",
+                                            (collection,)).fetchall()
+        documents = [decode_document(doc) for (doc,) in rows]
+        if query:
+            # ids are stored as strings, so compare the rest of the query only
+            query = dict((k, v) for k, v in query.items() if k != "_id")
+        return [doc for doc in documents if __matches__(doc, query)]
+
+    def find_one(self, collection, query=None):
+        documents = self.find(collection, query)
+        return documents[0] if documents else None
+
+    def collections(self):
+        conn = self.__connection_()
+        with self.__lock_:
+            return [c for (c,) in conn.execute("SELECT DISTINCT collection FROM results ORDER BY collection")]
+
+    def sync(self, dest, collections=None, batch_size=500):
+        """
+        Copies the documents not yet synced to the dest sink (e.g. a MongoSink), keeping their ids
+
+        Parameters
+        ----------
+        dest : sink
+        collections : list[str] (optional)
+            collections to sync, defaults to all of them
+        batch_size : int
+            documents per bulk insert
+
+        Returns
+        -------
+        int : the number of documents copied
+        """
+        if collections is None:
+            collections = self.collections()
+        copied = 0
+        conn = self.__connection_()
+        for collection in collections:
+            while True:
+                with self.__lock_:
+                    rows = conn.execute(
+                        "SELECT id, document FROM results WHERE collection = ? AND synced = 0 ORDER BY rowid LIMIT ?",
+                        (collection, batch_size)).fetchall()
+                if not rows:
+                    break
+                dest.insert_many(collection, [decode_document(doc) for (_, doc) in rows])
+                with self.__lock_:
+                    with conn:
+                        conn.executemany("UPDATE results SET synced = 1 WHERE id = ?", [(id,) for (id, _) in rows])
+                copied += len(rows)
+            logging.info("Synced collection %s" % collection)
+        return copied
+
+    def close(self):
+        conn = self.__connection_()
+        with self.__lock_:
+            conn.close()
+
+# tells the writer thread to exit
+__STOP__ = object()
+
+class BufferedSink(object):
+    """
+    Wraps a sink, queueing the inserted documents and writing them in bulk (insert_many) from a background
+    thread, so that the caller doesn't wait on the store. Ids are assigned when the document is queued, so
+    insert returns immediately. Reads flush the queue first, so always see the documents already inserted.
+    Errors from the writer are raised on the next flush (or read), and the documents that failed to write are
+    kept in failed_rows.
+
+    The writer thread is started on the first insert, and again in any process forked after that (e.g. joblib
+    workers, when the sink is created at import), as threads don't survive a fork. Each process flushes its
+    own queue when it exits.
+    """
+    def __init__(self, sink, batch_size=100, flush_interval=2.0):
+        """
+        Parameters
+        ----------
+        sink : sink
+            the sink written to
+        batch_size : int
+            maximum number of documents per bulk insert
+        flush_interval : float
+            maximum number of seconds a document is queued before it is written
+        """
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.failed_rows = []
+        self.__error_ = None
+        self.__closed_ = False
+        # the process the writer thread runs in, None until it is started
+        self.__pid_ = None
+        self.__queue_ = queue.Queue()
+        self.__writer_ = None
+        self.__start_lock_ = threading.Lock()
+        # don't lose the queued results when the script ends
+        atexit.register(self.close)
+
+    def __ensure_writer_(self):
+        if self.__pid_ == os.getpid():
+            return
+        with self.__start_lock_:
+            pid = os.getpid()
+            if self.__pid_ == pid:
+                return
+            if self.__pid_ is not None:
+                # forked: the documents queued in the parent are the parent's to write
+                self.__queue_ = queue.Queue()
+                self.__error_ = None
+                # multiprocessing workers exit without running atexit handlers
+                multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+            self.__writer_ = threading.Thread(target=self.__write_loop_, name="BufferedSink")
+            self.__writer_.daemon = True
+            self.__writer_.start()
+            self.__pid_ = pid
+
+    def __writer_running_(self):
+        return self.__pid_ == os.getpid()
+
+    def new_id(self):
+        return self.sink.new_id()
+
+    def insert(self, collection, row):
+        if self.__closed_:
+            raise ValueError("insert into a closed BufferedSink")
+        # copy, as callers often modify the parameters dict between calls (e.g. in parameter sweeps)
+        row = copy.deepcopy(row)
+        if "_id" not in row:
+            row["_id"] = self.sink.new_id()
+        self.__ensure_writer_()
+        self.__queue_.put((collection, row))
+        return row["_id"]
+
+    def insert_many(self, collection, rows):
+        return [self.insert(collection, row) for row in rows]
+
+    def __write_loop_(self):
+        while True:
+            item = self.__queue_.get()
+            if item is __STOP__:
+                self.__queue_.task_done()
+                return
+            batch = [item]
+            deadline = time.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.__queue_.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is __STOP__:
+                    stop = True
+                    break
+                batch.append(item)
+            self.__write_batch_(batch)
+            for _ in range(len(batch) + (1 if stop else 0)):
+                self.__queue_.task_done()
+            if stop:
+                return
+
+    def __write_batch_(self, batch):
+        by_collection = {}
+        for collection, row in batch:
+            by_collection.setdefault(collection, []).append(row)
+        for collection, rows in by_collection.items():
+            try:
+                self.sink.insert_many(collection, rows)
+            except Exception as e:
+                logging.error("BufferedSink: failed to write %i rows to %s: %s" % (len(rows), collection, str(e)))
+                self.failed_rows.extend((collection, row) for row in rows)
+                self.__error_ = e
+
+    def flush(self):
+        """ Blocks until all queued documents are written """
+        if self.__writer_running_():
+            self.__queue_.join()
+        if self.__error_ is not None:
+            error, self.__error_ = self.__error_, None
+            raise error
+
+    def find(self, collection, query=None):
+        self.flush()
+        return self.sink.find(collection, query)
+
+    def find_one(self, collection, query=None):
+        self.flush()
+        return self.sink.find_one(collection, query)
+
+    def close(self):
+        if self.__closed_:
+            return
+        self.__closed_ = True
+        if self.__writer_running_():
+            self.__queue_.put(__STOP__)
+            self.__writer_.join()
+        try:
+            self.flush()
+        finally:
+            self.sink.close()
+
+def create_sink(uri=None):
+    """
+    Creates the sink described by uri:
+        mongo                   the metrics database on the local mongo server
+        mongodb://host:port     the metrics database on that server
+        sqlite:<file name>      a local SQLite database
+
+    Parameters
+    ----------
+    uri : str (optional)
+        defaults to the RESULTS_SINK environment variable, or mongo if that is not set
+    """
+    if uri is None:
+        uri = os.environ.get(RESULTS_SINK_ENV, DEFAULT_SINK_URI)
+    if uri == "mongo":
+        return MongoSink()
+    if uri.startswith("mongodb://"):
+        return MongoSink(uri)
+    if uri.startswith("sqlite:"):
+        return SQLiteSink(uri[len("sqlite:"):])
+    raise ValueError("Unknown results sink: %s" % uri)
+
+if __name__ == "__main__":
+    import sys
+
+    """ Pushes the results from a local (SQLite) results database to mongo, e.g.
+            python results_sinks.py sqlite:/data/results.db mongo
+    """
+    src, dest = create_sink(sys.argv[1]), create_sink(sys.argv[2] if len(sys.argv) > 2 else DEFAULT_SINK_URI)
+    print("Copied %i results" % src.sync(dest))
+    src.close()
+    dest.close()
@@ -11,6 +11,10 @@ class PosTagger(object):
         """ 
         return nltk.pos_tag(tokenized_doc)
 
+    def tag_many(self, tokenized_docs):
+        """ a list of token lists. Tags them in one call, which avoids re-loading the tagger per doc """
+        return nltk.pos_tag_sents(tokenized_docs)
+
 if __name__ == "__main__":
 
     tagger = PosTagger()
@@ -41,6 +41,19 @@ are already built-in::
 
 and so on.
 
+For many queries (e.g. every token of a corpus), store the vectors in binary form and memory map them,
+and query in batches::
+
+  >>> model.save_vectors('/tmp/vectors')
+  >>> model = Word2Vec.load_vectors('/tmp/vectors')  # memory mapped, read only
+  >>> model.most_similar_many(['woman', ['king', 'woman']], topn=5)
+
+or, trading some recall for speed, through an approximate index::
+
+  >>> index = RandomProjectionIndex(model, n_bits=16, n_tables=8)
+  >>> index.recall(model.index2word[:1000], topn=10)  # fraction of the exact top 10 that the index finds
+  >>> index.most_similar_many(['woman', 'king'], topn=10)
+
 .. [1] Tomas Mikolov, Kai Chen, Greg Corrado, and Jeffrey Dean. Efficient Estimation of Word Representations in Vector Space. In Proceedings of Workshop at ICLR, 2013.
 
 """
@@ -54,7 +67,9 @@ import threading
 from Queue import Queue
 
 from numpy import empty, exp, dot, outer, random, dtype, get_include,\
-    float32 as REAL, uint32, seterr, array, uint8, vstack, argsort, fromstring
+    float32 as REAL, uint32, seterr, array, uint8, vstack, argsort, fromstring,\
+    argpartition, sqrt, einsum, newaxis, ascontiguousarray, arange, int64, unique, concatenate,\
+    load as load_npy, save as save_npy
 
 logger = logging.getLogger(__name__)
 
@@ -108,6 +123,24 @@ except:
         return len([word for word in sentence if word is not None])
 
 
+# file names of the vectors stored by Word2Vec.save_vectors
+VOCAB_FILE = "vocab.txt"
+VECTORS_FILE = "syn0.npy"
+NORM_VECTORS_FILE = "syn0norm.npy"
+
+
+def argtopn(dists, topn):
+    """
+    Indices of the `topn` largest values of `dists`, largest first. Uses argpartition (linear time),
+    so that only the top-N are sorted, rather than the whole vocabulary.
+
+    """
+    if topn >= len(dists):
+        return argsort(dists)[::-1]
+    best = argpartition(dists, len(dists) - topn)[len(dists) - topn:]
+    return best[argsort(dists[best])[::-1]]
+
+
 class Vocab(object):
     """A single vocabulary item, used internally for constructing binary trees (incl. both word leaves and inner nodes)."""
     def __init__(self, **kwargs):
@@ -361,6 +394,50 @@ class Word2Vec(utils.SaveLoad):
         return result
 
 
+    def save_vectors(self, folder):
+        """
+        Store the vocabulary and the (raw and normalized) input-hidden weight matrices in `folder`,
+        as .npy files that `load_vectors()` memory maps.
+
+        """
+        self.init_sims()
+        logger.info("storing %sx%s projection weights into %s" % (len(self.vocab), self.layer1_size, folder))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        save_npy(os.path.join(folder, VECTORS_FILE), ascontiguousarray(self.syn0, dtype=REAL))
+        save_npy(os.path.join(folder, NORM_VECTORS_FILE), ascontiguousarray(self.syn0norm, dtype=REAL))
+        with open(os.path.join(folder, VOCAB_FILE), 'wb') as fout:
+            # in index order, so line numbers are the matrix rows
+            for word in self.index2word:
+                fout.write("%s %i\n" % (utils.to_utf8(word), self.vocab[word].count))
+
+
+    @classmethod
+    def load_vectors(cls, folder, mmap_mode='r'):
+        """
+        Load the vectors stored by `save_vectors()`. By default the weight matrices are memory mapped
+        (read only), so loading is near instant, and processes loading the same vectors share one copy
+        via the OS page cache. Use `mmap_mode=None` to read them into memory instead.
+
+        As with `load_word2vec_format()`, you cannot continue training with a model loaded this way.
+
+        """
+        logger.info("loading projection weights from %s" % (folder))
+        result = Word2Vec()
+        with open(os.path.join(folder, VOCAB_FILE)) as fin:
+            for line_no, line in enumerate(fin):
+                word, count = line.rstrip('\n').rsplit(' ', 1)
+                word = utils.to_unicode(word)  # stored in utf8 by save_vectors
+                result.vocab[word] = Vocab(index=line_no, count=int(count))
+                result.index2word.append(word)
+        result.syn0 = load_npy(os.path.join(folder, VECTORS_FILE), mmap_mode=mmap_mode)
+        result.syn0norm = load_npy(os.path.join(folder, NORM_VECTORS_FILE), mmap_mode=mmap_mode)
+        assert result.syn0.shape == result.syn0norm.shape == (len(result.index2word), result.syn0.shape[1])
+        result.layer1_size = result.syn0.shape[1]
+        logger.info("loaded %s matrix from %s" % (result.syn0.shape, folder))
+        return result
+
+
     def most_similar(self, positive=[], negative=[], topn=10):
         """
         Find the top-N most similar words. Positive words contribute positively towards the
@@ -401,12 +478,67 @@ class Word2Vec(utils.SaveLoad):
         dists = dot(self.syn0norm, mean)
         if not topn:
             return dists
-        best = argsort(dists)[::-1][:topn + len(all_words)]
+        best = argtopn(dists, topn + len(all_words))
         # ignore (don't return) words from the input
         result = [(self.index2word[sim], dists[sim]) for sim in best if sim not in all_words]
         return result[:topn]
 
 
+    def query_vectors(self, queries):
+        """
+        The (unit length) mean vector of each query, as used by `most_similar()`, and the set of
+        indices of the words in each query. Each query is a word, or a list of words or (word, weight)
+        pairs, where words default to a weight of 1.0 (so use a negative weight for negative words).
+
+        """
+        self.init_sims()
+        means, exclude = empty((len(queries), self.layer1_size), dtype=REAL), []
+        for row, query in enumerate(queries):
+            if isinstance(query, basestring):
+                query = [query]
+            query = [(word, 1.0) if isinstance(word, basestring) else word for word in query]
+            if not query:
+                raise ValueError("cannot compute similarity with no input")
+            indices, weights = [], []
+            for word, weight in query:
+                if word not in self.vocab:
+                    raise KeyError("word '%s' not in vocabulary" % word)
+                indices.append(self.vocab[word].index)
+                weights.append(weight)
+            mean = dot(array(weights, dtype=REAL), self.syn0norm[indices]) / len(indices)
+            means[row] = matutils.unitvec(mean)
+            exclude.append(set(indices))
+        return means, exclude
+
+
+    def most_similar_many(self, queries, topn=10, batch_size=1024):
+        """
+        `most_similar()` for many queries at once. Each query is a word, or a list of words or
+        (word, weight) pairs (see `query_vectors()`). Returns the list of the top-N most similar
+        words of each query.
+
+        The similarities of each batch of `batch_size` queries are computed as one matrix product
+        (level 3 BLAS), and the top-N of each query found with argpartition, rather than sorting
+        the whole vocabulary.
+
+        Example::
+
+          >>> trained_model.most_similar_many(['woman', [('king', 1.0), ('man', -1.0), ('woman', 1.0)]], topn=1)
+          [[('man', 0.73723527)], [('queen', 0.50882536)]]
+
+        """
+        means, exclude = self.query_vectors(queries)
+        results = []
+        for start in xrange(0, len(means), batch_size):
+            dists = dot(means[start:start + batch_size], self.syn0norm.T)
+            for row, ignore in zip(dists, exclude[start:start + batch_size]):
+                best = argtopn(row, topn + len(ignore))
+                # ignore (don't return) words from the input
+                result = [(self.index2word[sim], row[sim]) for sim in best if sim not in ignore]
+                results.append(result[:topn])
+        return results
+
+
     def doesnt_match(self, words):
         """
         Which word from the given list doesn't go with the others?
@@ -463,7 +595,10 @@ class Word2Vec(utils.SaveLoad):
     def init_sims(self):
         if getattr(self, 'syn0norm', None) is None:
             logger.info("precomputing L2-norms of word weight vectors")
-            self.syn0norm = vstack(matutils.unitvec(vec) for vec in self.syn0).astype(REAL)
+            # the whole matrix at once, rather than one unitvec call per word. Zero vectors are left unchanged
+            norms = sqrt(einsum('ij,ij->i', self.syn0, self.syn0))
+            norms[norms == 0.0] = 1.0
+            self.syn0norm = (self.syn0 / norms[:, newaxis]).astype(REAL)
 
 
     def accuracy(self, questions, restrict_vocab=30000):
@@ -537,6 +672,99 @@ class Word2Vec(utils.SaveLoad):
 
 
 
+class RandomProjectionIndex(object):
+    """
+    Approximate nearest neighbour (cosine similarity) index over the word vectors of a `Word2Vec` model,
+    using random projection locality sensitive hashing.
+
+    Each of `n_tables` hash tables buckets the vectors by the signs of their projections onto `n_bits`
+    random hyperplanes. The candidates for a query are the words sharing its bucket in any table, and
+    only those are scored exactly. More tables find more of the true neighbours (higher recall, slower),
+    more bits make the buckets smaller (faster, lower recall). Use `recall()` to measure the trade off
+    against the exact `Word2Vec.most_similar_many()` on your own queries.
+
+    """
+    def __init__(self, model, n_bits=16, n_tables=8, seed=1):
+        if not 0 < n_bits < 63:
+            raise ValueError("n_bits must be between 1 and 62")
+        model.init_sims()
+        self.model = model
+        self.n_bits = n_bits
+        self.n_tables = n_tables
+        self.seed = seed
+        self.planes = random.RandomState(seed).randn(n_tables, model.layer1_size, n_bits).astype(REAL)
+        self.powers = (1 << arange(n_bits, dtype=int64))
+
+        logger.info("hashing %i vectors into %i tables of %i bits" % (len(model.index2word), n_tables, n_bits))
+        self.tables = []
+        for table in xrange(n_tables):
+            codes = self.hash(model.syn0norm, table)
+            # group the rows by bucket: sort, then slice at the first row of each bucket
+            order = argsort(codes, kind='mergesort')
+            buckets, starts = unique(codes[order], return_index=True)
+            ends = list(starts[1:]) + [len(order)]
+            self.tables.append(dict((bucket, order[start:end]) for bucket, start, end in zip(buckets.tolist(), starts, ends)))
+
+
+    def hash(self, vectors, table):
+        """The bucket of each row of `vectors` in hash table `table`, as an array of ints."""
+        return dot(dot(vectors, self.planes[table]) > 0, self.powers)
+
+
+    def candidates(self, means):
+        """The indices of the candidate words for each (unit length) query vector in `means`."""
+        codes = [self.hash(means, table).tolist() for table in xrange(self.n_tables)]
+        candidates = []
+        for row in xrange(len(means)):
+            buckets = [self.tables[table].get(codes[table][row]) for table in xrange(self.n_tables)]
+            buckets = [bucket for bucket in buckets if bucket is not None]
+            candidates.append(unique(concatenate(buckets)) if buckets else arange(0, dtype=int64))
+        return candidates
+
+
+    def most_similar_many(self, queries, topn=10):
+        """
+        Approximate `Word2Vec.most_similar_many()`: the top-N most similar words of each query, from its
+        candidates only. May return fewer than `topn` words when a query has few candidates.
+
+        """
+        means, exclude = self.model.query_vectors(queries)
+        results = []
+        for mean, ignore, candidates in zip(means, exclude, self.candidates(means)):
+            dists = dot(self.model.syn0norm[candidates], mean)
+            best = argtopn(dists, topn + len(ignore))
+            result = [(self.model.index2word[candidates[sim]], dists[sim]) for sim in best if candidates[sim] not in ignore]
+            results.append(result[:topn])
+        return results
+
+
+    def recall(self, queries, topn=10):
+        """
+        The recall of the index against the exact result: the fraction of the exact top-N most
+        similar words of the queries (see `Word2Vec.most_similar_many()`) that `most_similar_many()`
+        also returns. Also logs the mean number of candidates scored per query.
+
+        """
+        exact = self.model.most_similar_many(queries, topn)
+        approx = self.most_similar_many(queries, topn)
+        found, total = 0, 0
+        for exact_result, approx_result in zip(exact, approx):
+            approx_words = set(word for word, _ in approx_result)
+            found += sum(1 for word, _ in exact_result if word in approx_words)
+            total += len(exact_result)
+        recall = found / float(total) if total else 1.0
+        means, _ = self.model.query_vectors(queries)
+        n_candidates = sum(len(candidates) for candidates in self.candidates(means))
+        logger.info("%s: recall@%i %.4f over %i queries, %.1f candidates per query (of %i words)" %
+            (self, topn, recall, len(queries), n_candidates / float(max(1, len(queries))), len(self.model.index2word)))
+        return recall
+
+
+    def __str__(self):
+        return "RandomProjectionIndex(n_bits=%s, n_tables=%s, seed=%s)" % (self.n_bits, self.n_tables, self.seed)
+
+
+
 class BrownCorpus(object):
     """Iterate over sentences from the Brown corpus (part of NLTK data)."""
     def __init__(self, dirname):
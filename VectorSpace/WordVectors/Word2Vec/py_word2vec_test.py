@@ -0,0 +1,34 @@
+import shutil
+import tempfile
+import unittest
+
+from numpy import allclose
+
+from py_word2vec import Word2Vec
+
+SENTENCES = [[u"caf\xe9", u"coffee", u"cup"], [u"coffee", u"cup", u"tea"], [u"tea", u"caf\xe9", u"milk"]] * 20
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testSaveLoadVectors(self):
+        model = Word2Vec(SENTENCES, size=10, min_count=1, seed=1)
+        model.save_vectors(self.folder)
+        loaded = Word2Vec.load_vectors(self.folder)
+
+        self.assertIn(u"caf\xe9", loaded.vocab)
+        self.assertEqual(loaded.index2word, model.index2word)
+        for word in model.index2word:
+            self.assertEqual(loaded.vocab[word].index, model.vocab[word].index)
+            self.assertEqual(loaded.vocab[word].count, model.vocab[word].count)
+        self.assertTrue(allclose(loaded.syn0, model.syn0))
+        self.assertTrue(allclose(loaded[u"caf\xe9"], model[u"caf\xe9"]))
+        self.assertEqual([[w for w, _ in sims] for sims in loaded.most_similar_many([u"caf\xe9", u"tea"], topn=3)],
+                         [[w for w, _ in sims] for sims in model.most_similar_many([u"caf\xe9", u"tea"], topn=3)])
+
+if __name__ == "__main__":
+    unittest.main()
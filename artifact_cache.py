@@ -0,0 +1,301 @@
+__author__ = 'simon.hughes'
+
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+import types
+from collections import defaultdict
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+import numpy as np
+from scipy import sparse
+
+# bump this to invalidate every cached artifact (e.g. after changing how keys are computed)
+CACHE_VERSION = 1
+
+PICKLE_EXT = ".pkl"
+COMPRESSED_EXT = ".pkl.gz"
+
+def __update_(hasher, tag, s):
+    # length prefix each value so that adjacent values can never run into each other
+    hasher.update("%s%d:" % (tag, len(s)))
+    hasher.update(s)
+
+def function_name(fn):
+    try:
+        return fn.func_name
+    except AttributeError:
+        return getattr(fn, "__name__", type(fn).__name__)
+
+def __hash_value_(hasher, value, active):
+    """
+    Feeds a canonical byte representation of value into hasher. Unlike str() or hash(), this is
+    stable across processes and machines, and covers the full contents of containers and objects.
+    Raises a TypeError for values that can't be hashed deterministically
+
+    Parameters
+    ----------
+    hasher : hashlib hash object
+    value : object
+    active : set[int]
+        ids of the containers currently being hashed, to guard against cycles
+    """
+    if value is None:
+        hasher.update("N;")
+    elif isinstance(value, bool):
+        hasher.update("B%d;" % int(value))
+    elif isinstance(value, (int, long, float, np.number)):
+        __update_(hasher, "I", repr(value))
+    elif isinstance(value, unicode):
+        __update_(hasher, "U", value.encode("utf-8"))
+    elif isinstance(value, str):
+        __update_(hasher, "S", value)
+    elif isinstance(value, np.ndarray):
+        __update_(hasher, "A", "%s%s" % (value.dtype.str, str(value.shape)))
+        if value.dtype == object:
+            __hash_value_(hasher, value.tolist(), active)
+        else:
+            __update_(hasher, "", np.ascontiguousarray(value).tostring())
+    elif sparse.issparse(value):
+        csr = value.tocsr()
+        __update_(hasher, "M", str(csr.shape))
+        for arr in (csr.data, csr.indices, csr.indptr):
+            __hash_value_(hasher, arr, active)
+    else:
+        if id(value) in active:
+            hasher.update("R;")
+            return
+        active.add(id(value))
+        try:
+            # the container's type is part of the hash, so e.g. [1] and (1,) get different keys
+            if isinstance(value, (list, tuple)):
+                hasher.update("L%s:%d[" % (type(value).__name__, len(value)))
+                for v in value:
+                    __hash_value_(hasher, v, active)
+                hasher.update("]")
+            elif isinstance(value, (dict, defaultdict)):
+                # sort on the digest of each key, as the keys need not be comparable
+                items = sorted((stable_hash(k), v) for k, v in value.items())
+                hasher.update("D%s:%d{" % (type(value).__name__, len(items)))
+                for k, v in items:
+                    hasher.update(k)
+                    __hash_value_(hasher, v, active)
+                hasher.update("}")
+            elif isinstance(value, (set, frozenset)):
+                hasher.update("T%s:%d{" % (type(value).__name__, len(value)))
+                for k in sorted(stable_hash(v) for v in value):
+                    hasher.update(k)
+                hasher.update("}")
+            elif isinstance(value, (type, types.ClassType)):
+                __update_(hasher, "C", "%s.%s" % (value.__module__, value.__name__))
+            elif hasattr(value, "__call__") and hasattr(value, "__code__"):
+                # functions - the name includes any parameters bound by attach_function_identifier,
+                # and the byte code means an edited function no longer matches stale artifacts
+                __update_(hasher, "F", "%s.%s" % (getattr(value, "__module__", ""), function_name(value)))
+                __update_(hasher, "", value.__code__.co_code)
+            elif hasattr(value, "__dict__"):
+                __update_(hasher, "O", "%s.%s" % (type(value).__module__, type(value).__name__))
+                __hash_value_(hasher, value.__dict__, active)
+            elif hasattr(value, "__call__"):
+                __update_(hasher, "F", function_name(value))
+            else:
+                # only values whose repr is their content (e.g. datetimes, Decimals), not the default
+                # repr, which includes the object's memory address
+                value_repr = repr(value)
+                if type(value).__repr__ is object.__repr__ or " at 0x" in value_repr:
+                    raise TypeError("stable_hash can't hash a %s deterministically" % type(value).__name__)
+                __update_(hasher, "X", "%s:%s" % (type(value).__name__, value_repr))
+        finally:
+            active.discard(id(value))
+
+def stable_hash(*args, **kwargs):
+    """
+    Computes a stable (sha256) hex digest over all positional and keyword arguments
+
+    Returns
+    -------
+    str : the hex digest
+    """
+    hasher = hashlib.sha256()
+    active = set()
+    __hash_value_(hasher, args, active)
+    __hash_value_(hasher, kwargs, active)
+    return hasher.hexdigest()
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits, self.misses, self.stores, self.evictions, self.errors = 0, 0, 0, 0, 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def __repr__(self):
+        return "hits: %i misses: %i stores: %i evictions: %i errors: %i hit rate: %.2f" % \
+               (self.hits, self.misses, self.stores, self.evictions, self.errors, self.hit_rate())
+
+class ArtifactCache(object):
+    """
+    A content addressed on disk cache. Each artifact is stored in its own file named
+        <filename_prefix><sha256 of the key>[.pkl|.pkl.gz]
+    Files are written to a temporary file and renamed into place, so concurrent writers and
+    crashed jobs never leave a partially written artifact behind. When max_size_mb is set, the
+    least recently used artifacts sharing the prefix are removed once the total size exceeds it.
+    """
+    def __init__(self, filename_prefix, compress=False, max_size_mb=None, version=None):
+        """
+        Parameters
+        ----------
+        filename_prefix : str
+            path (folder and file name prefix) of the cached files
+        compress : bool
+            gzip the pickled artifacts
+        max_size_mb : float (optional)
+            maximum total size of the artifacts with this prefix. Unlimited if None
+        version : object (optional)
+            code version salt, change this to invalidate the existing artifacts
+        """
+        self.filename_prefix = filename_prefix
+        self.compress = compress
+        self.max_size_mb = max_size_mb
+        self.version = version
+        self.stats = CacheStats()
+        self.__lock_ = threading.Lock()
+
+    def key(self, *args, **kwargs):
+        return stable_hash(CACHE_VERSION, self.version, args, kwargs)
+
+    def filename(self, key):
+        return self.filename_prefix + key + (COMPRESSED_EXT if self.compress else PICKLE_EXT)
+
+    def __open_(self, fname, mode):
+        if self.compress:
+            return gzip.open(fname, mode)
+        return open(fname, mode)
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        (bool, object) : whether the key was found, and the cached artifact
+        """
+        fname = self.filename(key)
+        if os.path.exists(fname):
+            try:
+                with self.__open_(fname, "rb") as f:
+                    result = pickle.load(f)
+                # touch the file so eviction is by last use, not creation (atime is often disabled)
+                os.utime(fname, None)
+                with self.__lock_:
+                    self.stats.hits += 1
+                return True, result
+            except Exception:
+                # a corrupt or unreadable artifact is treated as a miss, and replaced
+                with self.__lock_:
+                    self.stats.errors += 1
+        with self.__lock_:
+            self.stats.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        fname = self.filename(key)
+        folder = os.path.dirname(os.path.abspath(fname))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        fd, tmp_fname = tempfile.mkstemp(dir=folder, prefix=os.path.basename(self.filename_prefix), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                if self.compress:
+                    with gzip.GzipFile(fileobj=tmp, mode="wb") as f:
+                        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                else:
+                    pickle.dump(value, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            try:
+                os.rename(tmp_fname, fname)
+            except OSError:
+                # windows won't rename over an existing file
+                if os.path.exists(fname):
+                    os.remove(fname)
+                os.rename(tmp_fname, fname)
+        except:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+
+        with self.__lock_:
+            self.stats.stores += 1
+        if self.max_size_mb is not None:
+            self.evict(keep=fname)
+
+    def artifacts(self):
+        """
+        Returns
+        -------
+        list[(float, int, str)] : the (last used time, size in bytes, file name) of the cached artifacts
+        """
+        folder = os.path.dirname(os.path.abspath(self.filename_prefix))
+        prefix = os.path.basename(self.filename_prefix)
+        if not os.path.exists(folder):
+            return []
+        files = []
+        for fname in os.listdir(folder):
+            if fname.startswith(prefix) and (fname.endswith(PICKLE_EXT) or fname.endswith(COMPRESSED_EXT)):
+                full_path = os.path.join(folder, fname)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    # removed by another process
+                    continue
+                files.append((st.st_mtime, st.st_size, full_path))
+        return files
+
+    def size_mb(self):
+        return sum(size for _, size, _ in self.artifacts()) / (1024.0 * 1024.0)
+
+    def evict(self, keep=None):
+        """ Removes the least recently used artifacts until the total size is within max_size_mb.
+            The artifact named keep (the one just written) is never removed
+        """
+        max_bytes = self.max_size_mb * 1024 * 1024
+        files = sorted(self.artifacts())
+        total = sum(size for _, size, _ in files)
+        for _, size, fname in files:
+            if total <= max_bytes:
+                break
+            if fname == keep:
+                continue
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total -= size
+            with self.__lock_:
+                self.stats.evictions += 1
+
+    def clear(self):
+        for _, _, fname in self.artifacts():
+            os.remove(fname)
+
+    def __call__(self, f):
+        """ Decorates f, caching its results on all of its arguments """
+        def wrapped_f(*args, **kwargs):
+            key = self.key("%s.%s" % (f.__module__, function_name(f)), f.__code__.co_code, args, kwargs)
+            found, result = self.get(key)
+            if found:
+                return result
+            result = f(*args, **kwargs)
+            self.put(key, result)
+            return result
+        wrapped_f.cache = self
+        wrapped_f.func_name = function_name(f)
+        wrapped_f.__doc__ = f.__doc__
+        return wrapped_f